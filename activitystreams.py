@@ -10,7 +10,8 @@ each element is optional. user_id may be @me. group_id may be @all, @friends
 matter, it's currently ignored.
 
 The supported query parameters are startIndex and count, which are handled as
-described in OpenSocial (above) and OpenSearch.
+described in OpenSocial (above) and OpenSearch, and cursor, which takes the
+opaque nextCursor from a previous response and fetches the page after it.
 
 Other relevant activity REST APIs:
 http://status.net/wiki/Twitter-compatible_API
@@ -26,9 +27,11 @@ http://atomenabled.org/developers/syndication/
 
 __author__ = ['Ryan Barrett <granary@ryanb.org>']
 
+import hashlib
 import json
 import logging
 import urllib
+import urlparse
 
 from google.appengine.ext import ndb
 from oauth_dropins.webutil import handlers
@@ -52,20 +55,47 @@ XML_TEMPLATE = """\
 <response>%s</response>
 """
 ITEMS_PER_PAGE = 100
+# JSON and Atom output are generated incrementally and written out in chunks of
+# about this many characters.
+OUTPUT_CHUNK_SIZE = 64 * 1024
 
 # default values for each part of the API request path except the site, e.g.
 # /twitter/@me/@self/@all/...
 PATH_DEFAULTS = ((source.ME,), (source.ALL, source.FRIENDS), (source.APP,), ())
 MAX_PATH_LEN = len(PATH_DEFAULTS) + 1
 
+# Cached responses expire after this many seconds, or sooner if the cache's own
+# TTL is shorter.
+RESPONSE_CACHE_TTL = 24 * 60 * 60
+
+# Headers that aren't stored with cached responses.
+UNCACHED_HEADERS = frozenset(('content-length', 'etag'))
+
+
+def normalize_url(url):
+  """Normalizes a URL for use in a cache key.
+
+  Lower cases the scheme and host, defaults the path to /, and drops the
+  fragment.
+  """
+  parsed = urlparse.urlsplit(url)
+  return urlparse.urlunsplit((parsed.scheme.lower(), parsed.netloc.lower(),
+                              parsed.path or '/', parsed.query, ''))
+
 
 class Handler(webapp2.RequestHandler):
   """Base class for ActivityStreams API handlers.
 
   Attributes:
     source: Source subclass
+    response_cache: optional cache for rendered responses with get() and
+      set_multi() methods, e.g. a source.LRUCache, optionally backed by
+      memcache. If set, responses get an ETag, clients' conditional requests
+      get 304s, and cached responses are revalidated upstream with the
+      source's ETag. May be set on a subclass or on Handler itself.
   """
   handle_exception = handlers.handle_exception
+  response_cache = None
 
   def get(self):
     """Handles an API GET.
@@ -73,6 +103,8 @@ class Handler(webapp2.RequestHandler):
     Request path is of the form /site/user_id/group_id/app_id/activity_id ,
     where each element except site is an optional string object id.
     """
+    key, cached = self.get_cached_response()
+
     # parse path
     args = urllib.unquote(self.request.path).strip('/').split('/')
     if not args or len(args) > MAX_PATH_LEN:
@@ -108,22 +140,33 @@ class Handler(webapp2.RequestHandler):
             for a, defaults in zip(args, PATH_DEFAULTS)]
     user_id = args[0] if args else None
 
-    # get activities
+    # get activities. if we have a cached response, revalidate it.
+    kwargs = self.get_kwargs(src)
+    cached_etag = cached and cached['upstream'].get('etag')
+    if cached_etag:
+      kwargs['etag'] = cached_etag
     try:
-      response = src.get_activities_response(*args, **self.get_kwargs(src))
+      response = src.get_activities_response(*args, **kwargs)
     except NotImplementedError as e:
       self.abort(400, str(e))
 
-    # fetch actor if necessary
-    actor = response.get('actor')
-    if not actor and self.request.get('format') == 'atom':
-      # atom needs actor
-      args = [None if a in defaults else a  # handle default path elements
-              for a, defaults in zip(args, PATH_DEFAULTS)]
-      user_id = args[0] if args else None
-      actor = src.get_actor(user_id) if src else {}
+    if (cached_etag and not response.get('items') and
+        response.get('etag') in (None, cached_etag)):
+      # nothing changed upstream, e.g. 304 Not Modified
+      self.write_cached_response(cached)
+    else:
+      # fetch actor if necessary
+      actor = response.get('actor')
+      if not actor and self.request.get('format') == 'atom':
+        # atom needs actor
+        args = [None if a in defaults else a  # handle default path elements
+                for a, defaults in zip(args, PATH_DEFAULTS)]
+        user_id = args[0] if args else None
+        actor = src.get_actor(user_id) if src else {}
+
+      self.write_response(response, actor=actor, url=src.BASE_URL)
 
-    self.write_response(response, actor=actor, url=src.BASE_URL)
+    self.finish_response(key, upstream={'etag': response.get('etag')})
 
   def write_response(self, response, actor=None, url=None, title=None):
     """Converts ActivityStreams activities and writes them out.
@@ -147,11 +190,11 @@ class Handler(webapp2.RequestHandler):
     self.response.headers['Access-Control-Allow-Origin'] = '*'
     if format in ('json', 'activitystreams'):
       self.response.headers['Content-Type'] = 'application/json'
-      self.response.out.write(json.dumps(response, indent=2))
+      self.write_chunks(json.JSONEncoder(indent=2).iterencode(response))
     elif format == 'atom':
       self.response.headers['Content-Type'] = 'text/xml'
       hub = self.request.get('hub')
-      self.response.out.write(atom.activities_to_atom(
+      self.write_chunks(atom.generate_atom(
         activities, actor,
         host_url=url or self.request.host_url + '/',
         request_url=self.request.url,
@@ -170,23 +213,122 @@ class Handler(webapp2.RequestHandler):
     elif format == 'json-mf2':
       self.response.headers['Content-Type'] = 'application/json'
       items = [microformats2.object_to_json(a) for a in activities]
-      self.response.out.write(json.dumps({'items': items}, indent=2))
+      self.write_chunks(json.JSONEncoder(indent=2).iterencode({'items': items}))
 
     if 'plaintext' in self.request.params:
       # override response content type
       self.response.headers['Content-Type'] = 'text/plain'
 
-  def get_kwargs(self, source):
-    """Extracts, normalizes and returns the startIndex, count, and search
-    query params.
+  def write_chunks(self, chunks):
+    """Writes incrementally generated output to the response.
+
+    Buffers small chunks, e.g. individual JSON tokens, and writes them out about
+    OUTPUT_CHUNK_SIZE characters at a time, so that we never hold the whole
+    output in memory as a single string.
+
+    Args:
+      chunks: iterable of strings
+    """
+    buf = []
+    size = 0
+    for chunk in chunks:
+      buf.append(chunk)
+      size += len(chunk)
+      if size >= OUTPUT_CHUNK_SIZE:
+        self.response.out.write(''.join(buf))
+        buf = []
+        size = 0
+
+    if buf:
+      self.response.out.write(''.join(buf))
+
+  def cache_key(self):
+    """Returns the response cache key for the current request.
+
+    Based on the request path and all query parameters, including access
+    tokens, so different users never share responses. The key is hashed, so
+    tokens aren't stored in the cache in plain text.
+    """
+    params = sorted((name, normalize_url(val) if name == 'url' else val)
+                    for name, val in self.request.params.items())
+    return 'AR ' + hashlib.md5(json.dumps([self.request.path, params])).hexdigest()
+
+  def get_cached_response(self):
+    """Looks up the current request in the response cache.
+
+    Returns:
+      (string key, dict cached response) tuple. Both are None if
+      response_cache isn't set. The cached response is None on a miss.
+    """
+    if self.response_cache is None:
+      return None, None
+    key = self.cache_key()
+    return key, self.response_cache.get(key)
+
+  def write_cached_response(self, cached):
+    """Writes out a cached response's headers and body.
+
+    Args:
+      cached: dict, cached response from get_cached_response()
+    """
+    seen = set()
+    for name, val in cached['headers']:
+      if name in seen:
+        self.response.headers.add(name, val)
+      else:
+        self.response.headers[name] = val
+        seen.add(name)
+    self.response.out.write(cached['body'])
+
+  def finish_response(self, key, upstream=None):
+    """Caches the response and answers conditional requests for it.
+
+    Call after the response's body and headers are complete. Adds an ETag based
+    on the body and returns 304 if it matches the request's If-None-Match.
+    Does nothing if response_cache isn't set.
+
+    Args:
+      key: string, response cache key from get_cached_response()
+      upstream: dict, upstream validators to store with the response, e.g.
+        'etag' and 'last_modified'. Used to revalidate it later.
+    """
+    if self.response_cache is None or self.response.status_int != 200:
+      return
+
+    body = self.response.body
+    self.response_cache.set_multi({key: {
+      'body': body,
+      'headers': [(name, val) for name, val in self.response.headers.items()
+                  if name.lower() not in UNCACHED_HEADERS],
+      'upstream': upstream or {},
+    }}, time=RESPONSE_CACHE_TTL)
+
+    etag = '"%s"' % hashlib.md5(body).hexdigest()
+    self.response.headers['ETag'] = etag
+    if_none_match = self.request.headers.get('If-None-Match', '')
+    if etag in [e.strip() for e in if_none_match.split(',')]:
+      self.response.clear()
+      self.response.status_int = 304
+
+  def get_kwargs(self, src):
+    """Extracts, normalizes and returns the startIndex, count, cursor, and
+    search query params.
 
     Args:
-      source: Source instance
+      src: Source instance
 
     Returns:
       dict with 'start_index' and 'count' keys mapped to integers
     """
-    start_index = self.get_positive_int('startIndex')
+    cursor = self.request.get('cursor')
+    if cursor:
+      try:
+        source.decode_cursor(cursor)
+      except ValueError, e:
+        raise exc.HTTPBadRequest(unicode(e))
+
+    # a cursor replaces startIndex, so later pages don't fetch the earlier ones
+    start_index = 0 if cursor else self.get_positive_int('startIndex')
     count = self.get_positive_int('count')
 
     if count == 0:
@@ -195,6 +337,8 @@ class Handler(webapp2.RequestHandler):
       count = min(count, ITEMS_PER_PAGE)
 
     kwargs = {'start_index': start_index, 'count': count}
+    if cursor:
+      kwargs['cursor'] = cursor
 
     search_query = self.request.get('search_query') or self.request.get('q')
     if search_query:
@@ -22,6 +22,7 @@ from oauth_dropins import twitter
 from oauth_dropins.webutil import handlers
 from oauth_dropins.webutil import util
 import webapp2
+from webob import exc
 
 import activitystreams
 from granary import microformats2
@@ -35,6 +36,35 @@ API_PARAMS = {
   'format',
 }
 
+# /url reads at most this many bytes of the fetched page. HTML past the limit is
+# ignored, since a prefix of an HTML page can still be parsed. JSON inputs over
+# the limit are rejected.
+MAX_FETCH_BYTES = 5 * 1024 * 1024
+# /url reads the fetched page this many bytes at a time.
+FETCH_CHUNK_SIZE = 64 * 1024
+
+
+def read_bounded(resp, max_bytes):
+  """Reads a response's body a chunk at a time, up to a maximum size.
+
+  Args:
+    resp: file-like HTTP response, e.g. from urllib2.urlopen()
+    max_bytes: integer
+
+  Returns: (string body, boolean truncated) tuple. truncated is True if the
+    response had more than max_bytes.
+  """
+  chunks = []
+  size = 0
+  while size < max_bytes:
+    chunk = resp.read(min(FETCH_CHUNK_SIZE, max_bytes - size))
+    if not chunk:
+      return ''.join(chunks), False
+    chunks.append(chunk)
+    size += len(chunk)
+
+  return ''.join(chunks), bool(resp.read(1))
+
 
 class FrontPageHandler(handlers.TemplateHandler):
   """Renders and serves the front page."""
@@ -88,32 +118,63 @@ class UrlHandler(activitystreams.Handler):
   handle_exception = handlers.handle_exception
 
   def get(self):
+    key, cached = self.get_cached_response()
+
     expected_inputs = ('activitystreams', 'html', 'json-mf2')
     input = util.get_required_param(self, 'input')
     if input not in expected_inputs:
       raise exc.HTTPBadRequest('Invalid input: %s, expected one of %r' %
                                (input, expected_inputs))
 
-    # fetch url
+    # fetch url. if we have a cached response, make the request conditional.
     url = util.get_required_param(self, 'url')
-    resp = util.urlopen(url)
+    upstream = cached['upstream'] if cached else {}
+    headers = {}
+    if upstream.get('etag'):
+      headers['If-None-Match'] = upstream['etag']
+    if upstream.get('last_modified'):
+      headers['If-Modified-Since'] = upstream['last_modified']
+
+    try:
+      resp = util.urlopen(urllib2.Request(url, headers=headers) if headers else url)
+      status = resp.getcode()
+    except urllib2.HTTPError as e:
+      if e.code != 304 or not cached:
+        raise
+      status = 304
+
+    if status == 304 and cached:  # Not Modified. serve the cached response.
+      logging.info('%s not modified, using cached response', url)
+      self.write_cached_response(cached)
+      self.finish_response(key, upstream=upstream)
+      return
+
     if url != resp.geturl():
       url = resp.geturl()
       logging.info('Redirected to %s', url)
-    body = resp.read()
+
+    # read at most MAX_FETCH_BYTES
+    body, truncated = read_bounded(resp, MAX_FETCH_BYTES)
+    if truncated:
+      if input != 'html':
+        raise exc.HTTPBadRequest('%s is over the max size, %s bytes' %
+                                 (url, MAX_FETCH_BYTES))
+      logging.warning('%s is over %s bytes; ignoring the rest', url,
+                      MAX_FETCH_BYTES)
 
     # decode data
     mf2 = None
     if input == 'activitystreams':
       activities = json.loads(body)
     elif input == 'html':
-      activities = microformats2.html_to_activities(body, url)
       mf2 = mf2py.parse(doc=body, url=url)
+      activities = microformats2.html_to_activities(body, url, parsed=mf2)
     elif input == 'json-mf2':
       mf2 = json.loads(body)
       mf2['rels'] = {}  # mf2util expects rels
       activities = [microformats2.json_to_object(item)
                     for item in mf2.get('items', [])]
+    del body  # don't hold onto the raw page while rendering
 
     author = None
     title = None
@@ -124,6 +185,12 @@ class UrlHandler(activitystreams.Handler):
     self.write_response(source.Source.make_activities_base_response(activities),
                         url=url, actor=author, title=title)
 
+    resp_headers = resp.info()
+    self.finish_response(key, upstream={
+      'etag': resp_headers.get('ETag'),
+      'last_modified': resp_headers.get('Last-Modified'),
+    })
+
 
 application = webapp2.WSGIApplication([
   ('/', FrontPageHandler),
@@ -18,14 +18,49 @@ import microformats2
 import source
 
 ATOM_TEMPLATE_FILE = 'user_feed.atom'
+# Optional directory of templates precompiled to Python by compile_templates().
+# If it exists, templates are loaded from it instead of compiled at runtime.
+COMPILED_TEMPLATES_DIR = os.path.join(os.path.dirname(__file__),
+                                      'templates_compiled')
 # stolen from django.utils.html
 UNENCODED_AMPERSANDS_RE = re.compile(r'&(?!(\w+|#\d+);)')
 
 
+# The jinja2 Environment, built lazily by _environment(). It caches compiled
+# templates, so it's shared across all calls.
+_env = None
+
+
 def _encode_ampersands(text):
   return UNENCODED_AMPERSANDS_RE.sub('&amp;', text)
 
 
+def _environment():
+  """Returns the shared jinja2 Environment, building it on first use."""
+  global _env
+  if _env is None:
+    loader = jinja2.PackageLoader(__package__, 'templates')
+    if os.path.isdir(COMPILED_TEMPLATES_DIR):
+      loader = jinja2.ChoiceLoader([jinja2.ModuleLoader(COMPILED_TEMPLATES_DIR),
+                                    loader])
+    _env = jinja2.Environment(loader=loader, autoescape=True)
+  return _env
+
+
+def compile_templates(target=COMPILED_TEMPLATES_DIR):
+  """Precompiles the Atom templates to Python modules, e.g. at build time.
+
+  activities_to_atom() loads them from COMPILED_TEMPLATES_DIR if it exists.
+
+  Args:
+    target: string, directory to write the compiled templates to
+  """
+  env = jinja2.Environment(loader=jinja2.PackageLoader(__package__, 'templates'),
+                           autoescape=True)
+  env.compile_templates(target, zip=None,
+                        filter_func=lambda name: name.endswith('.atom'))
+
+
 def activities_to_atom(activities, actor, title=None, request_url=None,
                        host_url=None, xml_base=None, rels=None):
   """Converts ActivityStreams activites to an Atom feed.
@@ -42,6 +77,31 @@ def activities_to_atom(activities, actor, title=None, request_url=None,
 
   Returns: unicode string with Atom XML
   """
+  return _environment().get_template(ATOM_TEMPLATE_FILE).render(
+    **_template_vars(activities, actor, title=title, request_url=request_url,
+                     host_url=host_url, xml_base=xml_base, rels=rels))
+
+
+def generate_atom(activities, actor, **kwargs):
+  """Converts ActivityStreams activites to an Atom feed, incrementally.
+
+  Like activities_to_atom(), but yields the feed in chunks as it's rendered
+  instead of building the whole document in memory. Takes the same args.
+
+  Returns: generator of unicode strings with Atom XML
+  """
+  return _environment().get_template(ATOM_TEMPLATE_FILE).generate(
+    **_template_vars(activities, actor, **kwargs))
+
+
+def _template_vars(activities, actor, title=None, request_url=None,
+                   host_url=None, xml_base=None, rels=None):
+  """Prepares ActivityStreams activites to be rendered into an Atom feed.
+
+  See activities_to_atom() for args.
+
+  Returns: dict of template variables
+  """
   # Strip query params from URLs so that we don't include access tokens, etc
   host_url = (_remove_query_params(host_url) if host_url
               else 'https://github.com/snarfed/granary')
@@ -93,11 +153,9 @@ def activities_to_atom(activities, actor, title=None, request_url=None,
     def __unicode__(self):
       return super(Defaulter, self).__unicode__() if self else u''
 
-  env = jinja2.Environment(loader=jinja2.PackageLoader(__package__, 'templates'),
-                           autoescape=True)
   if actor is None:
     actor = {}
-  return env.get_template(ATOM_TEMPLATE_FILE).render(
+  return dict(
     items=[Defaulter(**a) for a in activities],
     host_url=host_url,
     request_url=request_url,
@@ -120,7 +178,7 @@ def html_to_atom(html, url=None, **kwargs):
   """
   parsed = mf2py.parse(doc=html, url=url)
   return activities_to_atom(
-    microformats2.html_to_activities(html, url),
+    microformats2.html_to_activities(html, url, parsed=parsed),
     microformats2.find_author(parsed),
     title=mf2util.interpret_feed(parsed, url).get('name'),
     xml_base=util.base_url(url),
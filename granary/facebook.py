@@ -61,6 +61,7 @@ import mf2util
 import appengine_config
 from oauth_dropins.webutil import util
 import source
+import times
 
 # WARNING: when we upgrade to 2.4, we'll need to start including the fields
 # query param for most or all requests. :/
@@ -73,7 +74,9 @@ API_COMMENT = '%s?fields=id,message,from,created_time,message_tags,parent,attach
 # Ideally this fields arg would just be [default fields plus comments], but
 # there's no way to ask for that. :/
 # https://developers.facebook.com/docs/graph-api/using-graph-api/v2.1#fields
-API_EVENT = '%s?fields=comments,description,end_time,id,likes,name,owner,picture,privacy,start_time,timezone,updated_time,venue'
+API_EVENT_FIELDS = 'comments,description,end_time,id,likes,name,owner,picture,privacy,start_time,timezone,updated_time,venue'
+API_EVENT = '%s?fields=' + API_EVENT_FIELDS
+API_EVENTS = '?ids=%s&fields=' + API_EVENT_FIELDS
 # WARNING: this edge is deprecated in API v2.4 and will stop working in 2017.
 # https://developers.facebook.com/docs/apps/changelog#v2_4_deprecations
 API_EVENT_RSVPS = '%s/invited'
@@ -99,6 +102,17 @@ API_NEWS_PUBLISHES = 'me/news.publishes'
 API_VIDEOS = 'https://graph-video.facebook.com/v2.3/me/videos'
 
 MAX_IDS = 50  # for the ids query param
+MAX_BATCH_SIZE = 50  # max requests in a single batch API call
+MAX_EVENT_RSVP_PAGES = 10  # per event, when fetching invite lists
+
+# Query params from a feed's paging.next URL that are carried over in cursors.
+# https://developers.facebook.com/docs/graph-api/using-graph-api/v2.2#paging
+PAGING_PARAMS = frozenset(('until', 'since', 'after', 'before', '__paging_token'))
+
+# Matches JSONPath references to other requests' results in batch API calls,
+# e.g. {result=events:$.data.*.id}. Group 1 is the referenced request's name.
+# https://developers.facebook.com/docs/graph-api/making-multiple-requests#operations
+BATCH_REFERENCE_RE = re.compile(r'{result=([^:}]+):[^}]*}')
 
 # Maps Facebook Graph API type, status_type, or Open Graph data type to
 # ActivityStreams objectType.
@@ -193,13 +207,15 @@ class Facebook(source.Source):
       user_id = 'me'
     return self.user_to_actor(self.urlopen(user_id))
 
+  @source.with_actor_memo
   def get_activities_response(self, user_id=None, group_id=None, app_id=None,
                               activity_id=None, start_index=0, count=0,
                               etag=None, min_id=None, cache=None,
                               fetch_replies=False, fetch_likes=False,
                               fetch_shares=False, fetch_events=False,
                               fetch_mentions=False, search_query=None,
-                              fetch_news=False, event_owner_id=None, **kwargs):
+                              cursor=None, fetch_news=False, event_owner_id=None,
+                              **kwargs):
     """Fetches posts and converts them to ActivityStreams activities.
 
     See method docstring in source.py for details.
@@ -215,6 +231,9 @@ class Facebook(source.Source):
     searching for them.
     https://github.com/snarfed/bridgy/issues/523#issuecomment-155523875
 
+    Cursors wrap the paging params from the feed's paging.next URL, e.g. until
+    and __paging_token, which are cheaper for the API than large offsets.
+
     Additional args:
       fetch_news: boolean, whether to also fetch and include Open Graph news
         stories (/USER/news.publishes). Requires the user_actions.news
@@ -228,6 +247,7 @@ class Facebook(source.Source):
       raise NotImplementedError()
 
     activities = []
+    next_cursor = None
     if activity_id:
       # Sometimes Facebook requires post ids in USERID_POSTID format; sometimes
       # it doesn't accept that format. I can't tell which is which yet, so try
@@ -266,31 +286,69 @@ class Facebook(source.Source):
 
     else:
       url = API_SELF_POSTS if group_id == source.SELF else API_HOME
-      url = url % (user_id if user_id else 'me', start_index)
+      if cursor:
+        paging = {k: v for k, v in source.decode_cursor(cursor).items()
+                  if k in PAGING_PARAMS}
+        url = util.add_query_params(url % (user_id if user_id else 'me', 0),
+                                    paging)
+      else:
+        url = url % (user_id if user_id else 'me', start_index)
       if count:
         url = util.add_query_params(url, {'limit': count})
       headers = {'If-None-Match': etag} if etag else {}
-      try:
-        resp = self.urlopen(url, headers=headers, _as=None)
-        etag = resp.info().get('ETag')
-        posts = self._as(list, json.loads(resp.read()))
-      except urllib2.HTTPError, e:
-        if e.code == 304:  # Not Modified, from a matching ETag
-          posts = []
-        else:
-          raise
 
       if group_id == source.SELF:
         # TODO: save and use ETag for all of these extra calls
-        # TODO: use batch API to get photos, events, etc in one request
-        # https://developers.facebook.com/docs/graph-api/making-multiple-requests
-        # https://github.com/snarfed/bridgy/issues/44
+        resps = self._get_self_batch(url, headers, fetch_news=fetch_news,
+                                     fetch_events=fetch_events)
+        feed = resps['feed']
+        if int(feed.get('code', 0)) == 304:  # Not Modified, from a matching ETag
+          posts = []
+        else:
+          feed_body = self._batch_body(feed, url)
+          posts = self._as(list, feed_body)
+          next_cursor = self._paging_cursor(feed_body)
+          etag = feed.get('headers', {}).get('ETag')
+
         if fetch_news:
-          posts.extend(self.urlopen(API_NEWS_PUBLISHES, _as=list))
-        posts = self._merge_photos(posts)
+          posts.extend(self._as(list, self._batch_body(resps['news'],
+                                                       API_NEWS_PUBLISHES)))
+
+        albums = resps['albums']
+        posts = self._merge_photos(
+          posts,
+          photos=self._as(list, self._batch_body(resps['photos'],
+                                                 API_PHOTOS_UPLOADED)),
+          # fall back to fetching albums only if they're needed
+          albums=(self._as(list, albums.get('body'))
+                  if int(albums.get('code', 0)) / 100 == 2 else None))
+
         if fetch_events:
-          activities.extend(self._get_events(owner_id=event_owner_id))
+          rsvps = self._as(list, self._batch_body(resps['events'], API_USER_RSVPS))
+          events = None
+          event_objs = resps['event_objs']
+          if not rsvps:
+            events = {}
+          elif int(event_objs.get('code', 0)) / 100 == 2:
+            events = self._as(dict, event_objs.get('body'))
+          else:  # fall back to fetching events separately
+            logging.warning("Couldn't fetch events in batch: %s", event_objs)
+          activities.extend(self._get_events(owner_id=event_owner_id,
+                                             rsvps=rsvps, events=events))
+
       else:
+        try:
+          resp = self.urlopen(url, headers=headers, _as=None)
+          etag = resp.info().get('ETag')
+          feed_body = json.loads(resp.read())
+          posts = self._as(list, feed_body)
+          next_cursor = self._paging_cursor(feed_body)
+        except urllib2.HTTPError, e:
+          if e.code == 304:  # Not Modified, from a matching ETag
+            posts = []
+          else:
+            raise
+
         # for group feeds, filter out some shared_story posts because they tend
         # to be very tangential - friends' likes, related posts, etc.
         #
@@ -344,9 +402,69 @@ class Facebook(source.Source):
 
     response = self.make_activities_base_response(util.trim_nulls(activities))
     response['etag'] = etag
+    if next_cursor:
+      response['nextCursor'] = next_cursor
     return response
 
-  def _merge_photos(self, posts):
+  @staticmethod
+  def _paging_cursor(resp):
+    """Returns a cursor for the page after a feed response, or None.
+
+    Args:
+      resp: parsed JSON feed response, with paging.next if there are more posts
+    """
+    if not isinstance(resp, dict):
+      return None
+
+    next = resp.get('paging', {}).get('next')
+    if next:
+      params = urlparse.parse_qs(urlparse.urlparse(next).query)
+      paging = {k: v[0] for k, v in params.items() if k in PAGING_PARAMS}
+      if paging:
+        return source.encode_cursor(paging)
+
+  def _get_self_batch(self, feed_url, feed_headers, fetch_news=False,
+                      fetch_events=False):
+    """Fetches the current user's feed, photos, etc. with the batch API.
+
+    https://github.com/snarfed/bridgy/issues/44
+
+    The user's events are looked up in the same batch as their RSVPs with a
+    JSONPath reference to the RSVPs' event ids, since the RSVPs don't include the
+    event descriptions.
+
+    Args:
+      feed_url: string, relative API URL for the user's feed
+      feed_headers: dict, HTTP headers for the feed request, e.g. If-None-Match
+      fetch_news: boolean, whether to fetch Open Graph news stories
+      fetch_events: boolean, whether to fetch the user's events
+
+    Returns: dict mapping request name ('feed', 'news', 'photos', 'albums',
+      'events', 'event_objs') to dict response in urlopen_batch_full()'s format
+    """
+    feed = {'name': 'feed', 'relative_url': feed_url}
+    if feed_headers:
+      feed['headers'] = feed_headers
+    requests = [feed]
+
+    if fetch_news:
+      requests.append({'name': 'news', 'relative_url': API_NEWS_PUBLISHES})
+
+    requests += [
+      {'name': 'photos', 'relative_url': API_PHOTOS_UPLOADED},
+      {'name': 'albums', 'relative_url': API_ALBUMS % 'me'},
+    ]
+
+    if fetch_events:
+      requests += [
+        {'name': 'events', 'relative_url': API_USER_RSVPS},
+        {'name': 'event_objs',
+         'relative_url': API_EVENTS % '{result=events:$.data.*.id}'},
+      ]
+
+    return self.urlopen_batch_named(requests)
+
+  def _merge_photos(self, posts, photos=None, albums=None):
     """Fetches and merges photo objects into posts, replacing matching posts.
 
     Have to fetch uploaded photos manually since facebook sometimes collapses
@@ -363,6 +481,10 @@ class Facebook(source.Source):
 
     Args:
       posts: list of Facebook post object dicts
+      photos: optional list of the user's uploaded Facebook photo object dicts.
+        Fetched if not provided.
+      albums: optional list of the user's Facebook album object dicts. Fetched
+        lazily, only if needed, if not provided.
 
     Returns: new list of post and photo object dicts
     """
@@ -376,9 +498,12 @@ class Facebook(source.Source):
                           obj_id, existing.get('id'), post.get('id'))
         posts_by_obj_id[obj_id] = post
 
-    albums = None  # lazy loaded, maps facebook id to ActivityStreams object
+    # lazy loaded if not provided, maps facebook id to album object
+    if albums is not None:
+      albums = {a['id']: a for a in albums}
 
-    photos = self.urlopen(API_PHOTOS_UPLOADED, _as=list)
+    if photos is None:
+      photos = self.urlopen(API_PHOTOS_UPLOADED, _as=list)
     for photo in photos:
       album_id = photo.get('album')
       post = posts_by_obj_id.pop(photo.get('id'), {})
@@ -403,41 +528,147 @@ class Facebook(source.Source):
 
     https://developers.facebook.com/docs/graph-api/using-graph-api#multiidlookup
 
+    If there's more than one chunk of ids, they're all sent in a single batch
+    API call, and their results are merged in chunk order. Raises
+    urllib2.HTTPError if any chunk fails.
+
     Args:
       api_call: string with %s placeholder for ids query param
       ids: sequence of string ids
 
     Returns: merged list of objects from the responses' 'data' fields
     """
+    urls = [api_call % ','.join(ids[i:i + MAX_IDS])
+            for i in range(0, len(ids), MAX_IDS)]
+    if len(urls) == 1:
+      resps = [self.urlopen(urls[0])]
+    else:
+      named = self.urlopen_batch_named(
+        [{'name': str(i), 'relative_url': url} for i, url in enumerate(urls)])
+      resps = [self._as(dict, self._batch_body(named.get(str(i), {}), url))
+               for i, url in enumerate(urls)]
+
     results = {}
-    for i in range(0, len(ids), MAX_IDS):
-      resp = self.urlopen(api_call % ','.join(ids[i:i + MAX_IDS]))
+    for resp in resps:
       for id, objs in resp.items():
         # objs is usually a dict but sometimes a boolean. (oh FB, never change!)
         results.setdefault(id, []).extend(self._as(dict, objs).get('data', []))
 
     return results
 
-  def _get_events(self, owner_id=None):
+  def _get_events(self, owner_id=None, rsvps=None, events=None):
     """Fetches the current user's events.
 
     https://developers.facebook.com/docs/graph-api/reference/user/events/
     https://developers.facebook.com/docs/graph-api/reference/event#edges
 
+    Events are filtered by owner before their RSVPs are fetched, so that we
+    never download big non-owned events' invite lists.
+
     TODO: also fetch and use API_USER_RSVPS_DECLINED
 
     Args:
       owner_id: string. if provided, only returns events owned by this user
+      rsvps: optional list of the user's Facebook RSVP objects, ie the
+        API_USER_RSVPS response. Fetched if not provided.
+      events: optional dict mapping event id to Facebook event object. Fetched
+        with multi-id lookups if not provided.
 
     Returns:
       list of ActivityStreams event objects
     """
-    rsvps = self.urlopen(API_USER_RSVPS, _as=list)
+    if rsvps is None:
+      rsvps = self.urlopen(API_USER_RSVPS, _as=list)
+    ids = [rsvp['id'] for rsvp in rsvps if rsvp.get('id')]
+
+    # have to re-fetch the event objects because the user rsvps response doesn't
+    # include the event description.
+    if events is None:
+      events = self._get_event_objs(ids)
+
+    owned = []
+    for id in ids:
+      event = self._owned_event(id, events.get(id), owner_id)
+      if event:
+        owned.append((id, event))
+    invited = self._get_event_rsvps([id for id, _ in owned])
+
+    return util.trim_nulls([self.event_to_activity(obj, rsvps=invited.get(id))
+                            for id, obj in owned])
 
-    # have to re-fetch the individual event objects because the user rsvps
-    # response doesn't include the event description.
-    return util.trim_nulls([self.get_event(rsvp['id'], owner_id=owner_id)
-                            for rsvp in rsvps if rsvp.get('id')])
+  def _get_event_objs(self, ids):
+    """Fetches multiple event objects with multi-id lookups.
+
+    https://developers.facebook.com/docs/graph-api/using-graph-api#multiidlookup
+
+    Multi-id lookups fail entirely if any single id is bad, so if one 4xxes,
+    falls back to fetching its events individually.
+
+    Args:
+      ids: sequence of string event ids
+
+    Returns: dict mapping event id to Facebook event object. Events that
+      couldn't be fetched are omitted.
+    """
+    events = {}
+    for i in range(0, len(ids), MAX_IDS):
+      chunk = ids[i:i + MAX_IDS]
+      try:
+        events.update(self.urlopen(API_EVENTS % ','.join(chunk)))
+      except urllib2.HTTPError, e:
+        if e.code / 100 != 4:
+          raise
+        logging.warning("Couldn't fetch events %s, fetching individually: %s",
+                        chunk, e)
+        for id in chunk:
+          with util.ignore_http_4xx_error():
+            events[id] = self.urlopen(API_EVENT % id)
+
+    return events
+
+  def _get_event_rsvps(self, event_ids):
+    """Fetches multiple events' RSVPs, ie invitees, with the batch API.
+
+    Follows paging, up to MAX_EVENT_RSVP_PAGES pages per event. All events' next
+    pages are fetched together in one batch.
+
+    Args:
+      event_ids: sequence of string event ids
+
+    Returns: dict mapping event id to list of Facebook RSVP objects. Events whose
+      RSVPs couldn't be fetched are omitted.
+    """
+    rsvps = {}
+    pending = [(id, API_EVENT_RSVPS % id) for id in event_ids]
+
+    for _ in range(MAX_EVENT_RSVP_PAGES):
+      if not pending:
+        break
+      resps = self.urlopen_batch_named([{'name': id, 'relative_url': url}
+                                        for id, url in pending])
+      next_pages = []
+      for id, url in pending:
+        body = None
+        with util.ignore_http_4xx_error():
+          body = self._batch_body(resps.get(id, {}), url)
+        if body is None:
+          logging.warning("Couldn't fetch RSVPs for event %s: %s", id,
+                          resps.get(id))
+          continue
+
+        rsvps.setdefault(id, []).extend(self._as(list, body))
+        paging = self._as(dict, body).get('paging', {})
+        after = paging.get('cursors', {}).get('after')
+        if paging.get('next') and after:
+          next_pages.append((id, util.add_query_params(API_EVENT_RSVPS % id,
+                                                       {'after': after})))
+      pending = next_pages
+
+    if pending:
+      logging.warning('Stopped fetching RSVPs after %d pages for events %s',
+                      MAX_EVENT_RSVP_PAGES, [id for id, _ in pending])
+
+    return rsvps
 
   def get_event(self, event_id, owner_id=None):
     """Returns a Facebook event post.
@@ -453,6 +684,28 @@ class Facebook(source.Source):
     with util.ignore_http_4xx_error():
       event = self.urlopen(API_EVENT % event_id)
 
+    event = self._owned_event(event_id, event, owner_id)
+    if not event:
+      return None
+
+    rsvps = None
+    with util.ignore_http_4xx_error():
+      rsvps = self.urlopen(API_EVENT_RSVPS % event_id, _as=list)
+
+    return self.event_to_activity(event, rsvps=rsvps)
+
+  def _owned_event(self, event_id, event, owner_id=None):
+    """Checks that an event was fetched and is owned by a given user.
+
+    Args:
+      event_id: string, site-specific event id
+      event: Facebook event object, or None if it couldn't be fetched
+      owner_id: string
+
+    Returns: dict Facebook event object, or None if the event is missing or is
+      owned by a different user than owner_id (if provided)
+    """
+    event = self._as(dict, event) if event else None
     if not event or event.get('error'):
       logging.warning("Couldn't fetch event %s: %s", event_id, event)
       return None
@@ -463,11 +716,7 @@ class Facebook(source.Source):
                    event.get('name') or event.get('id'), event_owner_id, owner_id)
       return None
 
-    rsvps = None
-    with util.ignore_http_4xx_error():
-      rsvps = self.urlopen(API_EVENT_RSVPS % event_id, _as=list)
-
-    return self.event_to_activity(event, rsvps=rsvps)
+    return event
 
   def get_comment(self, comment_id, activity_id=None, activity_author_id=None):
     """Returns an ActivityStreams comment object.
@@ -808,7 +1057,7 @@ class Facebook(source.Source):
                                  appengine_config.FACEBOOK_APP_SECRET),
       }
     url = API_BASE + API_NOTIFICATION % user_id
-    resp = util.urlopen(urllib2.Request(url, data=urllib.urlencode(params)))
+    resp = self._urlopen(urllib2.Request(url, data=urllib.urlencode(params)))
     logging.debug('Response: %s %s', resp.getcode(), resp.read())
 
   def post_url(self, post):
@@ -1021,8 +1270,8 @@ class Facebook(source.Source):
       'id': self.tag_uri(id.post),
       'fb_id': fb_id,
       'objectType': object_type,
-      'published': util.maybe_iso8601_to_rfc3339(post.get('created_time')),
-      'updated': util.maybe_iso8601_to_rfc3339(post.get('updated_time')),
+      'published': times.iso8601_to_rfc3339(post.get('created_time')),
+      'updated': times.iso8601_to_rfc3339(post.get('updated_time')),
       'author': author,
       # FB post ids are of the form USERID_POSTID
       'url': url,
@@ -1225,6 +1474,7 @@ class Facebook(source.Source):
 
     return self.postprocess_object(obj)
 
+  @source.memoized_actor
   def user_to_actor(self, user):
     """Converts a user or page to an actor.
 
@@ -1250,7 +1500,7 @@ class Facebook(source.Source):
       'objectType': 'page' if user.get('type') == 'page' else 'person',
       'displayName': user.get('name') or username,
       'id': self.tag_uri(handle),
-      'updated': util.maybe_iso8601_to_rfc3339(user.get('updated_time')),
+      'updated': times.iso8601_to_rfc3339(user.get('updated_time')),
       'username': username,
       'description': user.get('bio') or user.get('description'),
       'summary': user.get('about'),
@@ -1381,8 +1631,8 @@ class Facebook(source.Source):
       'displayName': album.get('name'),
       'totalItems': album.get('count'),
       'to': self.privacy_to_to(album),
-      'published': util.maybe_iso8601_to_rfc3339(album.get('created_time')),
-      'updated': util.maybe_iso8601_to_rfc3339(album.get('updated_time')),
+      'published': times.iso8601_to_rfc3339(album.get('created_time')),
+      'updated': times.iso8601_to_rfc3339(album.get('updated_time')),
     })
 
   @staticmethod
@@ -1621,7 +1871,7 @@ SELECT id, name, username, url, pic FROM profile WHERE id IN
     log_url = url
     if self.access_token:
       url = util.add_query_params(url, [('access_token', self.access_token)])
-    resp = util.urlopen(urllib2.Request(url, **kwargs))
+    resp = self._urlopen(urllib2.Request(url, **kwargs))
 
     if _as is None:
       return resp
@@ -1676,16 +1926,77 @@ SELECT id, name, username, url, pic FROM profile WHERE id IN
 
     """
     resps = self.urlopen_batch_full([{'relative_url': url} for url in urls])
+    return [self._batch_body(resp, url) for url, resp in zip(urls, resps)]
 
-    bodies = []
-    for url, resp in zip(urls, resps):
-      code = int(resp.get('code', 0))
-      body = resp.get('body')
-      if code / 100 in (4, 5):
-        raise urllib2.HTTPError(url, code, body, resp.get('headers'), None)
-      bodies.append(body)
+  @staticmethod
+  def _batch_body(resp, url):
+    """Returns a single batch API response's body.
+
+    Raises the appropriate urllib2.HTTPError if the response's HTTP status code
+    is 4xx or 5xx.
+
+    Args:
+      resp: dict response in urlopen_batch_full()'s format
+      url: string relative API URL, used in the HTTPError
+    """
+    code = int(resp.get('code', 0))
+    body = resp.get('body')
+    if code / 100 in (4, 5):
+      raise urllib2.HTTPError(url, code, body, resp.get('headers'), None)
+    return body
 
-    return bodies
+  def urlopen_batch_named(self, requests):
+    """Sends named API calls in as few batch API calls as possible.
+
+    Requests that reference another request's results with a JSONPath
+    expression, e.g. '?ids={result=events:$.data.*.id}', are sent in the same
+    batch as the request they reference, and referenced requests always include
+    their responses.
+
+    https://developers.facebook.com/docs/graph-api/making-multiple-requests#operations
+
+    Args:
+      requests: sequence of dict requests in urlopen_batch_full()'s format, each
+        with a unique 'name' field. Requests must come after the requests they
+        reference.
+
+    Returns: dict mapping name to dict response in urlopen_batch_full()'s format
+    """
+    referenced = set()
+    for req in requests:
+      referenced.update(BATCH_REFERENCE_RE.findall(req['relative_url']))
+
+    # group requests with the requests they reference
+    groups = []
+    for req in requests:
+      req = copy.copy(req)
+      if req['name'] in referenced:
+        req['omit_response_on_success'] = False
+      parents = set(BATCH_REFERENCE_RE.findall(req['relative_url']))
+      group = []
+      for existing in [g for g in groups
+                       if parents & set(r['name'] for r in g)]:
+        groups.remove(existing)
+        group.extend(existing)
+      group.append(req)
+      groups.append(group)
+
+    # pack the groups into as few batches as possible
+    batches = [[]]
+    for group in groups:
+      assert len(group) <= MAX_BATCH_SIZE, \
+        'Too many dependent requests for one batch: %s' % group
+      if len(batches[-1]) + len(group) > MAX_BATCH_SIZE:
+        batches.append([])
+      batches[-1].extend(group)
+
+    resps = {}
+    for batch in batches:
+      if batch:
+        for req, resp in zip(batch, self.urlopen_batch_full(batch)):
+          resps[req['name']] = resp or {}
+
+    return resps
 
   def urlopen_batch_full(self, requests):
     """Sends a batch of multiple API calls using Facebook's batch API.
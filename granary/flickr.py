@@ -3,16 +3,15 @@
 
 Uses Flickr's REST API https://www.flickr.com/services/api/
 
-TODO: Fetching feeds with comments and/or favorites is very request
-intensive right now. It would be ideal to find a way to batch
-requests, make requests asynchronously, or make better calls to the
-API itself. Maybe use flickr.activity.userPhotos
-(https://www.flickr.com/services/api/flickr.activity.userPhotos.html)
-when group_id=SELF.
+Fetching feeds with comments and/or favorites is request intensive. For
+group_id=SELF, we use flickr.activity.userPhotos to get recent comments and
+faves in a single call. Otherwise, we fetch each photo's comments and faves in
+parallel, skipping photos whose counts haven't changed since the last call.
 """
 
 __author__ = ['Kyle Mahan <kyle@kylewm.com>']
 
+import collections
 import copy
 import datetime
 import functools
@@ -21,6 +20,7 @@ import json
 import logging
 import requests
 import source
+import times
 import sys
 import mf2py
 import mf2util
@@ -34,6 +34,22 @@ from oauth_dropins import flickr_auth
 from apiclient.errors import HttpError
 from apiclient.http import BatchHttpRequest
 
+# max number of concurrent comment and favorite API calls
+MAX_WORKERS = source.MAX_WORKERS
+# how far back flickr.activity.userPhotos looks for comments and faves, and how
+# many pages of its results to follow
+# https://www.flickr.com/services/api/flickr.activity.userPhotos.html
+USER_PHOTOS_TIMEFRAME = '30d'
+USER_PHOTOS_MAX_PAGES = 10
+
+# user_to_actor() caches actors by nsid, since fetching and parsing profile
+# pages for rel=me links is expensive. Shared by all Flickr instances that
+# don't pass their own actor_cache.
+ACTOR_CACHE_SIZE = 1000
+ACTOR_CACHE_TTL = 60 * 60 * 24  # 1d
+ACTOR_CACHE_NEGATIVE_TTL = 60 * 30  # 30m, when the profile page fetch fails
+ACTOR_CACHE = source.LRUCache(ACTOR_CACHE_SIZE, ACTOR_CACHE_TTL)
+
 
 class Flickr(source.Source):
 
@@ -43,10 +59,11 @@ class Flickr(source.Source):
 
   API_EXTRAS = ','.join(('date_upload', 'date_taken', 'views', 'media',
                          'description', 'tags', 'machine_tags', 'geo',
-                         'path_alias'))
+                         'path_alias', 'count_comments', 'count_faves'))
 
   def __init__(self, access_token_key, access_token_secret,
-               user_id=None, path_alias=None):
+               user_id=None, path_alias=None, actor_cache=None,
+               scrape_profiles=True):
     """Constructor.
 
     If they are not provided, user_id and path_alias will be looked up via the
@@ -58,11 +75,18 @@ class Flickr(source.Source):
       user_id: string, the logged in user's Flickr nsid. (optional)
       path_alias: string, the logged in user's path_alias, replaces user_id in
         canonical profile and photo urls (optional)
+      actor_cache: object with get() and set_multi(), e.g.
+        source.LRUCache or memcache, for caching actors by nsid. (optional,
+        defaults to ACTOR_CACHE)
+      scrape_profiles: boolean, whether user_to_actor() should fetch users'
+        profile pages to find their rel=me links. (optional)
     """
     self.access_token_key = access_token_key
     self.access_token_secret = access_token_secret
     self._user_id = user_id
     self._path_alias = path_alias
+    self.actor_cache = ACTOR_CACHE if actor_cache is None else actor_cache
+    self.scrape_profiles = scrape_profiles
 
   def call_api_method(self, method, params={}):
     """Call a Flickr API method.
@@ -306,10 +330,12 @@ class Flickr(source.Source):
                               etag=None, min_id=None, cache=None,
                               fetch_replies=False, fetch_likes=False,
                               fetch_shares=False, fetch_events=False,
-                              fetch_mentions=False, search_query=None, **kwargs):
+                              fetch_mentions=False, search_query=None,
+                              cursor=None, **kwargs):
     """Fetches Flickr photos and converts them to ActivityStreams activities.
 
-    See method docstring in source.py for details.
+    See method docstring in source.py for details. Cursors wrap the API's page
+    number.
 
     Mentions are not fetched or included because they don't exist in Flickr.
     https://github.com/snarfed/bridgy/issues/523#issuecomment-155523875
@@ -328,6 +354,8 @@ class Flickr(source.Source):
     else:
       params['extras'] = self.API_EXTRAS
       params['per_page'] = 50
+      if cursor:
+        params['page'] = source.decode_cursor(cursor).get('page', 1)
       if group_id == source.SELF:
         params['user_id'] = user_id
         method = 'flickr.people.getPhotos'
@@ -345,37 +373,207 @@ class Flickr(source.Source):
     if activity_id:
       photos = [photos_resp.get('photo', {})]
     else:
-      photos = photos_resp.get('photos', {}).get('photo', [])
+      photos_obj = photos_resp.get('photos', {})
+      photos = photos_obj.get('photo', [])
+      try:
+        page = int(photos_obj.get('page') or 0)
+        if page and page < int(photos_obj.get('pages') or 0):
+          result['nextCursor'] = source.encode_cursor({'page': page + 1})
+      except (TypeError, ValueError):
+        logging.warning('Bad paging in Flickr response: %s', photos_obj)
+
+    activities = [self.photo_to_activity(photo) for photo in photos]
+
+    # flickr.activity.userPhotos only works for the current user
+    if (group_id == source.SELF and not activity_id and
+        user_id in ('me', self._user_id)):
+      if fetch_replies or fetch_likes:
+        self._add_user_photos_activity(photos, activities, cache,
+                                       fetch_replies, fetch_likes)
+    elif fetch_replies or fetch_likes:
+      self._add_comments_and_faves(photos, activities, cache, fetch_replies,
+                                   fetch_likes)
+
+    result['items'] = activities
+    return util.trim_nulls(result)
+
+  def _add_comments_and_faves(self, photos, activities, cache, fetch_replies,
+                              fetch_likes):
+    """Fetches photos' comments and faves in parallel and adds them to activities.
 
-    for photo in photos:
-      activity = self.photo_to_activity(photo)
+    Skips photos whose comment or fave counts are zero or match the counts in
+    the cache from the last call, if the counts are known.
 
-      # TODO consider using 'flickr.activity.userPhotos' when group_id=@self,
-      # gives all recent comments and faves, instead of hitting the API for
-      # each photo
+    Args:
+      photos: sequence of Flickr photo dicts
+      activities: sequence of corresponding ActivityStreams activity dicts
+      cache: object with get_multi() and set_multi(), or None
+      fetch_replies: boolean
+      fetch_likes: boolean
+    """
+    # batch get cached counts of comments and faves for all photos
+    cached = {}
+    if cache is not None:
+      keys = itertools.product(('AFR', 'AFL'), [p.get('id') for p in photos])
+      cached = cache.get_multi('%s %s' % (prefix, id) for prefix, id in keys)
+    # only update the cache at the end, in case we hit an error before then
+    cache_updates = {}
+
+    calls = []  # (API method, cache key, count, photo, activity) tuples
+    for photo, activity in zip(photos, activities):
+      id = photo.get('id')
+      counts = []
       if fetch_replies:
-        replies = []
-        comments_resp = self.call_api_method('flickr.photos.comments.getList', {
-          'photo_id': photo.get('id'),
-        })
-        for comment in comments_resp.get('comments', {}).get('comment', []):
-          replies.append(self.comment_to_object(comment, photo.get('id')))
+        # flickr.photos.getInfo returns the count in comments, the other
+        # methods in the count_comments extra
+        num_comments = photo.get('count_comments')
+        if num_comments is None and isinstance(photo.get('comments'), dict):
+          num_comments = photo['comments'].get('_content')
+        counts.append(('flickr.photos.comments.getList', 'AFR ' + id,
+                       num_comments))
+      if fetch_likes:
+        counts.append(('flickr.photos.getFavorites', 'AFL ' + id,
+                       photo.get('count_faves')))
+
+      for method, cache_key, count in counts:
+        if count is not None:
+          count = int(count)
+          if not count and method == 'flickr.photos.comments.getList':
+            activity['object']['replies'] = {'items': [], 'totalItems': 0}
+          if not count or count == cached.get(cache_key):
+            continue
+        calls.append((method, cache_key, count, photo, activity))
+
+    def fetch(call):
+      method, _, _, photo, _ = call
+      return self.call_api_method(method, {'photo_id': photo.get('id')})
+
+    resps = source.run_concurrently(fetch, calls, max_workers=MAX_WORKERS)
+
+    for (method, cache_key, count, photo, activity), resp in zip(calls, resps):
+      if method == 'flickr.photos.comments.getList':
+        replies = [self.comment_to_object(comment, photo.get('id'))
+                   for comment in resp.get('comments', {}).get('comment', [])]
         activity['object']['replies'] = {
           'items': replies,
           'totalItems': len(replies),
         }
-
-      if fetch_likes:
-        faves_resp = self.call_api_method('flickr.photos.getFavorites', {
-          'photo_id': photo.get('id'),
-        })
-        for person in faves_resp.get('photo', {}).get('person', []):
+      else:
+        for person in resp.get('photo', {}).get('person', []):
           activity['object'].setdefault('tags', []).append(
             self.like_to_object(person, activity))
 
-      result['items'].append(activity)
+      if count is not None:
+        cache_updates[cache_key] = count
 
-    return util.trim_nulls(result)
+    if cache_updates and cache is not None:
+      cache.set_multi(cache_updates)
+
+  def _add_user_photos_activity(self, photos, activities, cache,
+                                fetch_replies, fetch_likes):
+    """Fetches recent comments and faves on the user's photos in one call.
+
+    Uses flickr.activity.userPhotos, following its paging for up to
+    USER_PHOTOS_MAX_PAGES pages. It only returns activity from the last
+    USER_PHOTOS_TIMEFRAME, so photos whose count_comments or count_faves don't
+    match the events it returns, e.g. because they have older comments, fall
+    back to _add_comments_and_faves().
+    https://www.flickr.com/services/api/flickr.activity.userPhotos.html
+
+    Args:
+      photos: sequence of the current user's Flickr photo dicts
+      activities: sequence of corresponding ActivityStreams activity dicts
+      cache: object with get_multi() and set_multi(), or None
+      fetch_replies: boolean
+      fetch_likes: boolean
+    """
+    # maps photo id to event type ('comment' or 'fave') to list of events
+    events = collections.defaultdict(lambda: collections.defaultdict(list))
+    page = pages = 1
+    while page <= min(pages, USER_PHOTOS_MAX_PAGES):
+      params = {
+        'timeframe': USER_PHOTOS_TIMEFRAME,
+        'per_page': 50,
+      }
+      if page > 1:
+        params['page'] = page
+      items = self.call_api_method('flickr.activity.userPhotos', params
+                                   ).get('items', {})
+      for item in items.get('item', []):
+        for event in item.get('activity', {}).get('event', []):
+          events[item.get('id')][event.get('type')].append(event)
+      pages = int(items.get('pages') or 1)
+      page += 1
+
+    cache_updates = {}
+    # maps (fetch_replies, fetch_likes) to list of (photo, activity) tuples
+    fallbacks = collections.defaultdict(list)
+
+    for photo, activity in zip(photos, activities):
+      photo_id = photo.get('id')
+      comments = events[photo_id]['comment'] if fetch_replies else []
+      faves = events[photo_id]['fave'] if fetch_likes else []
+      comments_complete = self._count_matches(photo.get('count_comments'),
+                                              comments)
+      faves_complete = self._count_matches(photo.get('count_faves'), faves)
+
+      if fetch_replies and comments_complete:
+        replies = [self.comment_to_object({
+          'id': event.get('commentid'),
+          'author': event.get('user'),
+          'authorname': event.get('username'),
+          'realname': event.get('realname'),
+          'iconserver': event.get('iconserver'),
+          'iconfarm': event.get('iconfarm'),
+          'datecreate': event.get('dateadded'),
+          'permalink': '%s#comment%s' % (activity.get('url'),
+                                         event.get('commentid')),
+          '_content': event.get('_content'),
+        }, photo_id) for event in comments]
+        activity['object']['replies'] = {
+          'items': replies,
+          'totalItems': len(replies),
+        }
+        cache_updates['AFR ' + photo_id] = len(replies)
+
+      if fetch_likes and faves_complete:
+        for event in faves:
+          activity['object'].setdefault('tags', []).append(
+            self.like_to_object({
+              'nsid': event.get('user'),
+              'username': event.get('username'),
+              'realname': event.get('realname'),
+              'iconserver': event.get('iconserver'),
+              'iconfarm': event.get('iconfarm'),
+            }, activity))
+        cache_updates['AFL ' + photo_id] = len(faves)
+
+      fallback = (fetch_replies and not comments_complete,
+                  fetch_likes and not faves_complete)
+      if any(fallback):
+        fallbacks[fallback].append((photo, activity))
+
+    for (replies, likes), pairs in fallbacks.items():
+      fallback_photos, fallback_activities = zip(*pairs)
+      self._add_comments_and_faves(fallback_photos, fallback_activities, cache,
+                                   replies, likes)
+
+    if cache_updates and cache is not None:
+      cache.set_multi(cache_updates)
+
+  @staticmethod
+  def _count_matches(count, events):
+    """Returns True if a photo's comment or fave count matches its events.
+
+    Args:
+      count: string or integer count_comments or count_faves extra, or None if
+        unknown
+      events: list of flickr.activity.userPhotos events
+    """
+    try:
+      return count is not None and int(count) == len(events)
+    except ValueError:
+      return False
 
   def get_actor(self, user_id=None):
     """Get an ActivityStreams object of type 'person' given a Flickr user's nsid.
@@ -395,8 +593,19 @@ class Flickr(source.Source):
 
   def user_to_actor(self, resp):
     """Convert a Flickr user dict into an ActivityStreams actor.
+
+    Unless scrape_profiles is False, also fetches the user's profile page to
+    find their rel=me URLs. Actors with scraped profiles are cached by nsid in
+    actor_cache.
     """
     person = resp.get('person', {})
+    nsid = person.get('nsid')
+    cache_key = 'AFA %s' % nsid
+    if self.scrape_profiles and nsid:
+      cached = self.actor_cache.get(cache_key)
+      if cached is not None:
+        return copy.deepcopy(cached)
+
     username = person.get('username', {}).get('_content')
     obj = util.trim_nulls({
       'objectType': 'person',
@@ -417,11 +626,15 @@ class Flickr(source.Source):
       'description': person.get('description', {}).get('_content'),
     })
 
+    if not self.scrape_profiles:
+      return self.postprocess_object(obj)
+
     # fetch profile page to get url(s)
     profile_url = person.get('profileurl', {}).get('_content')
+    failed = False
     if profile_url:
       try:
-        resp = util.urlopen(profile_url)
+        resp = self._urlopen(profile_url)
         profile_json = mf2py.parse(doc=resp, url=profile_url)
         # personal site is likely the first non-flickr url
         urls = profile_json.get('rels', {}).get('me', [])
@@ -431,8 +644,15 @@ class Flickr(source.Source):
           None)
       except urllib2.URLError, e:
         logging.warning('could not fetch user homepage %s', profile_url)
-
-    return self.postprocess_object(obj)
+        failed = True
+
+    obj = self.postprocess_object(obj)
+    if nsid:
+      # cache failures for less time
+      self.actor_cache.set_multi(
+        {cache_key: copy.deepcopy(obj)},
+        time=ACTOR_CACHE_NEGATIVE_TTL if failed else ACTOR_CACHE_TTL)
+    return obj
 
   def get_comment(self, comment_id, activity_id, activity_author_id=None):
     """Returns an ActivityStreams comment object.
@@ -473,7 +693,7 @@ class Flickr(source.Source):
       path_alias = photo.get('pathalias')
 
     created = photo.get('dates', {}).get('taken') or photo.get('datetaken')
-    published = util.maybe_timestamp_to_rfc3339(
+    published = times.timestamp_to_rfc3339(
       photo.get('dates', {}).get('posted') or photo.get('dateupload'))
 
     # TODO replace owner_id with path_alias?
@@ -581,7 +801,7 @@ class Flickr(source.Source):
                                      person.get('nsid')),
         },
       },
-      'created': util.maybe_timestamp_to_rfc3339(photo_activity.get('favedate')),
+      'created': times.timestamp_to_rfc3339(photo_activity.get('favedate')),
       'url': u'{}#liked-by-{}'.format(
         photo_activity.get('url'), person.get('nsid')),
       'object': {'url': photo_activity.get('url')},
@@ -607,8 +827,8 @@ class Flickr(source.Source):
       'id': self.tag_uri(comment.get('id')),
       'inReplyTo': [{'id': self.tag_uri(photo_id)}],
       'content': comment.get('_content', ''),
-      'published': util.maybe_timestamp_to_rfc3339(comment.get('datecreate')),
-      'updated': util.maybe_timestamp_to_rfc3339(comment.get('datecreate')),
+      'published': times.timestamp_to_rfc3339(comment.get('datecreate')),
+      'updated': times.timestamp_to_rfc3339(comment.get('datecreate')),
       'author': {
         'objectType': 'person',
         'displayName': comment.get('realname') or comment.get('authorname'),
@@ -7,14 +7,13 @@ https://developers.google.com/+/api/latest/activities/list#collection
 
 __author__ = ['Ryan Barrett <granary@ryanb.org>']
 
-import datetime
 import functools
 import itertools
 import json
-import re
 
 import appengine_config
 import source
+import times
 
 from apiclient.errors import HttpError
 from apiclient.http import BatchHttpRequest
@@ -79,10 +78,12 @@ class GooglePlus(source.Source):
                               etag=None, min_id=None, cache=None,
                               fetch_replies=False, fetch_likes=False,
                               fetch_shares=False, fetch_events=False,
-                              fetch_mentions=False, search_query=None, **kwargs):
+                              fetch_mentions=False, search_query=None,
+                              cursor=None, **kwargs):
     """Fetches posts and converts them to ActivityStreams activities.
 
     See method docstring in source.py for details. app_id is ignored.
+    Cursors wrap the API's pageToken and nextPageToken.
 
     Replies (comments), likes (+1s), and shares (reshares) each need an extra
     API call per activity. The activity has total counts for them, though, so we
@@ -102,6 +103,9 @@ class GooglePlus(source.Source):
     if user_id is None:
       user_id = 'me'
 
+    page_token = source.decode_cursor(cursor).get('pageToken') if cursor else None
+    next_page_token = None
+
     http = self.auth_entity.http()
     if etag:
       # monkey patch the ETag header in because google-api-python-client doesn't
@@ -120,14 +124,19 @@ class GooglePlus(source.Source):
         activities = [call.execute(http)]
       elif search_query:
         call = self.auth_entity.api().activities().search(
-          query=search_query, maxResults=min(count, SEARCH_MAX_RESULTS))
-        activities = call.execute(http).get('items', [])
+          query=search_query, maxResults=min(count, SEARCH_MAX_RESULTS),
+          pageToken=page_token)
+        resp = call.execute(http)
+        activities = resp.get('items', [])
+        next_page_token = resp.get('nextPageToken')
       else:
         call = self.auth_entity.api().activities().list(
-          userId=user_id, collection='public', maxResults=count)
+          userId=user_id, collection='public', maxResults=count,
+          pageToken=page_token)
         resp = call.execute(http)
         activities = resp.get('items', [])
         etag = resp.get('etag')
+        next_page_token = resp.get('nextPageToken')
     except HttpError, e:
       if e.resp.status == 304:  # Not Modified, from a matching ETag
         activities = []
@@ -184,6 +193,8 @@ class GooglePlus(source.Source):
 
     response = self.make_activities_base_response(activities)
     response['etag'] = etag
+    if next_page_token:
+      response['nextCursor'] = source.encode_cursor({'pageToken': next_page_token})
     if cache_updates and cache is not None:
       cache.set_multi(cache_updates)
     return response
@@ -311,21 +322,15 @@ class GooglePlus(source.Source):
     Returns:
       list of ActivityStreams activity dicts
     """
-    # extract JSON data blob
-    script_start = "<script>AF_initDataCallback({key: '161', isError:  false , hash: '14', data:"
-    start = html.find(script_start)
-    end = html.find('});</script>', start)
-    if start == -1 or end == -1:
+    # extract JSON data blob. it omits values in arrays, e.g. [,,,"x",,,], so
+    # insert placeholder nulls so that we can decode it as JSON.
+    data = source.extract_json(
+      html, "<script>AF_initDataCallback({key: '161', isError:  false , hash: '14', data:",
+      suffix='});</script>', sparse=True)
+    if data is None:
       return []
-    start += len(script_start)
-    html = html[start:end]
-
-    # insert placeholder nulls for omitted values, e.g. [,,,"x",,,] so that we
-    # can decode it as JSON. run twice to handle overlaps.
-    for i in range(2):
-      html = re.sub(r'([,[])\s*([],])', r'\1null\2', html)
 
-    data = json.loads(html)[1][7][1:]
+    data = data[1][7][1:]
     data = [d[6].values()[0] for d in data if len(d) >= 7 and d[6]]
 
     activities = []
@@ -333,7 +338,7 @@ class GooglePlus(source.Source):
       id = self.tag_uri(d[8])
       url = 'https://%s/%s' % (self.DOMAIN, d[21])  # d[132] is full url
       # posix timestamp in ms
-      published = datetime.datetime.utcfromtimestamp(d[5] / 1000).isoformat('T') + 'Z'
+      published = times.ms_timestamp_to_iso8601(d[5])
 
       if d[69] and len(d[69]) >= 2 and d[69][1] and d[69][1][0]:
         # this is a like, reshare, etc
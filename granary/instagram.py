@@ -24,6 +24,7 @@ import appengine_config
 from oauth_dropins.webutil import util
 import requests
 import source
+import times
 
 # Maps Instagram media type to ActivityStreams objectType.
 OBJECT_TYPES = {'image': 'photo', 'video': 'video'}
@@ -40,12 +41,18 @@ API_MEDIA_LIKES_URL = 'https://api.instagram.com/v1/media/%s/likes'
 API_COMMENT_URL = 'https://api.instagram.com/v1/media/%s/comments'
 
 HTML_MEDIA = 'https://www.instagram.com/p/%s/'
+# precedes the JSON data blob in instagram.com HTML pages
+HTML_DATA_PREFIX = '<script type="text/javascript">window._sharedData = '
 
 # URL-safe base64 encoding. used in Instagram.id_to_shortcode()
 BASE64 = string.ascii_uppercase + string.ascii_lowercase + string.digits + '-_'
 
 MENTION_RE = re.compile(r'@([A-Za-z0-9._]+)')
 
+# max number of post pages that _scrape() fetches in parallel. it also makes at
+# most source.MAX_REQUESTS_PER_DOMAIN concurrent requests to any single host.
+MAX_WORKERS = source.MAX_WORKERS
+
 
 class Instagram(source.Source):
   """Implements the ActivityStreams API for Instagram."""
@@ -87,13 +94,19 @@ class Instagram(source.Source):
     if self.access_token:
       # TODO add access_token to the data parameter for POST requests
       url = util.add_query_params(url, [('access_token', self.access_token)])
-    resp = util.urlopen(urllib2.Request(url, **kwargs))
+    resp = self._urlopen(urllib2.Request(url, **kwargs))
     return resp if kwargs.get('data') else json.loads(resp.read()).get('data')
 
   @classmethod
   def user_url(cls, username):
     return '%s%s/' % (cls.BASE_URL, username)
 
+  @classmethod
+  def min_id_key(cls, silo_id):
+    """Media ids are MEDIA_USER, e.g. 123_456. Compares the MEDIA part."""
+    media = silo_id.split('_')[0]
+    return int(media) if media.isdigit() else None
+
   def get_actor(self, user_id=None):
     """Returns a user as a JSON ActivityStreams actor dict.
 
@@ -113,6 +126,7 @@ class Instagram(source.Source):
       return self.user_to_actor(util.trim_nulls(
         self.urlopen(API_USER_URL % user_id) or {}))
 
+  @source.with_actor_memo
   def get_activities_response(self, user_id=None, group_id=None, app_id=None,
                               activity_id=None, start_index=0, count=0,
                               etag=None, min_id=None, cache=None,
@@ -242,7 +256,7 @@ class Instagram(source.Source):
     kwargs = {}
     if cookie:
       kwargs = {'headers': {'Cookie': cookie}}
-    resp = util.requests_get(url, allow_redirects=False, **kwargs)
+    resp = self._requests_get(url, allow_redirects=False, **kwargs)
     if ((cookie and 'not-logged-in' in resp.text) or
         (resp.status_code in ('301', '302') and
          '/accounts/login' in resp.headers.get('Location', ''))):
@@ -252,7 +266,8 @@ class Instagram(source.Source):
     activities, actor = self.html_to_activities(resp.text)
 
     if fetch_extras and not activity_id:
-      # batch get cached counts of comments and likes for all activities
+      # batch get cached counts of comments and likes for all activities, and
+      # cached post pages
       cached = {}
       # don't update the cache until the end, in case we hit an error before
       cache_updates = {}
@@ -260,9 +275,11 @@ class Instagram(source.Source):
         keys = []
         for activity in activities:
           _, id = util.parse_tag_uri(activity['id'])
-          keys.extend(['AIL ' + id, 'AIC ' + id])
+          keys.extend(['AIL ' + id, 'AIC ' + id,
+                       'AIP ' + self._shortcode(activity['url'])])
         cached = cache.get_multi(keys)
 
+      to_fetch = []  # (index, url, cache updates) tuples
       for i, activity in enumerate(activities):
         obj = activity['object']
         _, id = util.parse_tag_uri(activity['id'])
@@ -273,11 +290,23 @@ class Instagram(source.Source):
 
         if (likes and likes != cached.get(likes_key) or
             comments and comments != cached.get(comments_key)):
-          full_activity, _ = self.html_to_activities(
-            util.requests_get(activity['url']).text)
-          if full_activity:
-            activities[i] = full_activity[0]
-            cache_updates.update({likes_key: likes, comments_key: comments})
+          to_fetch.append((i, activity['url'],
+                           {likes_key: likes, comments_key: comments}))
+
+      def fetch(item):
+        _, url, _ = item
+        return self._scrape_media_page(
+          url, cached.get('AIP ' + self._shortcode(url)))
+
+      # be polite: limit concurrent requests to any single host
+      fetched = source.run_concurrently(fetch, to_fetch, max_workers=MAX_WORKERS,
+                                        per_domain=lambda item: item[1])
+      for (i, url, updates), (full_activity, page) in zip(to_fetch, fetched):
+        if full_activity:
+          activities[i] = full_activity
+          cache_updates.update(updates)
+        if page:
+          cache_updates['AIP ' + self._shortcode(url)] = page
 
       if cache_updates and cache is not None:
         cache.set_multi(cache_updates)
@@ -286,6 +315,50 @@ class Instagram(source.Source):
     resp['actor'] = actor
     return resp
 
+  def _scrape_media_page(self, url, cached_page=None):
+    """Fetches and converts a single post's HTML page.
+
+    If cached_page has an ETag or Last-Modified validator, makes a conditional
+    request, and returns the cached activity if the page hasn't changed.
+
+    Args:
+      url: string, post URL
+      cached_page: dict with 'activity' and 'etag' and/or 'last_modified'
+        fields, from a previous call's returned page, or None
+
+    Returns: (activity dict or None, page dict or None) tuple. page is a new
+      value to cache for this post, or None if the page has no validators or
+      hasn't changed.
+    """
+    headers = {}
+    if cached_page:
+      if cached_page.get('etag'):
+        headers['If-None-Match'] = cached_page['etag']
+      if cached_page.get('last_modified'):
+        headers['If-Modified-Since'] = cached_page['last_modified']
+
+    kwargs = {'headers': headers} if headers else {}
+    resp = self._requests_get(url, **kwargs)
+    if cached_page and resp.status_code == 304:
+      return cached_page['activity'], None
+
+    activities, _ = self.html_to_activities(resp.text)
+    if not activities:
+      return None, None
+
+    page = util.trim_nulls({
+      'etag': resp.headers.get('ETag'),
+      'last_modified': resp.headers.get('Last-Modified'),
+    })
+    if page:
+      page['activity'] = activities[0]
+    return activities[0], page or None
+
+  @staticmethod
+  def _shortcode(url):
+    """Returns the shortcode in a post URL, e.g. ABC123 in .../p/ABC123/."""
+    return url.rstrip('/').split('/')[-1]
+
   def get_comment(self, comment_id, activity_id=None, activity_author_id=None):
     """Returns an ActivityStreams comment object.
 
@@ -472,7 +545,7 @@ class Instagram(source.Source):
       # TODO: detect videos. (the type field is in the JSON respose but not
       # propagated into the Media object.)
       'objectType': OBJECT_TYPES.get(media.get('type', 'image'), 'photo'),
-      'published': util.maybe_timestamp_to_rfc3339(media.get('created_time')),
+      'published': times.timestamp_to_rfc3339(media.get('created_time')),
       'author': self.user_to_actor(user),
       'content': content,
       'url': media.get('link'),
@@ -568,7 +641,7 @@ class Instagram(source.Source):
       'inReplyTo': [{'id': self.tag_uri(media_id)}],
       'url': '%s#comment-%s' % (media_url, comment.get('id')) if media_url else None,
       # TODO: add PST time zone
-      'published': util.maybe_timestamp_to_rfc3339(comment.get('created_time')),
+      'published': times.timestamp_to_rfc3339(comment.get('created_time')),
       'content': comment.get('text'),
       'author': self.user_to_actor(comment.get('from')),
       'to': [{'objectType': 'group', 'alias': '@public'}],
@@ -594,6 +667,7 @@ class Instagram(source.Source):
         'author': self.user_to_actor(liker),
     })
 
+  @source.memoized_actor
   def user_to_actor(self, user):
     """Converts a user to an actor.
 
@@ -686,15 +760,10 @@ class Instagram(source.Source):
       ([ActivityStreams activities], ActivityStreams viewer actor)
     """
     # extract JSON data blob
-    script_start = '<script type="text/javascript">window._sharedData = '
-    start = html.find(script_start)
-    if start == -1:
+    data = source.extract_json(html, HTML_DATA_PREFIX)
+    if data is None:
       return [], None
 
-    start += len(script_start)
-    end = html.index(';</script>', start)
-    data = json.loads(html[start:end])
-
     entry_data = data.get('entry_data', {})
     activities = []
 
@@ -47,6 +47,32 @@ HCARD = string.Template("""\
 IN_REPLY_TO = string.Template('  <a class="u-in-reply-to" href="$url"></a>')
 
 
+def _compile_template(template):
+  """Splits a string.Template into its literal text and placeholders.
+
+  Args:
+    template: string.Template with only $name or ${name} placeholders
+
+  Returns: list of strings, alternating literal text and placeholder names,
+    starting and ending with literal text
+  """
+  fragments = []
+  start = 0
+  for match in template.pattern.finditer(template.template):
+    name = match.group('named') or match.group('braced')
+    assert name, 'Unsupported placeholder %r' % match.group()
+    fragments += [template.template[start:match.start()], name]
+    start = match.end()
+  fragments.append(template.template[start:])
+  return fragments
+
+
+# json_to_html() and hcard_to_html() write these directly to a buffer instead
+# of substituting the templates. see _write_template().
+HENTRY_FRAGMENTS = _compile_template(HENTRY)
+HCARD_FRAGMENTS = _compile_template(HCARD)
+
+
 def get_string_urls(objs):
   """Extracts string URLs from a list of either string URLs or mf2 dicts.
 
@@ -313,16 +339,22 @@ def json_to_object(mf2):
   return util.trim_nulls(obj)
 
 
-def html_to_activities(html, url=None):
+def html_to_activities(html, url=None, parsed=None):
   """Converts a microformats2 HTML h-feed to ActivityStreams activities.
 
+  Parsing is the expensive part, so if you also need other data from the same
+  document, e.g. find_author() or mf2util.interpret_feed(), parse it once with
+  mf2py.parse() and pass the result as parsed.
+
   Args:
-    html: string HTML
+    html: string HTML. Ignored if parsed is provided.
     url: optional string URL that HTML came from
+    parsed: optional dict, the return value of mf2py.parse() on html
 
   Returns: list of ActivityStreams activity dicts
   """
-  parsed = mf2py.parse(doc=html, url=url)
+  if parsed is None:
+    parsed = mf2py.parse(doc=html, url=url)
   hfeed = mf2util.find_first_entry(parsed, ['h-feed'])
   items = hfeed.get('children', []) if hfeed else parsed.get('items', [])
   return [{'object': json_to_object(item)} for item in items]
@@ -385,15 +417,32 @@ def json_to_html(obj, parent_props=[]):
 
   Returns: string HTML
   """
+  out = []
+  _write_json_html(obj, parent_props, out)
+  return ''.join(out)
+
 
+def _write_json_html(obj, parent_props, out):
+  """Writes the HTML for a microformats2 JSON object to a buffer.
+
+  Implements json_to_html(). Embedded objects, e.g. comments and likes, are
+  written into buffers of their own that are spliced into this one, so their
+  HTML isn't rebuilt as a string at every level.
+
+  Args:
+    obj: dict, a decoded microformats2 JSON object
+    parent_props: list of strings, see json_to_html()
+    out: list of strings, the buffer to append HTML fragments to
+  """
   if not obj:
-    return ''
+    return
 
   types = obj.get('type', [])
   if 'h-card' in types:
-    return hcard_to_html(obj, parent_props)
+    out.append(hcard_to_html(obj, parent_props))
+    return
 
-  props = copy.copy(obj.get('properties', {}))
+  props = obj.get('properties', {})
   in_reply_tos = '\n'.join(IN_REPLY_TO.substitute(url=url)
                            for url in get_string_urls(props.get('in-reply-to', [])))
 
@@ -407,6 +456,7 @@ def json_to_html(obj, parent_props=[]):
   rsvp = prop.get('rsvp')
   if rsvp:
     if not props.get('name'):
+      props = copy.copy(props)
       props['name'] = [{'yes': 'is attending.',
                         'no': 'is not attending.',
                         'maybe': 'might attend.'}.get(rsvp)]
@@ -414,8 +464,10 @@ def json_to_html(obj, parent_props=[]):
       rsvp, props['name'][0])
 
   elif props.get('invitee') and not props.get('name'):
+    props = copy.copy(props)
     props['name'] = ['invited']
 
+  # each element is a buffer with one child's HTML
   children = []
 
   # if this post is itself a like or repost, link to its target(s).
@@ -423,9 +475,9 @@ def json_to_html(obj, parent_props=[]):
     # having like-of or repost-of makes this a like or repost.
     for target in props.get(mftype + '-of', []):
       if isinstance(target, basestring):
-        children.append('<a class="u-%s-of" href="%s"></a>' % (mftype, target))
+        children.append(['<a class="u-%s-of" href="%s"></a>' % (mftype, target)])
       else:
-        children.append(json_to_html(target, ['u-' + mftype + '-of']))
+        children.append(_json_to_html_buffer(target, ['u-' + mftype + '-of']))
 
   # set up content and name
   content = prop.get('content', {})
@@ -453,8 +505,8 @@ def json_to_html(obj, parent_props=[]):
   # comments
   # http://indiewebcamp.com/comment-presentation#How_to_markup
   # http://indiewebcamp.com/h-cite
-  comments_html = '\n'.join(json_to_html(c, ['p-comment'])
-                            for c in props.get('comment', []))
+  comments = [_json_to_html_buffer(c, ['p-comment'])
+              for c in props.get('comment', [])]
 
   # embedded likes and reposts of this post
   # http://indiewebcamp.com/like, http://indiewebcamp.com/repost
@@ -464,30 +516,64 @@ def json_to_html(obj, parent_props=[]):
     if verb + '-of' not in props:
       vals = props.get(verb, [])
       if vals and isinstance(vals[0], dict):
-        children += [json_to_html(v, ['u-' + verb]) for v in vals]
+        children += [_json_to_html_buffer(v, ['u-' + verb]) for v in vals]
 
   # embedded children of this post
-  children += [json_to_html(c) for c in obj.get('children', [])]
-
-  return HENTRY.substitute(
-    prop,
-    published=maybe_datetime(prop.get('published'), 'dt-published'),
-    updated=maybe_datetime(prop.get('updated'), 'dt-updated'),
-    types=' '.join(parent_props + types),
-    author=hcard_to_html(author, ['p-author']),
-    location=hcard_to_html(prop.get('location'), ['p-location']),
-    people=people,
-    photo=photo,
-    video=video,
-    in_reply_tos=in_reply_tos,
-    invitees='\n'.join([hcard_to_html(i, ['p-invitee'])
-                        for i in props.get('invitee', [])]),
-    content=content_html,
-    content_classes=' '.join(content_classes),
-    comments=comments_html,
-    children='\n'.join(children),
-    linked_name=maybe_linked_name(props),
-    summary=summary)
+  children += [_json_to_html_buffer(c) for c in obj.get('children', [])]
+
+  _write_template(HENTRY_FRAGMENTS, out, prop, {
+    'published': maybe_datetime(prop.get('published'), 'dt-published'),
+    'updated': maybe_datetime(prop.get('updated'), 'dt-updated'),
+    'types': ' '.join(parent_props + types),
+    'author': hcard_to_html(author, ['p-author']),
+    'location': hcard_to_html(prop.get('location'), ['p-location']),
+    'people': people,
+    'photo': photo,
+    'video': video,
+    'in_reply_tos': in_reply_tos,
+    'invitees': '\n'.join([hcard_to_html(i, ['p-invitee'])
+                           for i in props.get('invitee', [])]),
+    'content': content_html,
+    'content_classes': ' '.join(content_classes),
+    'comments': comments,
+    'children': children,
+    'linked_name': maybe_linked_name(props),
+    'summary': summary,
+  })
+
+
+def _json_to_html_buffer(obj, parent_props=[]):
+  """Returns a new buffer with the HTML for a microformats2 JSON object."""
+  out = []
+  _write_json_html(obj, parent_props, out)
+  return out
+
+
+def _write_template(fragments, out, mapping, values):
+  """Writes a compiled template to a buffer.
+
+  Equivalent to string.Template.substitute(mapping, **values), except that
+  values may also be lists of buffers, which are written separated by
+  newlines.
+
+  Args:
+    fragments: list of strings, from _compile_template()
+    out: list of strings, the buffer to append to
+    mapping: dict, placeholder values to use if they're not in values
+    values: dict, placeholder values
+  """
+  out.append(fragments[0])
+  for i in xrange(1, len(fragments), 2):
+    name = fragments[i]
+    val = values[name] if name in values else mapping[name]
+    if isinstance(val, list) and name in values:
+      for j, buffer in enumerate(val):
+        if j:
+          out.append('\n')
+        out.extend(buffer)
+    else:
+      out.append('%s' % (val,))
+    out.append(fragments[i + 1])
 
 
 def hcard_to_html(hcard, parent_props=[]):
@@ -507,11 +593,13 @@ def hcard_to_html(hcard, parent_props=[]):
   prop = first_props(hcard['properties'])
   prop.setdefault('uid', '')
   photo = prop.get('photo')
-  return HCARD.substitute(
-    prop,
-    types=' '.join(util.uniquify(parent_props + hcard['type'])),
-    photo=img(photo, 'u-photo', '') if photo else '',
-    linked_name=maybe_linked_name(hcard['properties']))
+  out = []
+  _write_template(HCARD_FRAGMENTS, out, prop, {
+    'types': ' '.join(util.uniquify(parent_props + hcard['type'])),
+    'photo': img(photo, 'u-photo', '') if photo else '',
+    'linked_name': maybe_linked_name(hcard['properties']),
+  })
+  return ''.join(out)
 
 
 def render_content(obj, include_location=True, synthesize_content=True):
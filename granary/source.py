@@ -12,11 +12,23 @@ http://activitystrea.ms/specs/json/targeting/1.0/#anchor3
 
 __author__ = ['Ryan Barrett <granary@ryanb.org>']
 
+import base64
 import collections
+import contextlib
 import copy
+import functools
+import hashlib
+import json
 import logging
 import mimetypes
 import re
+import socket
+import StringIO
+import sys
+import threading
+import time
+import urllib
+import urllib2
 import urlparse
 import html2text
 
@@ -46,6 +58,33 @@ sources = {}
 CreationResult = collections.namedtuple('CreationResult', [
   'content', 'description', 'abort', 'error_plain', 'error_html'])
 
+# Default max number of threads that run_concurrently() uses. Set to 1 to make
+# calls serially, in order, e.g. in tests that expect HTTP requests in a fixed
+# order.
+MAX_WORKERS = 5
+
+# Max number of keep-alive connections that an HttpPool keeps open per host,
+# and max number of hosts it keeps connections open to.
+MAX_CONNECTIONS_PER_HOST = 10
+MAX_HOSTS = 20
+
+# Default max number of concurrent requests that run_concurrently() makes to any
+# single domain when it's given per_domain, e.g. in
+# original_post_discovery_multi() and Instagram scraping.
+MAX_REQUESTS_PER_DOMAIN = 2
+
+# Matches elided values in sparse JavaScript arrays, e.g. both commas in [,,1].
+# Uses lookahead so that adjacent elisions all match in a single pass.
+SPARSE_ARRAY_RE = re.compile(r'([,[])\s*(?=[],])')
+
+_json_decoder = json.JSONDecoder()
+
+# RedirectCache defaults: max number of entries, and how long to keep resolved
+# redirects vs negative results (errors and non-HTML responses), in seconds.
+REDIRECT_CACHE_SIZE = 5000
+REDIRECT_CACHE_TTL = 24 * 60 * 60
+REDIRECT_CACHE_NEGATIVE_TTL = 30 * 60
+
 
 def strip_html_tags(str):
   """Returns the text content of an HTML string, with tags removed."""
@@ -65,6 +104,495 @@ def html_to_text(html):
       line.rstrip() for line in h.unescape(h.handle(html)).splitlines())
 
 
+def extract_json(html, prefix, suffix=None, sparse=False):
+  """Extracts and decodes a JSON blob embedded in an HTML page, e.g. in <script>.
+
+  Decodes in place, starting right after prefix, without copying the blob out
+  of html first, unless it's sparse.
+
+  Args:
+    html: unicode string
+    prefix: string that immediately precedes the JSON blob
+    suffix: string that immediately follows the JSON blob. Only required if
+      sparse is True.
+    sparse: boolean, whether the blob is a JavaScript literal with sparse
+      arrays, e.g. [1,,3], which are normalized to JSON, e.g. [1,null,3]
+
+  Returns: decoded JSON value, or None if prefix or suffix isn't found
+
+  Raises: ValueError if the blob isn't valid JSON
+  """
+  start = html.find(prefix)
+  if start == -1:
+    return None
+  start += len(prefix)
+
+  if not sparse:
+    # skip whitespace, since raw_decode() doesn't
+    while html[start:start + 1].isspace():
+      start += 1
+    return _json_decoder.raw_decode(html, start)[0]
+
+  end = html.find(suffix, start)
+  if end == -1:
+    return None
+  return json.loads(SPARSE_ARRAY_RE.sub(r'\1null', html[start:end]))
+
+
+def encode_cursor(params):
+  """Encodes a silo's native paging parameters as an opaque cursor string.
+
+  Args:
+    params: dict of the query parameters that fetch the next page, e.g.
+      {'max_id': '123'}
+
+  Returns: URL-safe string
+  """
+  return base64.urlsafe_b64encode(json.dumps(params, sort_keys=True)).rstrip('=')
+
+
+def decode_cursor(cursor):
+  """Decodes a cursor from encode_cursor() back into paging parameters.
+
+  Args:
+    cursor: string
+
+  Returns: dict
+
+  Raises: ValueError if cursor is malformed
+  """
+  try:
+    cursor = str(cursor)
+    params = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+  except (TypeError, UnicodeError, ValueError):
+    raise ValueError('Invalid cursor: %r' % cursor)
+
+  if not isinstance(params, dict):
+    raise ValueError('Invalid cursor: %r' % cursor)
+  return params
+
+
+def run_concurrently(fn, inputs, max_workers=None, per_domain=None,
+                     max_per_domain=None):
+  """Calls fn on each input in a bounded pool of threads.
+
+  Used to fan out independent, I/O bound API calls, e.g. one per activity.
+  Results are returned in the same order as inputs, regardless of the order the
+  calls finish in. If any call raises an exception, the first one (in input
+  order) is re-raised after all calls have finished.
+
+  If per_domain is provided, at most max_per_domain calls run at once for
+  inputs on the same domain. Threads pick up inputs on other domains instead
+  of waiting, and no more threads are started than the limits allow, e.g. only
+  max_per_domain if all inputs are on one domain.
+
+  Args:
+    fn: callable that takes a single argument
+    inputs: sequence of arguments to pass to fn
+    max_workers: integer, max number of threads to use. Defaults to
+      MAX_WORKERS. If 1, or if there's only one input, fn is called serially in
+      the current thread.
+    per_domain: optional callable that takes an input and returns its URL
+    max_per_domain: integer, max number of concurrent calls per domain when
+      per_domain is provided. Defaults to MAX_REQUESTS_PER_DOMAIN.
+
+  Returns: list of fn's return values, one per input
+  """
+  inputs = list(inputs)
+  if max_workers is None:
+    max_workers = MAX_WORKERS
+  if max_workers <= 1 or len(inputs) <= 1:
+    return [fn(input) for input in inputs]
+
+  if per_domain:
+    if max_per_domain is None:
+      max_per_domain = MAX_REQUESTS_PER_DOMAIN
+    domains = [util.domain_from_link(per_domain(input)) for input in inputs]
+    counts = collections.Counter(domains)
+    max_workers = min(max_workers,
+                      sum(min(n, max_per_domain) for n in counts.values()))
+  else:
+    domains = [None] * len(inputs)
+    max_per_domain = len(inputs)
+
+  results = [None] * len(inputs)
+  errors = [None] * len(inputs)
+  pending = range(len(inputs))  # indices, in input order
+  running = collections.Counter()  # maps domain to number of calls in flight
+  lock = threading.Condition()
+
+  def next_input():
+    """Claims and returns the index of the next input that can run, or None if
+    there are none left. Waits if all remaining inputs' domains are busy.
+    """
+    with lock:
+      while pending:
+        for pos, i in enumerate(pending):
+          if running[domains[i]] < max_per_domain:
+            del pending[pos]
+            running[domains[i]] += 1
+            return i
+        lock.wait()
+
+  def worker():
+    while True:
+      i = next_input()
+      if i is None:
+        return
+      try:
+        results[i] = fn(inputs[i])
+      except BaseException:
+        errors[i] = sys.exc_info()
+      finally:
+        with lock:
+          running[domains[i]] -= 1
+          lock.notify_all()
+
+  threads = [threading.Thread(target=worker)
+             for _ in xrange(min(max_workers, len(inputs)))]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  for error in errors:
+    if error:
+      raise error[0], error[1], error[2]
+
+  return results
+
+
+def with_actor_memo(fn):
+  """Decorator for Source methods that memoizes actors for the whole call.
+
+  Inside the call, user_to_actor() implementations decorated with
+  memoized_actor() convert each distinct user only once. Use on methods like
+  get_activities_response() that convert many objects by the same users.
+  """
+  @functools.wraps(fn)
+  def wrapper(self, *args, **kwargs):
+    with self.actor_memo():
+      return fn(self, *args, **kwargs)
+  return wrapper
+
+
+def memoized_actor(fn):
+  """Decorator for user_to_actor() implementations. See Source.actor_memo().
+
+  Actors are keyed by the user's id. The same user can appear with different
+  fields in different objects, e.g. snapshots from different times, so a
+  memoized actor is only reused if the user dict is equal to the one it was
+  converted from. Every call returns its own copy, so callers may modify it.
+  """
+  @functools.wraps(fn)
+  def wrapper(self, user):
+    memo = self._actor_memo
+    key = (user.get('id_str') or user.get('id')
+           if memo is not None and isinstance(user, dict) else None)
+    if key is None:
+      return fn(self, user)
+
+    memo_user, actor = memo.get(key, (None, None))
+    if memo_user == user:
+      return _copy_json(actor)
+
+    actor = fn(self, user)
+    memo[key] = (user, _copy_json(actor))
+    return actor
+  return wrapper
+
+
+def _copy_json(obj):
+  """Returns a deep copy of a JSON-style value. Much faster than deepcopy().
+
+  Args:
+    obj: dict, list, or scalar value
+  """
+  if isinstance(obj, dict):
+    return {k: _copy_json(v) for k, v in obj.iteritems()}
+  elif isinstance(obj, list):
+    return [_copy_json(v) for v in obj]
+  return obj
+
+
+class HttpPool(object):
+  """A pool of persistent, keep-alive HTTP connections.
+
+  Backed by a requests Session, so that repeated requests to the same host
+  reuse their TCP and TLS connections instead of opening new ones each time.
+  Each host gets at most max_per_host connections; requests beyond that block
+  until a connection is free. Thread safe, so one pool can be shared across
+  sources and run_concurrently() threads.
+
+  urlopen() is a drop-in replacement for urllib2.urlopen(): it takes a URL or
+  urllib2.Request, returns a file-like response with read(), info(), getcode(),
+  and geturl(), and raises urllib2.HTTPError for non-2xx responses.
+
+  To use it, set a source's http_pool attribute, e.g.:
+
+    tw = twitter.Twitter(key, secret)
+    tw.http_pool = source.HttpPool()
+
+  or set Source.http_pool to share a single pool across all sources.
+  """
+
+  def __init__(self, max_per_host=MAX_CONNECTIONS_PER_HOST, max_hosts=MAX_HOSTS):
+    """Constructor.
+
+    Args:
+      max_per_host: integer, max number of open connections per host
+      max_hosts: integer, max number of hosts to keep connections open to
+    """
+    self.session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+      pool_connections=max_hosts, pool_maxsize=max_per_host, pool_block=True)
+    self.session.mount('http://', adapter)
+    self.session.mount('https://', adapter)
+
+  def urlopen(self, url, data=None, headers=None, **kwargs):
+    """Makes an HTTP request. Like urllib2.urlopen().
+
+    Args:
+      url: string URL or urllib2.Request
+      data: string, optional POST body. If provided, the request is a POST.
+      headers: optional dict of HTTP request headers
+      kwargs: passed through to requests.Session.request()
+
+    Returns: urllib.addinfourl response object
+
+    Raises: urllib2.HTTPError if the response has a non-2xx status code,
+      urllib2.URLError if the connection fails, socket.timeout if it times out
+    """
+    if isinstance(url, urllib2.Request):
+      method = url.get_method()
+      data = url.get_data()
+      headers = dict(url.header_items())
+      url = url.get_full_url()
+    else:
+      method = 'GET' if data is None else 'POST'
+
+    resp = self._request(method, url, data=data, headers=headers, **kwargs)
+    body = StringIO.StringIO(resp.content)
+    if resp.status_code // 100 != 2:
+      raise urllib2.HTTPError(url, resp.status_code, resp.reason, resp.headers,
+                              body)
+    return urllib.addinfourl(body, resp.headers, resp.url, resp.status_code)
+
+  def requests_get(self, url, **kwargs):
+    """Makes an HTTP GET request. Like util.requests_get().
+
+    Returns: requests.Response
+    """
+    return self._request('GET', url, **kwargs)
+
+  def _request(self, method, url, **kwargs):
+    kwargs.setdefault('timeout', util.HTTP_TIMEOUT)
+    logging.info('Requesting %s %s with pooled connection', method, url)
+    try:
+      return self.session.request(method, url, **kwargs)
+    except requests.exceptions.Timeout, e:
+      raise socket.timeout(str(e))
+    except requests.exceptions.ConnectionError, e:
+      raise urllib2.URLError(e)
+
+
+class LRUCache(object):
+  """In-process LRU cache with TTLs.
+
+  Implements the parts of App Engine's memcache interface that we use: get(),
+  get_multi(), set_multi(), and delete_multi(). Should usually be created once
+  per process and reused across requests.
+
+  Holds at most max_size entries, evicting the least recently used first.
+  Entries expire after ttl seconds. Negative results, ie values that
+  _is_negative() returns True for, expire after negative_ttl seconds instead.
+  Like memcache, set_multi() takes an optional time kwarg, in seconds. If it's
+  provided, entries expire after it or the cache's own TTL, whichever is sooner.
+
+  If backend is provided, e.g. memcache, it's checked on local misses, and
+  all writes go through to it, including time.
+
+  Attributes:
+    hits: integer, number of gets answered from the in-process cache
+    misses: integer, number of gets that weren't in the in-process cache
+  """
+
+  def __init__(self, max_size, ttl, negative_ttl=None, backend=None):
+    """Constructor.
+
+    Args:
+      max_size: integer, max number of entries to keep in memory
+      ttl: integer, seconds to keep entries
+      negative_ttl: integer, seconds to keep negative results. Defaults to ttl.
+      backend: optional external cache object with get(key), set_multi(dict),
+        and delete_multi(list) methods, e.g. App Engine's memcache
+    """
+    self.max_size = max_size
+    self.ttl = ttl
+    self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+    self.backend = backend
+    self.hits = self.misses = 0
+    # maps key to (value, expiration timestamp), least recently used first
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry and entry[1] > time.time():
+        self._entries[key] = entry  # move to most recently used
+        self.hits += 1
+        return entry[0]
+      self.misses += 1
+
+    if self.backend is not None:
+      value = self.backend.get(key)
+      if value is not None:
+        self._set_local(key, value)
+        return value
+
+  def get_multi(self, keys):
+    got = {}
+    for key in keys:
+      value = self.get(key)
+      if value is not None:
+        got[key] = value
+    return got
+
+  def set_multi(self, mapping, **kwargs):
+    for key, value in mapping.items():
+      self._set_local(key, value, max_ttl=kwargs.get('time'))
+    if self.backend is not None:
+      self.backend.set_multi(mapping, **kwargs)
+
+  def delete_multi(self, keys):
+    keys = list(keys)
+    with self._lock:
+      for key in keys:
+        self._entries.pop(key, None)
+    if self.backend is not None:
+      self.backend.delete_multi(keys)
+
+  def _is_negative(self, value):
+    """Returns True if a value is a negative result. Subclasses may override.
+
+    Args:
+      value: cached value
+    """
+    return False
+
+  def _set_local(self, key, value, max_ttl=None):
+    """Stores a value in the in-process cache, evicting entries if necessary.
+
+    Args:
+      key: string
+      value: cached value
+      max_ttl: integer, optional seconds until the value expires, if sooner
+        than the cache's own TTL. 0 or None means no limit, like memcache.
+    """
+    ttl = self.negative_ttl if self._is_negative(value) else self.ttl
+    if max_ttl:
+      ttl = min(ttl, max_ttl)
+    expires = time.time() + ttl
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = (value, expires)
+      while len(self._entries) > self.max_size:
+        self._entries.popitem(last=False)
+
+
+class RedirectCache(LRUCache):
+  """In-process LRU cache with TTLs for resolved URL redirects.
+
+  Can be passed as the cache arg to util.follow_redirects(),
+  original_post_discovery(), and original_post_discovery_multi(). Resolved
+  redirects expire after ttl seconds. Negative results, ie failed resolves and
+  non-HTML responses, expire sooner, after negative_ttl seconds.
+  """
+
+  def __init__(self, max_size=REDIRECT_CACHE_SIZE, ttl=REDIRECT_CACHE_TTL,
+               negative_ttl=REDIRECT_CACHE_NEGATIVE_TTL, backend=None):
+    super(RedirectCache, self).__init__(max_size, ttl, negative_ttl=negative_ttl,
+                                        backend=backend)
+
+  def _is_negative(self, value):
+    """requests.Response values with a non-HTML content type or an error
+    status code, e.g. follow_redirects() failures' 499, are negative.
+    """
+    return isinstance(value, requests.Response) and (
+      not value.status_code or value.status_code >= 400 or
+      not value.headers.get('content-type', '').startswith('text/html'))
+
+
+class SyncState(object):
+  """Per-account incremental polling state for Source.poll().
+
+  Callers store this between polls, e.g. serialized with to_json(). It
+  implements the parts of App Engine's memcache interface that
+  get_activities_response() uses for its cache arg, so that cached counts,
+  e.g. Twitter's ATR/ATF, Google+'s AGC/AGL/AGS, and Instagram's AIL/AIC keys,
+  are stored per account along with the rest of the state.
+
+  Sources read the cached counts for every activity in their response, so
+  after each poll, prune() drops the counts that weren't read or written,
+  ie the ones for activities that have dropped out of the response. That
+  keeps the state from growing without bound, so set_multi() ignores memcache's
+  time kwarg.
+
+  Attributes:
+    min_id: string, highest numeric silo activity id seen so far
+    etag: string, ETag from the last poll's response
+    counts: dict, cache key to value, e.g. {'ATR 123': 4}
+    seen: dict, activity id to fingerprint of its contents, for the activities
+      in the last poll's response
+  """
+
+  def __init__(self, min_id=None, etag=None, counts=None, seen=None):
+    self.min_id = min_id
+    self.etag = etag
+    self.counts = counts or {}
+    self.seen = seen or {}
+    # keys read or written since the last prune()
+    self._used = set()
+
+  def to_json(self):
+    """Returns this state serialized as a JSON string."""
+    return json.dumps({
+      'min_id': self.min_id,
+      'etag': self.etag,
+      'counts': self.counts,
+      'seen': self.seen,
+    })
+
+  @classmethod
+  def from_json(cls, data):
+    """Returns a SyncState deserialized from a to_json() string."""
+    return cls(**json.loads(data))
+
+  def get(self, key):
+    self._used.add(key)
+    return self.counts.get(key)
+
+  def get_multi(self, keys):
+    keys = list(keys)
+    self._used.update(keys)
+    return {key: self.counts[key] for key in keys if key in self.counts}
+
+  def set_multi(self, mapping, **kwargs):
+    self._used.update(mapping)
+    self.counts.update(mapping)
+
+  def delete_multi(self, keys):
+    for key in keys:
+      self.counts.pop(key, None)
+
+  def prune(self):
+    """Drops cached counts that haven't been read or written since the last
+    prune()."""
+    self.counts = {k: v for k, v in self.counts.items() if k in self._used}
+    self._used = set()
+
+
 def creation_result(content=None, description=None, abort=False,
                     error_plain=None, error_html=None):
   """Create a new CreationResult named tuple, which the result of
@@ -131,9 +659,20 @@ class Source(object):
     EMBED_POST: string, the HTML for embedding a post. Should have a %(url)s
       placeholder for the post URL and (optionally) a %(content)s placeholder
       for the post content.
+
+  Attributes:
+    http_pool: optional HttpPool to make HTTP requests with. If None, requests
+      are made with util.urlopen() and util.requests_get(), ie without
+      connection reuse. May be set on an instance or on Source itself.
   """
   __metaclass__ = SourceMeta
 
+  http_pool = None
+
+  # maps user id to (user, actor) while an actor_memo() block is active. see
+  # memoized_actor().
+  _actor_memo = None
+
   def user_url(self, user_id):
     """Returns the URL for a user's profile."""
     raise NotImplementedError()
@@ -157,7 +696,8 @@ class Source(object):
                               etag=None, min_id=None, cache=None,
                               fetch_replies=False, fetch_likes=False,
                               fetch_shares=False, fetch_events=False,
-                              fetch_mentions=False, search_query=None, **kwargs):
+                              fetch_mentions=False, search_query=None,
+                              cursor=None, **kwargs):
     """Fetches and returns ActivityStreams activities and response details.
 
     Subclasses should override this. See get_activities() for an alternative
@@ -201,6 +741,9 @@ class Source(object):
       fetch_mentions: boolean, whether to fetch posts that mention the user
       search_query: string, an optional search query, only for use with
          @search group_id
+      cursor: string, optional opaque cursor from a previous response's
+        nextCursor. Fetches the page after that response with the silo's own
+        paging, instead of start_index, which is ignored.
       kwargs: some sources accept extra kwargs. See their docs for details.
 
     Returns:
@@ -217,9 +760,92 @@ class Source(object):
         sorted: False
         updatedSince: False
         etag: string etag returned by the API's initial call to get activities
+        nextCursor: string cursor for the next page, if the source supports
+          cursors and there may be more activities. Pass it back as cursor.
     """
     raise NotImplementedError()
 
+  def poll(self, state=None, **kwargs):
+    """Fetches activities that are new or changed since the last poll.
+
+    Passes the state's ETag and cached counts to get_activities_response(), and
+    its min_id as described in poll_min_id_kwargs(). min_id is only tracked for
+    sources that implement min_id_key(), currently Twitter and Instagram.
+    Facebook, Flickr, and Google+ don't support min_id, so polling them only
+    saves API calls through ETags and cached counts.
+
+    Args:
+      state: SyncState from the previous poll, or None for the first poll.
+        Not modified.
+      kwargs: passed through to get_activities_response(), except etag,
+        min_id, and cache, which come from state
+
+    Returns: (list of new or changed activity dicts, new SyncState) tuple
+    """
+    state = copy.deepcopy(state) if state else SyncState()
+    state._used = set()
+
+    extras = any(v for k, v in kwargs.items() if k.startswith('fetch_'))
+    kwargs.update(self.poll_min_id_kwargs(state.min_id, extras))
+    resp = self.get_activities_response(etag=state.etag, cache=state, **kwargs)
+    if resp.get('etag'):
+      state.etag = resp['etag']
+
+    activities = resp.get('items', [])
+    changed = []
+    seen = {}
+    max_key = self.min_id_key(state.min_id) if state.min_id else None
+    for activity in activities:
+      id = activity.get('id')
+      fingerprint = hashlib.md5(json.dumps(activity, sort_keys=True)).hexdigest()
+      if not id or state.seen.get(id) != fingerprint:
+        changed.append(activity)
+      if id:
+        seen[id] = fingerprint
+        parsed = util.parse_tag_uri(id)
+        silo_id = parsed[1] if parsed else id
+        key = self.min_id_key(silo_id)
+        if key is not None and (max_key is None or key > max_key):
+          state.min_id = silo_id
+          max_key = key
+
+    # an empty response may just mean nothing changed, e.g. 304 Not Modified
+    if activities:
+      state.seen = seen
+      state.prune()
+
+    return changed, state
+
+  def poll_min_id_kwargs(self, min_id, extras):
+    """Returns the min_id kwargs that poll() passes to get_activities_response().
+
+    By default, passes min_id only if no fetch_* kwargs are set, since min_id
+    can only find new activities, not new replies, likes, etc. of existing
+    ones. Subclasses may override.
+
+    Args:
+      min_id: string, the poll state's min_id, or None
+      extras: boolean, whether any fetch_* kwargs are set
+
+    Returns: dict
+    """
+    return {'min_id': None if extras else min_id}
+
+  @classmethod
+  def min_id_key(cls, silo_id):
+    """Returns a sortable key for comparing a silo activity id with min_id.
+
+    poll() uses this to track the newest activity it's seen. Sources that
+    support min_id override this for their id format. The default returns None
+    for every id, so poll() doesn't track min_id.
+
+    Args:
+      silo_id: string, e.g. '123' or '123_456'
+
+    Returns: sortable value, or None if the id can't be compared
+    """
+    return None
+
   @classmethod
   def make_activities_base_response(cls, activities, *args, **kwargs):
     """Generates a base response dict for get_activities_response().
@@ -349,6 +975,22 @@ class Source(object):
     """
     raise NotImplementedError()
 
+  @contextlib.contextmanager
+  def actor_memo(self):
+    """Context manager that memoizes user_to_actor() inside its block.
+
+    Reentrant. The memo is discarded when the outermost block exits.
+    """
+    if self._actor_memo is not None:
+      yield
+      return
+
+    self._actor_memo = {}
+    try:
+      yield
+    finally:
+      self._actor_memo = None
+
   def user_to_actor(self, user):
     """Converts a user to an actor.
 
@@ -364,6 +1006,28 @@ class Source(object):
     """
     raise NotImplementedError()
 
+  def _urlopen(self, url, **kwargs):
+    """Makes an HTTP request with http_pool if set, otherwise util.urlopen().
+
+    Args:
+      url: string URL or urllib2.Request
+      kwargs: passed through to HttpPool.urlopen() or util.urlopen()
+
+    Returns: urllib2 response object
+    """
+    if self.http_pool:
+      return self.http_pool.urlopen(url, **kwargs)
+    return util.urlopen(url, **kwargs)
+
+  def _requests_get(self, url, **kwargs):
+    """Makes an HTTP GET with http_pool if set, otherwise util.requests_get().
+
+    Returns: requests.Response
+    """
+    if self.http_pool:
+      return self.http_pool.requests_get(url, **kwargs)
+    return util.requests_get(url, **kwargs)
+
   def _get_tag(self, activities, verb, user_id):
     if not activities:
       return None
@@ -474,19 +1138,73 @@ class Source(object):
     tags fields, as well as links and permashortlinks/permashortcitations in the
     text content.
 
+    To discover original posts for many activities at once, use
+    original_post_discovery_multi(), which resolves redirects in parallel.
+
     Args:
       activity: activity dict
       domains: optional sequence of domains. If provided, only links to these
         domains will be considered original and stored in upstreamDuplicates.
         (Permashortcitations are exempt.)
       cache: optional, a cache object for storing resolved URL redirects. Passed
-        to follow_redirects().
+        to follow_redirects(). A RedirectCache is recommended.
       include_redirect_sources: boolean, whether to include URLs that redirect
         as well as their final destination URLs
       kwargs: passed to requests.head() when following redirects
 
     Returns: ([string original post URLs], [string mention URLs]) tuple
     """
+    candidates = Source._original_post_candidates(activity)
+    resolved = {url: util.follow_redirects(url, cache=cache, **kwargs)
+                for url in candidates}
+    return Source._classify_original_posts(
+      candidates, resolved, domains=domains,
+      include_redirect_sources=include_redirect_sources)
+
+  @staticmethod
+  def original_post_discovery_multi(activities, domains=None, cache=None,
+                                    include_redirect_sources=True,
+                                    max_workers=None, **kwargs):
+    """Discovers original post links for multiple activities at once.
+
+    Equivalent to calling original_post_discovery() on each activity, but
+    resolves each distinct candidate URL only once across all activities, and
+    follows redirects in parallel. At most MAX_REQUESTS_PER_DOMAIN requests are
+    made to any single domain at a time.
+
+    Args:
+      activities: sequence of activity dicts
+      domains, cache, include_redirect_sources, kwargs: see
+        original_post_discovery()
+      max_workers: integer, max number of redirects to follow in parallel.
+        Defaults to MAX_WORKERS.
+
+    Returns: list of ([string original post URLs], [string mention URLs])
+      tuples, one per activity
+    """
+    candidates = [Source._original_post_candidates(a) for a in activities]
+    urls = sorted(set().union(*candidates))
+
+    def resolve(url):
+      return util.follow_redirects(url, cache=cache, **kwargs)
+
+    # limit concurrent requests per domain so we don't hammer any one site
+    resolved = dict(zip(urls, run_concurrently(
+      resolve, urls, max_workers=max_workers, per_domain=lambda url: url)))
+    return [Source._classify_original_posts(
+              c, resolved, domains=domains,
+              include_redirect_sources=include_redirect_sources)
+            for c in candidates]
+
+  @staticmethod
+  def _original_post_candidates(activity):
+    """Returns an activity's candidate original post URLs for discovery.
+
+    Args:
+      activity: activity dict
+
+    Returns: set of string URLs
+    """
     obj = activity.get('object') or activity
     content = obj.get('content', '').strip()
 
@@ -501,19 +1219,34 @@ class Source(object):
     candidates += [match.expand(r'http://\1/\2') for match in
                    Source._PERMASHORTCITATION_RE.finditer(content)]
 
-    candidates = set(filter(None,
+    return set(filter(None,
       (util.clean_url(url) for url in candidates
        # heuristic: ellipsized URLs are probably incomplete, so omit them.
        if url and not url.endswith('...') and not url.endswith(u'…'))))
 
+  @staticmethod
+  def _classify_original_posts(candidates, resolved, domains=None,
+                               include_redirect_sources=True):
+    """Splits candidate URLs into original posts and mentions.
+
+    Args:
+      candidates: set of string URLs, from _original_post_candidates()
+      resolved: dict mapping each candidate URL to its follow_redirects()
+        response
+      domains, include_redirect_sources: see original_post_discovery()
+
+    Returns: ([string original post URLs], [string mention URLs]) tuple
+    """
+    candidates = set(candidates)
+
     # check for redirect and add their final urls
     redirects = {}  # maps final URL to original URL for redirects
     for url in list(candidates):
-      resolved = util.follow_redirects(url, cache=cache, **kwargs)
-      if (resolved.url != url and
-          resolved.headers.get('content-type', '').startswith('text/html')):
-        redirects[resolved.url] = url
-        candidates.add(resolved.url)
+      final = resolved[url]
+      if (final.url != url and
+          final.headers.get('content-type', '').startswith('text/html')):
+        redirects[final.url] = url
+        candidates.add(final.url)
 
     # use domains to determine which URLs are original post links vs mentions
     originals = set()
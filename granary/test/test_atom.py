@@ -32,6 +32,21 @@ class AtomTest(testutil.HandlerTest):
           xml_base=base_url
         ))
 
+  def test_generate_atom(self):
+    kwargs = {'request_url': 'http://request/url', 'host_url': 'http://host/url'}
+    self.assert_multiline_equals(
+      atom.activities_to_atom([copy.deepcopy(test_twitter.ACTIVITY)],
+                              test_twitter.ACTOR, **kwargs),
+      ''.join(atom.generate_atom([copy.deepcopy(test_twitter.ACTIVITY)],
+                                 test_twitter.ACTOR, **kwargs)))
+
+  def test_environment_is_shared(self):
+    env = atom._environment()
+    self.assertIs(env, atom._environment())
+    atom.activities_to_atom([copy.deepcopy(test_facebook.ACTIVITY)],
+                            test_facebook.ACTOR)
+    self.assertIs(env, atom._environment())
+
   def test_title(self):
     self.assert_multiline_in(
       '\n<title>my title</title>',
@@ -919,6 +919,7 @@ class FacebookTest(testutil.HandlerTest):
     self.fb = facebook.Facebook()
     self.batch = []
     self.batch_responses = []
+    self.batch_stubbed = False
 
   def expect_urlopen(self, url, response=None, **kwargs):
     if not url.startswith('http'):
@@ -926,6 +927,62 @@ class FacebookTest(testutil.HandlerTest):
     return super(FacebookTest, self).expect_urlopen(
       url, response=json.dumps(response), **kwargs)
 
+  def stub_batch(self):
+    if not self.batch_stubbed:
+      self.mox.StubOutWithMock(self.fb, 'urlopen_batch_full')
+      self.batch_stubbed = True
+
+  def expect_rsvps_batch(self, resps):
+    """Expects a batch API call for events' RSVPs.
+
+    Args:
+      resps: sequence of (event id, relative url, response dict) tuples
+    """
+    self.stub_batch()
+    self.fb.urlopen_batch_full(
+      [{'name': id, 'relative_url': url} for id, url, _ in resps]
+    ).AndReturn([resp for _, _, resp in resps])
+
+  def expect_self_batch(self, feed=None, photos=None, albums=None, news=None,
+                        events=None, event_objs=None, codes=None,
+                        feed_headers=None, response_headers=None):
+    """Expects the batch API call from get_activities(group_id=source.SELF).
+
+    Args are response bodies. news and events are only requested if they're not
+    None. event_objs defaults to a multi-id lookup response with events. codes
+    is an optional dict mapping request name to HTTP status code.
+    """
+    self.stub_batch()
+    codes = codes or {}
+    feed_req = {'name': 'feed', 'relative_url': 'me/feed?offset=0'}
+    if feed_headers:
+      feed_req['headers'] = feed_headers
+    reqs = [(feed_req, feed)]
+    if news is not None:
+      reqs.append(({'name': 'news', 'relative_url': 'me/news.publishes'}, news))
+    reqs += [({'name': 'photos', 'relative_url': 'me/photos/uploaded'}, photos),
+             ({'name': 'albums', 'relative_url': 'me/albums'}, albums)]
+    if events is not None:
+      if event_objs is None:
+        event_objs = {e['id']: e for e in facebook.Facebook._as(list, events)}
+      reqs += [
+        ({'name': 'events', 'relative_url': 'me/events',
+          'omit_response_on_success': False}, events),
+        ({'name': 'event_objs', 'relative_url':
+            '?ids={result=events:$.data.*.id}&fields=' + facebook.API_EVENT_FIELDS},
+         event_objs),
+      ]
+
+    # don't trim_nulls() the bodies, since e.g. privacy value '' is meaningful
+    resps = []
+    for req, body in reqs:
+      resp = {'code': codes.get(req['name'], 200),
+              'body': body if body is not None else {}}
+      if req['name'] == 'feed' and response_headers:
+        resp['headers'] = response_headers
+      resps.append(resp)
+    self.fb.urlopen_batch_full([req for req, _ in reqs]).AndReturn(resps)
+
   def expect_batch_req(self, url, response, status=200, headers={},
                        response_headers=None):
     batch.append({
@@ -1028,17 +1085,15 @@ class FacebookTest(testutil.HandlerTest):
     self.assertNotIn('tags', got[0])
 
   def test_get_activities_self_empty(self):
-    self.expect_urlopen('me/feed?offset=0', {})
-    self.expect_urlopen('me/photos/uploaded', {})
+    self.expect_self_batch()
     self.mox.ReplayAll()
     self.assert_equals([], self.fb.get_activities(group_id=source.SELF))
 
   def test_get_activities_self_photo_and_event(self):
-    self.expect_urlopen('me/feed?offset=0', {'data': [PHOTO_POST]})
-    self.expect_urlopen('me/photos/uploaded', {'data': [PHOTO]})
-    self.expect_urlopen('me/events', {'data': [EVENT]})
-    self.expect_urlopen(facebook.API_EVENT % '145304994', EVENT)
-    self.expect_urlopen(facebook.API_EVENT_RSVPS % '145304994', {'data': RSVPS})
+    self.expect_self_batch(feed={'data': [PHOTO_POST]}, photos={'data': [PHOTO]},
+                           events={'data': [EVENT]})
+    self.expect_rsvps_batch([('145304994', '145304994/invited',
+                              {'code': 200, 'body': {'data': RSVPS}})])
 
     self.mox.ReplayAll()
     self.assert_equals(
@@ -1049,7 +1104,7 @@ class FacebookTest(testutil.HandlerTest):
     """
     https://github.com/snarfed/bridgy/issues/562
     """
-    self.expect_urlopen('me/feed?offset=0', {'data': [
+    self.expect_self_batch(feed={'data': [
       {'id': '1', 'object_id': '11',   # has photo but no album
        'privacy': {'value': 'EVERYONE'}},
       {'id': '3', 'object_id': '33'},  # has photo but no album
@@ -1058,16 +1113,14 @@ class FacebookTest(testutil.HandlerTest):
        'privacy': {'value': 'CUSTOM'}},
       {'id': '7', 'object_id': '77',   # ditto, and photo has no album
        'privacy': {'value': 'CUSTOM'}},
-    ]})
-    self.expect_urlopen('me/photos/uploaded', {'data': [
+    ]}, photos={'data': [
       {'id': '11'},
       {'id': '22', 'album': '222'},  # no matching post
       {'id': '33', 'album': '333'},  # no matching album
       {'id': '44', 'album': '444'},  # no matching post or album
       {'id': '66', 'album': '666'},  # consolidated posts...
       {'id': '77'},
-    ]})
-    self.expect_urlopen('me/albums', {'data': [
+    ]}, albums={'data': [
       {'id': '222', 'privacy': 'friends'},   # no post
       {'id': '666', 'privacy': 'everyone'},  # consolidated post
     ]})
@@ -1085,62 +1138,128 @@ class FacebookTest(testutil.HandlerTest):
         for activity in self.fb.get_activities(group_id=source.SELF)])
 
   def test_get_activities_self_photos_returns_list(self):
-    self.expect_urlopen('me/feed?offset=0', {})
-    self.expect_urlopen('me/photos/uploaded', [])
+    self.expect_self_batch(photos=[])
     self.mox.ReplayAll()
     self.assert_equals([], self.fb.get_activities(group_id=source.SELF))
 
   def test_get_activities_self_owned_event_rsvps(self):
-    self.expect_urlopen('me/feed?offset=0', {})
-    self.expect_urlopen('me/photos/uploaded', {})
-    self.expect_urlopen('me/events', {'data': [EVENT]})
-    self.expect_urlopen(facebook.API_EVENT % '145304994', EVENT)
-    self.expect_urlopen(facebook.API_EVENT_RSVPS % '145304994', {'data': RSVPS})
+    self.expect_self_batch(events={'data': [EVENT]})
+    self.expect_rsvps_batch([('145304994', '145304994/invited',
+                              {'code': 200, 'body': {'data': RSVPS}})])
 
     self.mox.ReplayAll()
     self.assert_equals([EVENT_ACTIVITY_WITH_ATTENDEES], self.fb.get_activities(
       group_id=source.SELF, fetch_events=True, event_owner_id=EVENT['owner']['id']))
 
   def test_get_activities_self_unowned_event_no_rsvps(self):
-    self.expect_urlopen('me/feed?offset=0', {})
-    self.expect_urlopen('me/photos/uploaded', {})
-    self.expect_urlopen('me/events', {'data': [EVENT]})
-    self.expect_urlopen(facebook.API_EVENT % '145304994', EVENT)
+    self.expect_self_batch(events={'data': [EVENT]})
 
     self.mox.ReplayAll()
     self.assert_equals([], self.fb.get_activities(
       group_id=source.SELF, fetch_events=True, event_owner_id='xyz'))
 
   def test_get_activities_self_event_400s(self):
-    self.expect_urlopen('me/feed?offset=0', {})
-    self.expect_urlopen('me/photos/uploaded', {})
-    self.expect_urlopen('me/events', {'data': [EVENT]})
+    self.expect_self_batch(events={'data': [EVENT]}, codes={'event_objs': 400})
+    # falls back to a multi-id lookup, then to fetching the event individually
+    self.expect_urlopen(facebook.API_EVENTS % '145304994', status=400)
     self.expect_urlopen(facebook.API_EVENT % '145304994', EVENT, status=400)
 
     self.mox.ReplayAll()
     self.assert_equals([], self.fb.get_activities(
       group_id=source.SELF, fetch_events=True))
 
+  def test_get_activities_self_event_missing_from_batch(self):
+    self.expect_self_batch(events={'data': [EVENT]}, event_objs={})
+    self.mox.ReplayAll()
+    self.assert_equals([], self.fb.get_activities(
+      group_id=source.SELF, fetch_events=True))
+
   def test_get_activities_self_event_rsvps_400s(self):
-    self.expect_urlopen('me/feed?offset=0', {})
-    self.expect_urlopen('me/photos/uploaded', {})
-    self.expect_urlopen('me/events', {'data': [EVENT]})
-    self.expect_urlopen(facebook.API_EVENT % '145304994', EVENT)
-    self.expect_urlopen(facebook.API_EVENT_RSVPS % '145304994', {'data': RSVPS},
-                        status=400)
+    self.expect_self_batch(events={'data': [EVENT]})
+    self.expect_rsvps_batch([('145304994', '145304994/invited', {'code': 400})])
 
     self.mox.ReplayAll()
     self.assert_equals([EVENT_ACTIVITY], self.fb.get_activities(
       group_id=source.SELF, fetch_events=True))
 
+  def test_get_activities_self_events_filters_owner_before_rsvps(self):
+    other = copy.deepcopy(EVENT)
+    other.update({'id': '999', 'owner': {'id': 'xyz'}})
+    self.expect_self_batch(events={'data': [EVENT, other]})
+    # only fetches RSVPs for the owned event
+    self.expect_rsvps_batch([('145304994', '145304994/invited',
+                              {'code': 200, 'body': {'data': RSVPS}})])
+
+    self.mox.ReplayAll()
+    self.assert_equals([EVENT_ACTIVITY_WITH_ATTENDEES], self.fb.get_activities(
+      group_id=source.SELF, fetch_events=True, event_owner_id=EVENT['owner']['id']))
+
+  def test_get_events_rsvps_paging(self):
+    event_2 = copy.deepcopy(EVENT)
+    event_2['id'] = '222'
+    self.expect_urlopen('me/events', {'data': [EVENT, event_2]})
+    self.expect_urlopen(facebook.API_EVENTS % '145304994,222',
+                        {'145304994': EVENT, '222': event_2})
+    self.expect_rsvps_batch([
+      ('145304994', '145304994/invited', {'code': 200, 'body': {
+        'data': RSVPS[:2],
+        'paging': {'cursors': {'after': 'abc'}, 'next': 'http://x/y'},
+      }}),
+      ('222', '222/invited', {'code': 200, 'body': {'data': []}}),
+    ])
+    self.expect_rsvps_batch([
+      ('145304994', '145304994/invited?after=abc',
+       {'code': 200, 'body': {'data': RSVPS[2:]}}),
+    ])
+    self.mox.ReplayAll()
+
+    got = self.fb._get_events()
+    self.assert_equals(EVENT_ACTIVITY_WITH_ATTENDEES, got[0])
+    self.assert_equals('222', got[1]['object']['fb_id'])
+    self.assertNotIn('attending', got[1]['object'])
+
   def test_get_activities_self_events_returns_list(self):
-    self.expect_urlopen('me/feed?offset=0', {})
-    self.expect_urlopen('me/photos/uploaded', {})
-    self.expect_urlopen('me/events', [])
+    self.expect_self_batch(events=[])
     self.mox.ReplayAll()
     self.assert_equals([], self.fb.get_activities(
       group_id=source.SELF, fetch_events=True))
 
+  def test_get_activities_self_etag(self):
+    self.expect_self_batch(feed={'data': [POST]},
+                           feed_headers={'If-None-Match': '"my etag"'},
+                           response_headers={'ETag': '"new etag"'})
+    self.mox.ReplayAll()
+    resp = self.fb.get_activities_response(group_id=source.SELF,
+                                           etag='"my etag"')
+    self.assert_equals([ACTIVITY], resp['items'])
+    self.assert_equals('"new etag"', resp['etag'])
+
+  def test_get_activities_self_304_not_modified(self):
+    self.expect_self_batch(codes={'feed': 304},
+                           feed_headers={'If-None-Match': '"my etag"'})
+    self.mox.ReplayAll()
+    resp = self.fb.get_activities_response(group_id=source.SELF,
+                                           etag='"my etag"')
+    self.assert_equals([], resp['items'])
+    self.assert_equals('"my etag"', resp['etag'])
+
+  def test_get_activities_self_feed_error(self):
+    self.expect_self_batch(codes={'feed': 500})
+    self.mox.ReplayAll()
+    self.assertRaises(urllib2.HTTPError, self.fb.get_activities,
+                      group_id=source.SELF)
+
+  def test_get_activities_self_albums_error_falls_back(self):
+    self.expect_self_batch(feed={'data': [{'id': '3', 'object_id': '33'}]},
+                           photos={'data': [{'id': '33', 'album': '333'}]},
+                           codes={'albums': 400})
+    self.expect_urlopen('me/albums', {'data': [
+      {'id': '333', 'privacy': 'everyone'}]})
+    self.mox.ReplayAll()
+    got = self.fb.get_activities(group_id=source.SELF)
+    self.assert_equals([{'objectType':'group', 'alias':'@public'}],
+                       got[0]['object']['to'])
+
   def test_get_activities_passes_through_access_token(self):
     self.expect_urlopen('me/home?offset=0&access_token=asdf', {"id": 123})
     self.mox.ReplayAll()
@@ -1175,6 +1294,24 @@ class FacebookTest(testutil.HandlerTest):
     self.mox.ReplayAll()
     self.fb.get_activities(start_index=3, count=5)
 
+  def test_get_activities_cursor(self):
+    self.expect_urlopen('me/home?offset=0&limit=5', {
+      'data': [{'id': '1_2', 'message': 'foo'}],
+      'paging': {'next': facebook.API_BASE +
+                 'me/home?access_token=x&limit=5&until=1400'},
+    })
+    self.expect_urlopen('me/home?offset=0&until=1400&limit=5', {'data': []})
+    self.mox.ReplayAll()
+
+    resp = self.fb.get_activities_response(count=5)
+    self.assert_equals({'until': '1400'}, source.decode_cursor(resp['nextCursor']))
+
+    # start_index is ignored with a cursor
+    resp = self.fb.get_activities_response(start_index=3, count=5,
+                                           cursor=resp['nextCursor'])
+    self.assert_equals([], resp['items'])
+    self.assertNotIn('nextCursor', resp)
+
   def test_get_activities_activity_id_with_user_id(self):
     """Check that we fetch both forms of the id and merge the results."""
     self.expect_urlopen('12_34', {'id': '123'})
@@ -1241,14 +1378,26 @@ class FacebookTest(testutil.HandlerTest):
   def test_get_activities_too_many_ids(self):
     ids = ['1', '2', '3', '4', '5']
     self.expect_urlopen('me/home?offset=0', {'data': [{'id': id} for id in ids]})
-    self.expect_urlopen('sharedposts?ids=1,2', {'1': {'data': [{'id': '222'}]}})
-    self.expect_urlopen('sharedposts?ids=3,4', {'2': {'data': [{'id': '444'}]}})
-    self.expect_urlopen('sharedposts?ids=5', {})
-    self.expect_urlopen('comments?filter=stream&ids=1,2',
-                        {'1': {'data': [{'id': '111'}]}})
-    self.expect_urlopen('comments?filter=stream&ids=3,4',
-                        {'1': {'data': [{'id': '333'}]}})
-    self.expect_urlopen('comments?filter=stream&ids=5', {})
+    # each set of chunks is sent in a single batch request
+    self.stub_batch()
+    self.fb.urlopen_batch_full([
+      {'name': '0', 'relative_url': 'sharedposts?ids=1,2'},
+      {'name': '1', 'relative_url': 'sharedposts?ids=3,4'},
+      {'name': '2', 'relative_url': 'sharedposts?ids=5'},
+    ]).AndReturn([
+      {'code': 200, 'body': {'1': {'data': [{'id': '222'}]}}},
+      {'code': 200, 'body': {'2': {'data': [{'id': '444'}]}}},
+      {'code': 200, 'body': {}},
+    ])
+    self.fb.urlopen_batch_full([
+      {'name': '0', 'relative_url': 'comments?filter=stream&ids=1,2'},
+      {'name': '1', 'relative_url': 'comments?filter=stream&ids=3,4'},
+      {'name': '2', 'relative_url': 'comments?filter=stream&ids=5'},
+    ]).AndReturn([
+      {'code': 200, 'body': {'1': {'data': [{'id': '111'}]}}},
+      {'code': 200, 'body': {'1': {'data': [{'id': '333'}]}}},
+      {'code': 200},
+    ])
     self.mox.ReplayAll()
 
     try:
@@ -1267,6 +1416,26 @@ class FacebookTest(testutil.HandlerTest):
     obj1 = activities[1]['object']
     self.assert_equals(['444'], [t['fb_id'] for t in obj1['tags']])
 
+  def test_get_activities_too_many_ids_chunk_400s(self):
+    self.expect_urlopen('me/home?offset=0', {'data': [{'id': '1'}, {'id': '2'}]})
+    self.stub_batch()
+    self.fb.urlopen_batch_full([
+      {'name': '0', 'relative_url': 'sharedposts?ids=1'},
+      {'name': '1', 'relative_url': 'sharedposts?ids=2'},
+    ]).AndReturn([{'code': 200, 'body': {'1': {'data': [{'id': '222'}]}}},
+                  {'code': 400}])
+    self.mox.ReplayAll()
+
+    orig_max_ids = facebook.MAX_IDS
+    try:
+      facebook.MAX_IDS = 1
+      activities = self.fb.get_activities(fetch_shares=True)
+    finally:
+      facebook.MAX_IDS = orig_max_ids
+
+    for activity in activities:
+      self.assertNotIn('tags', activity['object'])
+
   def test_get_event(self):
     self.expect_urlopen(facebook.API_EVENT % '145304994', EVENT)
     self.expect_urlopen(facebook.API_EVENT_RSVPS % '145304994', {'data': RSVPS})
@@ -1303,8 +1472,7 @@ class FacebookTest(testutil.HandlerTest):
     post = {'id': '1', 'status_type': 'shared_story'}
     activity = self.fb.post_to_activity(post)
 
-    self.expect_urlopen('me/feed?offset=0', {'data': [post]})
-    self.expect_urlopen('me/photos/uploaded', {})
+    self.expect_self_batch(feed={'data': [post]})
     self.mox.ReplayAll()
     self.assert_equals([activity], self.fb.get_activities(group_id=source.SELF))
 
@@ -1341,22 +1509,17 @@ class FacebookTest(testutil.HandlerTest):
     self.assert_equals([activity], self.fb.get_activities(fetch_replies=True))
 
   def test_get_activities_skips_extras_if_no_posts(self):
-    self.expect_urlopen('me/feed?offset=0', {'data': []})
-    self.expect_urlopen('me/photos/uploaded', {})
+    self.expect_self_batch(feed={'data': []})
     self.mox.ReplayAll()
     self.assert_equals([], self.fb.get_activities(
       group_id=source.SELF, fetch_shares=True, fetch_replies=True))
 
   def test_get_activities_extras_skips_notes_includes_links(self):
     # first call returns just notes
-    self.expect_urlopen('me/feed?offset=0',
-                        {'data': [FB_NOTE, FB_CREATED_NOTE]})
-    self.expect_urlopen('me/photos/uploaded', {})
+    self.expect_self_batch(feed={'data': [FB_NOTE, FB_CREATED_NOTE]})
 
     # second call returns notes and link
-    self.expect_urlopen('me/feed?offset=0',
-                        {'data': [FB_NOTE, FB_CREATED_NOTE, FB_LINK]})
-    self.expect_urlopen('me/photos/uploaded', {})
+    self.expect_self_batch(feed={'data': [FB_NOTE, FB_CREATED_NOTE, FB_LINK]})
     self.expect_urlopen('sharedposts?ids=555', [])
     self.expect_urlopen('comments?filter=stream&ids=555', {})
 
@@ -1368,11 +1531,9 @@ class FacebookTest(testutil.HandlerTest):
         group_id=source.SELF, fetch_shares=True, fetch_replies=True))
 
   def test_get_activities_matches_extras_with_correct_activity(self):
-    self.expect_urlopen('me/feed?offset=0', {'data': [POST]})
-    self.expect_urlopen('me/photos/uploaded', {})
-    self.expect_urlopen('me/events', {'data': [EVENT]})
-    self.expect_urlopen(facebook.API_EVENT % '145304994', EVENT)
-    self.expect_urlopen(facebook.API_EVENT_RSVPS % '145304994', {})
+    self.expect_self_batch(feed={'data': [POST]}, events={'data': [EVENT]})
+    self.expect_rsvps_batch([('145304994', '145304994/invited',
+                              {'code': 200, 'body': {}})])
     self.expect_urlopen('sharedposts?ids=10100176064482163',
                         {'10100176064482163': {'data': [SHARE]}})
     self.expect_urlopen('comments?filter=stream&ids=10100176064482163',
@@ -1385,9 +1546,8 @@ class FacebookTest(testutil.HandlerTest):
       group_id=source.SELF, fetch_events=True, fetch_shares=True, fetch_replies=True))
 
   def test_get_activities_self_fetch_news(self):
-    self.expect_urlopen('me/feed?offset=0', {'data': [POST]})
-    self.expect_urlopen('me/news.publishes', {'data': [FB_NEWS_PUBLISH]})
-    self.expect_urlopen('me/photos/uploaded', {})
+    self.expect_self_batch(feed={'data': [POST]},
+                           news={'data': [FB_NEWS_PUBLISH]})
     # should only fetch sharedposts for POST, not FB_NEWS_PUBLISH
     self.expect_urlopen('sharedposts?ids=10100176064482163', {})
 
@@ -2487,3 +2647,30 @@ cc Sam G, Michael M<br />""", preview.description)
 
     self.assert_equals(resps, self.fb.urlopen_batch_full(
       [{'relative_url': 'abc'}, {'relative_url': 'def'}]))
+
+  def test_urlopen_batch_named(self):
+    self.mox.StubOutWithMock(self.fb, 'urlopen_batch_full')
+    self.fb.urlopen_batch_full([{'name': 'b', 'relative_url': 'b'}]).AndReturn(
+      [{'code': 200, 'body': 'B'}])
+    self.fb.urlopen_batch_full([
+      {'name': 'a', 'relative_url': 'a', 'omit_response_on_success': False},
+      {'name': 'c', 'relative_url': '?ids={result=a:$.data.*.id}'},
+    ]).AndReturn([{'code': 200, 'body': 'A'}, {'code': 400}])
+    self.mox.ReplayAll()
+
+    orig_max_batch_size = facebook.MAX_BATCH_SIZE
+    try:
+      facebook.MAX_BATCH_SIZE = 2
+      got = self.fb.urlopen_batch_named([
+        {'name': 'a', 'relative_url': 'a'},
+        {'name': 'b', 'relative_url': 'b'},
+        {'name': 'c', 'relative_url': '?ids={result=a:$.data.*.id}'},
+      ])
+    finally:
+      facebook.MAX_BATCH_SIZE = orig_max_batch_size
+
+    self.assert_equals({
+      'a': {'code': 200, 'body': 'A'},
+      'b': {'code': 200, 'body': 'B'},
+      'c': {'code': 400},
+    }, got)
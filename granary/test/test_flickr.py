@@ -665,7 +665,19 @@ class FlickrTest(testutil.TestCase):
     super(FlickrTest, self).setUp()
     appengine_config.FLICKR_APP_KEY = 'fake'
     appengine_config.FLICKR_APP_SECRET = 'fake'
+    # don't share cached actors across tests
+    self.orig_actor_cache = flickr.ACTOR_CACHE
+    flickr.ACTOR_CACHE = source.LRUCache(flickr.ACTOR_CACHE_SIZE,
+                                         flickr.ACTOR_CACHE_TTL)
     self.flickr = flickr.Flickr('key', 'secret')
+    # serialize API calls so that mox expectations are deterministic
+    self.orig_max_workers = flickr.MAX_WORKERS
+    flickr.MAX_WORKERS = 1
+
+  def tearDown(self):
+    flickr.MAX_WORKERS = self.orig_max_workers
+    flickr.ACTOR_CACHE = self.orig_actor_cache
+    super(FlickrTest, self).tearDown()
 
   def expect_call_api_method(self, method, params, result):
     full_params = {
@@ -689,6 +701,61 @@ class FlickrTest(testutil.TestCase):
     self.mox.ReplayAll()
     self.assert_equals(ACTOR, self.flickr.get_actor('39216764@N00'))
 
+  def test_get_actor_cached(self):
+    # only fetches the profile page once
+    for expect_profile in True, False:
+      self.expect_call_api_method('flickr.people.getInfo', {
+        'user_id': '39216764@N00'
+      }, json.dumps(PERSON_INFO))
+      if expect_profile:
+        self.expect_urlopen('https://www.flickr.com/people/kindofblue115/',
+                            PROFILE_HTML)
+    self.mox.ReplayAll()
+
+    self.assert_equals(ACTOR, self.flickr.get_actor('39216764@N00'))
+    self.assert_equals(ACTOR, self.flickr.get_actor('39216764@N00'))
+
+  def test_get_actor_external_cache(self):
+    cache = util.CacheDict()
+    self.flickr = flickr.Flickr('key', 'secret', actor_cache=cache)
+    self.expect_call_api_method('flickr.people.getInfo', {
+      'user_id': '39216764@N00'
+    }, json.dumps(PERSON_INFO))
+    self.expect_urlopen('https://www.flickr.com/people/kindofblue115/',
+                        PROFILE_HTML)
+    self.mox.ReplayAll()
+
+    self.assert_equals(ACTOR, self.flickr.get_actor('39216764@N00'))
+    self.assert_equals(ACTOR, cache['AFA 39216764@N00'])
+
+  def test_get_actor_cache_ttls(self):
+    cache = self.mox.CreateMockAnything()
+    self.flickr = flickr.Flickr('key', 'secret', actor_cache=cache)
+    for status, ttl in ((200, flickr.ACTOR_CACHE_TTL),
+                        (500, flickr.ACTOR_CACHE_NEGATIVE_TTL)):
+      cache.get('AFA 39216764@N00').AndReturn(None)
+      self.expect_call_api_method('flickr.people.getInfo', {
+        'user_id': '39216764@N00'
+      }, json.dumps(PERSON_INFO))
+      self.expect_urlopen('https://www.flickr.com/people/kindofblue115/',
+                          PROFILE_HTML, status=status)
+      cache.set_multi({'AFA 39216764@N00': mox.IgnoreArg()}, time=ttl)
+    self.mox.ReplayAll()
+
+    self.assert_equals(ACTOR, self.flickr.get_actor('39216764@N00'))
+    self.flickr.get_actor('39216764@N00')
+
+  def test_get_actor_no_scrape_profiles(self):
+    self.flickr = flickr.Flickr('key', 'secret', scrape_profiles=False)
+    self.expect_call_api_method('flickr.people.getInfo', {
+      'user_id': '39216764@N00'
+    }, json.dumps(PERSON_INFO))
+    self.mox.ReplayAll()
+
+    expected = copy.deepcopy(ACTOR)
+    del expected['url'], expected['urls']
+    self.assert_equals(expected, self.flickr.get_actor('39216764@N00'))
+
   def test_get_actor_default(self):
     # extra call to find the user id
     self.expect_call_api_method(
@@ -719,6 +786,28 @@ class FlickrTest(testutil.TestCase):
     self.mox.ReplayAll()
     self.assert_equals(CONTACTS_PHOTOS_ACTIVITIES, self.flickr.get_activities())
 
+  def test_get_activities_cursor(self):
+    params = {
+      'extras': flickr.Flickr.API_EXTRAS,
+      'per_page': 50,
+    }
+    photos = copy.deepcopy(CONTACTS_PHOTOS)
+    photos['photos'].update({'page': 1, 'pages': 30})
+    self.expect_call_api_method('flickr.photos.getRecent', params,
+                                json.dumps(photos))
+    params['page'] = 2
+    self.expect_call_api_method('flickr.photos.getRecent', params,
+                                json.dumps({'photos': {'page': 30, 'pages': 30}}))
+    self.mox.ReplayAll()
+
+    resp = self.flickr.get_activities_response(group_id=source.ALL)
+    self.assert_equals(CONTACTS_PHOTOS_ACTIVITIES, resp['items'])
+    self.assertEquals({'page': 2}, source.decode_cursor(resp['nextCursor']))
+
+    resp = self.flickr.get_activities_response(group_id=source.ALL,
+                                               cursor=resp['nextCursor'])
+    self.assertNotIn('nextCursor', resp)
+
   def test_get_activities_specific(self):
     self.expect_call_api_method(
       'flickr.photos.getInfo', {
@@ -760,6 +849,170 @@ class FlickrTest(testutil.TestCase):
       [ACTIVITY_WITH_FAVES], self.flickr.get_activities(
         activity_id='5227922370', fetch_likes=True))
 
+  def test_get_activities_skips_unchanged_counts(self):
+    photos = copy.deepcopy(CONTACTS_PHOTOS)
+    first, second = photos['photos']['photo']
+    first.update({'count_comments': '1', 'count_faves': '0'})
+    second.update({'count_comments': '3', 'count_faves': '2'})
+    self.expect_call_api_method(
+      'flickr.photos.getContactsPhotos', {
+        'extras': flickr.Flickr.API_EXTRAS,
+        'per_page': 50,
+      }, json.dumps(photos))
+
+    # first photo's comment count is unchanged and it has no faves. second
+    # photo's comment count changed and its fave count isn't cached.
+    self.expect_call_api_method('flickr.photos.comments.getList', {
+        'photo_id': '2345',
+    }, json.dumps(PHOTO_COMMENTS))
+    self.expect_call_api_method('flickr.photos.getFavorites', {
+        'photo_id': '2345',
+    }, json.dumps(PHOTO_FAVORITES))
+    self.mox.ReplayAll()
+
+    cache = util.CacheDict({'AFR 1234': 1, 'AFR 2345': 2})
+    got = self.flickr.get_activities(fetch_replies=True, fetch_likes=True,
+                                     cache=cache)
+    self.assertNotIn('replies', got[0]['object'])
+    self.assert_equals(1, got[1]['object']['replies']['totalItems'])
+    self.assert_equals(['like'], [t.get('verb') for t in got[1]['object']['tags']
+                                  if t.get('verb')])
+    self.assert_equals({'AFR 1234': 1, 'AFR 2345': 3, 'AFL 2345': 2}, cache)
+
+  def test_get_activities_zero_comments(self):
+    photos = copy.deepcopy(CONTACTS_PHOTOS)
+    for photo in photos['photos']['photo']:
+      photo['count_comments'] = '0'
+    self.expect_call_api_method(
+      'flickr.photos.getContactsPhotos', {
+        'extras': flickr.Flickr.API_EXTRAS,
+        'per_page': 50,
+      }, json.dumps(photos))
+    self.mox.ReplayAll()
+
+    got = self.flickr.get_activities(fetch_replies=True)
+    self.assert_equals([{'totalItems': 0}] * 2,
+                       [a['object']['replies'] for a in got])
+
+  def test_get_activities_self_user_photos_activity(self):
+    photos = copy.deepcopy(CONTACTS_PHOTOS)
+    first, second = photos['photos']['photo']
+    first.update({'count_comments': '0', 'count_faves': '0'})
+    second.update({'count_comments': '1', 'count_faves': '1'})
+    self.expect_call_api_method(
+      'flickr.people.getPhotos', {
+        'extras': flickr.Flickr.API_EXTRAS,
+        'per_page': 50,
+        'user_id': 'me',
+      }, json.dumps(photos))
+    self.expect_call_api_method('flickr.activity.userPhotos', {
+      'timeframe': flickr.USER_PHOTOS_TIMEFRAME,
+      'per_page': 50,
+    }, json.dumps({
+      'items': {'item': [{
+        'type': 'photo',
+        'id': '2345',
+        'activity': {'event': [{
+          'type': 'comment',
+          'commentid': '4942564-2345-72157625845945286',
+          'user': '36398523@N00',
+          'username': 'if winter ends',
+          'dateadded': '1293649344',
+          '_content': 'Nice!',
+        }, {
+          'type': 'fave',
+          'user': '95922884@N00',
+          'username': 'absentmindedprof',
+          'realname': 'Jennifer',
+          'dateadded': '1291599546',
+        }]},
+      }, {
+        'type': 'photo',
+        'id': '9999',  # not in this page of photos
+        'activity': {'event': [{'type': 'fave', 'user': '123'}]},
+      }]},
+      'stat': 'ok',
+    }))
+    self.mox.ReplayAll()
+
+    cache = util.CacheDict()
+    got = self.flickr.get_activities(group_id=source.SELF, fetch_replies=True,
+                                     fetch_likes=True, cache=cache)
+    self.assert_equals({'totalItems': 0}, got[0]['object']['replies'])
+    replies = got[1]['object']['replies']
+    self.assert_equals(1, replies['totalItems'])
+    self.assert_equals('Nice!', replies['items'][0]['content'])
+    self.assert_equals('https://www.flickr.com/photos/6666/2345/'
+                       '#comment4942564-2345-72157625845945286',
+                       replies['items'][0]['url'])
+    likes = [t for t in got[1]['object']['tags'] if t.get('verb') == 'like']
+    self.assert_equals(['Jennifer'], [l['author']['displayName'] for l in likes])
+    self.assert_equals({'AFR 1234': 0, 'AFL 1234': 0, 'AFR 2345': 1,
+                        'AFL 2345': 1}, cache)
+
+  def test_get_activities_self_user_photos_activity_paging_and_fallback(self):
+    photos = copy.deepcopy(CONTACTS_PHOTOS)
+    first, second = photos['photos']['photo']
+    # first photo has an older comment outside the timeframe. second photo's
+    # fave is on the second page.
+    first.update({'count_comments': '2', 'count_faves': '0'})
+    second.update({'count_comments': '0', 'count_faves': '1'})
+    self.expect_call_api_method(
+      'flickr.people.getPhotos', {
+        'extras': flickr.Flickr.API_EXTRAS,
+        'per_page': 50,
+        'user_id': 'me',
+      }, json.dumps(photos))
+    self.expect_call_api_method('flickr.activity.userPhotos', {
+      'timeframe': flickr.USER_PHOTOS_TIMEFRAME,
+      'per_page': 50,
+    }, json.dumps({
+      'items': {'page': 1, 'pages': 2, 'item': [{
+        'type': 'photo',
+        'id': '1234',
+        'activity': {'event': [{
+          'type': 'comment',
+          'commentid': '4942564-1234-72157625845945286',
+          'user': '36398523@N00',
+          '_content': 'Nice!',
+        }]},
+      }]},
+      'stat': 'ok',
+    }))
+    self.expect_call_api_method('flickr.activity.userPhotos', {
+      'timeframe': flickr.USER_PHOTOS_TIMEFRAME,
+      'per_page': 50,
+      'page': 2,
+    }, json.dumps({
+      'items': {'page': 2, 'pages': 2, 'item': [{
+        'type': 'photo',
+        'id': '2345',
+        'activity': {'event': [{
+          'type': 'fave',
+          'user': '95922884@N00',
+          'username': 'absentmindedprof',
+          'realname': 'Jennifer',
+        }]},
+      }]},
+      'stat': 'ok',
+    }))
+    # only the first photo's comments are incomplete
+    self.expect_call_api_method('flickr.photos.comments.getList', {
+        'photo_id': '1234',
+    }, json.dumps(PHOTO_COMMENTS))
+    self.mox.ReplayAll()
+
+    cache = util.CacheDict()
+    got = self.flickr.get_activities(group_id=source.SELF, fetch_replies=True,
+                                     fetch_likes=True, cache=cache)
+    self.assert_equals(1, got[0]['object']['replies']['totalItems'])
+    self.assertNotIn('Nice!', json.dumps(got[0]))
+    self.assert_equals({'totalItems': 0}, got[1]['object']['replies'])
+    likes = [t for t in got[1]['object']['tags'] if t.get('verb') == 'like']
+    self.assert_equals(['Jennifer'], [l['author']['displayName'] for l in likes])
+    self.assert_equals({'AFR 1234': 2, 'AFL 1234': 0, 'AFR 2345': 0,
+                        'AFL 2345': 1}, cache)
+
   def test_favorite_without_display_name(self):
     """Make sure faves fall back to the username if the user did not
     supply a real name.
@@ -28,6 +28,7 @@ from granary import appengine_config
 appengine_config.GOOGLE_CLIENT_ID = 'my client id'
 appengine_config.GOOGLE_CLIENT_SECRET = 'my client secret'
 from granary import googleplus
+from granary import source
 
 
 DISCOVERY_DOC = appengine_config.read(
@@ -444,6 +445,15 @@ class GooglePlusTest(testutil.HandlerTest):
       fetch_replies=True, fetch_likes=True, fetch_shares=True)
     self.assertEquals('"my etag"', resp['etag'])
 
+  def test_get_activities_cursor(self):
+    self.init(requestBuilder=http.RequestMockBuilder({
+          'plus.activities.list': (httplib2.Response({'status': 200}),
+                                   json.dumps({'nextPageToken': 'xyz'})),
+          }))
+    resp = self.googleplus.get_activities_response()
+    self.assertEquals({'pageToken': 'xyz'},
+                      source.decode_cursor(resp['nextCursor']))
+
   def test_get_activities_304_not_modified(self):
     """Requests with matching ETags return 304 Not Modified."""
     self.init(requestBuilder=http.RequestMockBuilder({
@@ -9,6 +9,7 @@ import json
 import logging
 import mox
 import StringIO
+import threading
 import urllib
 import urllib2
 import httplib2
@@ -779,6 +780,13 @@ class InstagramTest(testutil.HandlerTest):
   def setUp(self):
     super(InstagramTest, self).setUp()
     self.instagram = instagram.Instagram()
+    # fetch post pages serially so that mox expectations are deterministic
+    self.orig_max_workers = instagram.MAX_WORKERS
+    instagram.MAX_WORKERS = 1
+
+  def tearDown(self):
+    instagram.MAX_WORKERS = self.orig_max_workers
+    super(InstagramTest, self).tearDown()
 
   def test_get_actor(self):
     self.expect_urlopen('https://api.instagram.com/v1/users/foo',
@@ -946,6 +954,90 @@ class InstagramTest(testutil.HandlerTest):
       'AIL 789_456': 9,
     }, cache)
 
+  def test_get_activities_scrape_fetch_extras_concurrent(self):
+    instagram.MAX_WORKERS = 5
+    profile = copy.deepcopy(HTML_PROFILE)
+    pages = {
+      'https://www.instagram.com/x/': HTML_PROFILE_COMPLETE,
+      'https://www.instagram.com/p/ABC123/': HTML_PHOTO_COMPLETE,
+      'https://www.instagram.com/p/XYZ789/': HTML_VIDEO_COMPLETE,
+    }
+    requested = []
+    running = [0, 0]  # current, max
+    lock = threading.Lock()
+
+    def requests_get(url, **kwargs):
+      with lock:
+        requested.append((url, kwargs.get('headers')))
+        running[0] += 1
+        running[1] = max(running)
+      resp = requests.Response()
+      resp.encoding = 'utf-8'
+      if 'If-None-Match' in kwargs.get('headers', {}):
+        resp.status_code = 304
+      else:
+        resp.status_code = 200
+        resp._content = pages[url]
+        resp.headers['ETag'] = '"%s"' % url
+      with lock:
+        running[0] -= 1
+      return resp
+
+    self.instagram._requests_get = requests_get
+    cache = util.CacheDict()
+    self.assert_equals(HTML_ACTIVITIES_FULL, self.instagram.get_activities(
+      user_id='x', group_id=source.SELF, fetch_likes=True, fetch_replies=True,
+      scrape=True, cache=cache))
+    self.assertLessEqual(running[1], source.MAX_REQUESTS_PER_DOMAIN)
+    self.assert_equals('"https://www.instagram.com/p/XYZ789/"',
+                       cache['AIP XYZ789']['etag'])
+
+    # both posts' comment counts change, but their pages haven't, so the
+    # conditional requests get 304s and we use the cached activities
+    for node in profile['entry_data']['ProfilePage'][0]['user']['media']['nodes']:
+      node['comments']['count'] = 7
+    pages['https://www.instagram.com/x/'] = (
+      HTML_HEADER + json.dumps(profile) + HTML_FOOTER)
+    del requested[:]
+
+    self.assert_equals(HTML_ACTIVITIES_FULL, self.instagram.get_activities(
+      user_id='x', group_id=source.SELF, fetch_likes=True, fetch_replies=True,
+      scrape=True, cache=cache))
+    self.assertItemsEqual([
+      ('https://www.instagram.com/x/', None),
+      ('https://www.instagram.com/p/ABC123/',
+       {'If-None-Match': '"https://www.instagram.com/p/ABC123/"'}),
+      ('https://www.instagram.com/p/XYZ789/',
+       {'If-None-Match': '"https://www.instagram.com/p/XYZ789/"'}),
+    ], requested)
+    self.assert_equals(7, cache['AIC 789_456'])
+
+  def test_scrape_media_page_validators(self):
+    url = 'https://www.instagram.com/p/ABC123/'
+    self.mox.StubOutWithMock(self.instagram, '_requests_get')
+
+    changed = requests.Response()
+    changed.status_code = 200
+    changed._content = HTML_PHOTO_COMPLETE
+    changed.encoding = 'utf-8'
+    changed.headers['ETag'] = '"abc"'
+    self.instagram._requests_get(url).AndReturn(changed)
+
+    unchanged = requests.Response()
+    unchanged.status_code = 304
+    self.instagram._requests_get(url, headers={'If-None-Match': '"abc"'}
+                                 ).AndReturn(unchanged)
+    self.mox.ReplayAll()
+
+    activity, page = self.instagram._scrape_media_page(url)
+    self.assert_equals(HTML_PHOTO_ACTIVITY_FULL, activity)
+    self.assert_equals({'etag': '"abc"', 'activity': HTML_PHOTO_ACTIVITY_FULL},
+                       page)
+
+    # second time, page hasn't changed, so we use the cached activity
+    self.assert_equals((HTML_PHOTO_ACTIVITY_FULL, None),
+                       self.instagram._scrape_media_page(url, cached_page=page))
+
   def test_get_activities_scrape_missing_data(self):
     self.expect_requests_get('https://www.instagram.com/x/', """
 <!DOCTYPE html>
@@ -487,3 +487,18 @@ foo
         }),
     ):
       self.assertEquals(expected, microformats2.object_urls(actor))
+
+  def test_html_to_activities_parsed(self):
+    html = """\
+<div class="h-feed">
+<article class="h-entry"><div class="e-content">foo</div></article>
+</div>"""
+    expected = microformats2.html_to_activities(html, url='http://x')
+    self.assertEquals(1, len(expected))
+    parsed = mf2py.parse(doc=html, url='http://x')
+
+    # shouldn't parse again
+    self.mox.StubOutWithMock(mf2py, 'parse')
+    self.mox.ReplayAll()
+    self.assert_equals(expected, microformats2.html_to_activities(
+      None, url='http://x', parsed=parsed))
@@ -4,7 +4,16 @@
 
 __author__ = ['Ryan Barrett <granary@ryanb.org>']
 
+import collections
 import copy
+import json
+import mox
+import socket
+import threading
+import time
+import urllib2
+
+import requests
 
 from oauth_dropins.webutil import testutil
 from oauth_dropins.webutil import util
@@ -205,6 +214,270 @@ class SourceTest(testutil.TestCase):
     check(obj, ['http://or.ig/post/redirected', 'http://other/link/redirected'],
           include_redirect_sources=False)
 
+  def test_original_post_discovery_multi(self):
+    # each distinct URL should only be resolved once
+    self.expect_requests_head('http://other/link',
+                              redirected_url='http://other/link/redirected')
+    self.expect_requests_head('http://sho.rt/post',
+                              redirected_url='http://or.ig/post/redirected')
+    self.mox.ReplayAll()
+
+    activities = [
+      {'object': {'content': 'asdf http://other/link qwert',
+                  'upstreamDuplicates': ['http://sho.rt/post']}},
+      {'object': {'content': 'x http://sho.rt/post y'}},
+      {'object': {'content': 'no links'}},
+    ]
+    got = Source.original_post_discovery_multi(activities, domains=['or.ig'],
+                                               max_workers=1)
+    self.assertEquals(3, len(got))
+
+    originals = ['http://sho.rt/post', 'http://or.ig/post/redirected']
+    self.assertItemsEqual(originals, got[0][0])
+    self.assertItemsEqual(['http://other/link', 'http://other/link/redirected'],
+                          got[0][1])
+    self.assertItemsEqual(originals, got[1][0])
+    self.assertItemsEqual([], got[1][1])
+    self.assertEquals((set(), set()), got[2])
+
+  def test_redirect_cache(self):
+    cache = source.RedirectCache(max_size=2)
+    self.assertIsNone(cache.get('a'))
+    cache.set_multi({'a': 1, 'b': 2})
+    self.assertEquals(1, cache.get('a'))
+    self.assertEquals({'a': 1, 'b': 2}, cache.get_multi(['a', 'b', 'c']))
+    self.assertEquals((3, 2), (cache.hits, cache.misses))
+
+    # b is least recently used, so it gets evicted
+    cache.get('a')
+    cache.set_multi({'c': 3})
+    self.assertEquals({'a': 1, 'c': 3}, cache.get_multi(['a', 'b', 'c']))
+
+    cache.delete_multi(['a'])
+    self.assertIsNone(cache.get('a'))
+
+  def test_redirect_cache_negative_ttl(self):
+    cache = source.RedirectCache(ttl=1000, negative_ttl=0)
+
+    html = requests.Response()
+    html.status_code = 200
+    html.headers['content-type'] = 'text/html'
+    image = requests.Response()
+    image.status_code = 200
+    image.headers['content-type'] = 'image/jpeg'
+    # what util.follow_redirects() returns when the fetch fails
+    failed = requests.Response()
+    failed.status_code = 499
+    failed.headers['content-type'] = 'text/html'
+
+    cache.set_multi({'R html': html, 'R image': image, 'R failed': failed})
+    # time doesn't make a value negative, and can't extend negative_ttl
+    cache.set_multi({'R x': html, 'R y': image}, time=60)
+    self.assertEquals({'R html': html, 'R x': html}, cache.get_multi(
+      ['R html', 'R image', 'R failed', 'R x', 'R y']))
+
+  def test_lru_cache_negative_ttl(self):
+    cache = source.LRUCache(10, 1000, negative_ttl=0)
+    html = requests.Response()
+    html.headers['content-type'] = 'text/html'
+    # only RedirectCache treats responses specially
+    cache.set_multi({'a': 1, 'resp': html})
+    cache.set_multi({'b': 2}, time=60)
+    self.assertEquals({'a': 1, 'resp': html, 'b': 2},
+                      cache.get_multi(['a', 'resp', 'b']))
+
+  def test_lru_cache_time(self):
+    class FakeTime(object):
+      now = 1000
+      @classmethod
+      def time(cls):
+        return cls.now
+
+    backend = self.mox.CreateMockAnything()
+    backend.set_multi({'a': 1}, time=60)
+    backend.set_multi({'b': 2})
+    # a expires locally before b, so it checks the backend
+    backend.get('a').AndReturn(None)
+    self.mox.ReplayAll()
+
+    orig_time = source.time
+    source.time = FakeTime
+    try:
+      cache = source.LRUCache(10, 100, backend=backend)
+      cache.set_multi({'a': 1}, time=60)
+      cache.set_multi({'b': 2})
+      FakeTime.now += 80
+      self.assertIsNone(cache.get('a'))
+      self.assertEquals(2, cache.get('b'))
+    finally:
+      source.time = orig_time
+
+  def test_redirect_cache_backend(self):
+    backend = self.mox.CreateMockAnything()
+    backend.get('a').AndReturn(1)
+    backend.set_multi({'b': 2})
+    backend.delete_multi(['a', 'b'])
+    backend.get('b').AndReturn(None)
+    self.mox.ReplayAll()
+
+    cache = source.RedirectCache(backend=backend)
+    self.assertEquals(1, cache.get('a'))
+    self.assertEquals((0, 1), (cache.hits, cache.misses))
+    self.assertEquals(1, cache.get('a'))
+    self.assertEquals((1, 1), (cache.hits, cache.misses))
+
+    cache.set_multi({'b': 2})
+    cache.delete_multi(['a', 'b'])
+    self.assertIsNone(cache.get('b'))
+
+  def test_original_post_discovery_redirect_cache(self):
+    self.expect_requests_head('http://sho.rt/post',
+                              redirected_url='http://or.ig/post/redirected')
+    self.mox.ReplayAll()
+
+    cache = source.RedirectCache()
+    obj = {'upstreamDuplicates': ['http://sho.rt/post']}
+    originals = ['http://sho.rt/post', 'http://or.ig/post/redirected']
+    for i in range(2):
+      self.check_original_post_discovery(obj, originals, cache=cache)
+    self.assertEquals(1, cache.hits)
+
+  def test_sync_state(self):
+    state = source.SyncState(min_id='5', etag='"x"')
+    state.set_multi({'ATR 1': 2, 'ATF 1': 3})
+    self.assertEquals({'ATR 1': 2}, state.get_multi(['ATR 1', 'ATR 2']))
+    state.delete_multi(['ATF 1'])
+    self.assertIsNone(state.get('ATF 1'))
+
+    copied = source.SyncState.from_json(state.to_json())
+    self.assertEquals(json.loads(state.to_json()), json.loads(copied.to_json()))
+    self.assertEquals(('5', '"x"', {'ATR 1': 2}),
+                      (copied.min_id, copied.etag, copied.counts))
+
+  def test_sync_state_prune(self):
+    state = source.SyncState(counts={'ATR 1': 2, 'ATR 2': 3, 'ATR 3': 4})
+    state.get_multi(key for key in ['ATR 1', 'ATR 9'])
+    state.set_multi({'ATF 1': 5})
+    state.prune()
+    self.assertEquals({'ATR 1': 2, 'ATF 1': 5}, state.counts)
+
+    # nothing was used since the last prune
+    state.prune()
+    self.assertEquals({}, state.counts)
+
+  def test_poll(self):
+    # Instagram ids are MEDIA_USER
+    self.source = instagram.Instagram()
+    self.mox.StubOutWithMock(self.source, 'get_activities_response')
+    first = [{'id': 'tag:fa.ke:3_9', 'content': 'a'},
+             {'id': 'tag:fa.ke:12_9', 'content': 'b'}]
+    self.source.get_activities_response(
+      etag=None, min_id=None, cache=mox.IsA(source.SyncState), count=5
+    ).AndReturn({'items': first, 'etag': '"e1"'})
+
+    # second poll: one activity changed, one is new
+    second = copy.deepcopy(first)
+    second[0]['content'] = 'changed'
+    second.append({'id': 'tag:fa.ke:20_9'})
+    self.source.get_activities_response(
+      etag='"e1"', min_id='12_9', cache=mox.IsA(source.SyncState), count=5
+    ).AndReturn({'items': second})
+
+    # third poll fetches replies, so no min_id. nothing changed.
+    self.source.get_activities_response(
+      etag='"e1"', min_id=None, cache=mox.IsA(source.SyncState), count=5,
+      fetch_replies=True).AndReturn({'items': []})
+    self.mox.ReplayAll()
+
+    got, state = self.source.poll(count=5)
+    self.assertEquals(first, got)
+    self.assertEquals('12_9', state.min_id)
+    self.assertEquals('"e1"', state.etag)
+
+    got, new_state = self.source.poll(state, count=5)
+    self.assertEquals([second[0], second[2]], got)
+    self.assertEquals('20_9', new_state.min_id)
+    self.assertEquals('12_9', state.min_id)  # original isn't modified
+
+    got, newer_state = self.source.poll(new_state, count=5, fetch_replies=True)
+    self.assertEquals([], got)
+    self.assertEquals(new_state.seen, newer_state.seen)
+
+  def test_poll_prunes_counts(self):
+    self.mox.StubOutWithMock(self.source, 'get_activities_response')
+
+    def get_activities_response(cache=None, **kwargs):
+      cache.get_multi(['AIL 2'])
+      cache.set_multi({'AIL 3': 1})
+      return {'items': [{'id': 'tag:fa.ke:2'}, {'id': 'tag:fa.ke:3'}]}
+
+    self.source.get_activities_response(
+      etag=None, min_id=None, cache=mox.IsA(source.SyncState)
+    ).WithSideEffects(get_activities_response).AndReturn(
+      get_activities_response(cache=source.SyncState()))
+    self.mox.ReplayAll()
+
+    state = source.SyncState(counts={'AIL 1': 4, 'AIL 2': 5})
+    _, state = self.source.poll(state)
+    self.assertEquals({'AIL 2': 5, 'AIL 3': 1}, state.counts)
+    # the base class doesn't know how to compare ids
+    self.assertIsNone(state.min_id)
+
+  def test_poll_min_id(self):
+    fb = facebook.Facebook()
+    self.assertIsNone(fb.min_id_key('12_34'))
+    self.assertEquals({'min_id': '5'}, fb.poll_min_id_kwargs('5', False))
+    self.assertEquals({'min_id': None}, fb.poll_min_id_kwargs('5', True))
+
+    tw = twitter.Twitter('key', 'secret')
+    self.assertEquals(567, tw.min_id_key('567'))
+    self.assertIsNone(tw.min_id_key('567_favorited_by_8'))
+    self.assertEquals({'min_id': '5', 'timeline_min_id': True},
+                      tw.poll_min_id_kwargs('5', False))
+    self.assertEquals({'min_id': '5', 'timeline_min_id': False},
+                      tw.poll_min_id_kwargs('5', True))
+
+    self.assertEquals(12, instagram.Instagram.min_id_key('12_34'))
+
+  def test_actor_memo(self):
+    converted = []
+
+    class MemoSource(FakeSource):
+      @source.memoized_actor
+      def user_to_actor(self, user):
+        converted.append(user)
+        return {'id': user['id'], 'name': user.get('name'),
+                'image': {'url': 'http://pic/%s' % user['id']}}
+
+      @source.with_actor_memo
+      def convert(self, users):
+        with self.actor_memo():  # nested blocks share the outer memo
+          return [self.user_to_actor(u) for u in users]
+
+    src = MemoSource()
+    alice = {'id': '1', 'name': 'alice'}
+    renamed = {'id': '1', 'name': 'al'}
+    bob = {'id': '2', 'name': 'bob'}
+    got = src.convert([alice, bob, dict(alice), renamed, bob])
+    self.assertEquals([alice, bob, renamed], converted)
+    self.assertEquals(['alice', 'bob', 'alice', 'al', 'bob'],
+                      [a['name'] for a in got])
+    self.assertEquals(got[0], got[2])
+    self.assertIsNot(got[0], got[2])
+    self.assertIsNone(src._actor_memo)
+
+    # memoized actors are copied, so modifying one doesn't affect the others
+    got = src.convert([bob, bob, bob])
+    got[0]['name'] = 'robert'
+    got[1]['image']['url'] = 'http://other/pic'
+    self.assertEquals({'id': '2', 'name': 'bob',
+                       'image': {'url': 'http://pic/2'}}, got[2])
+
+    # outside a memo block, every call converts
+    src.user_to_actor(alice)
+    src.user_to_actor(alice)
+    self.assertEquals(6, len(converted))
+
   def test_get_like(self):
     self.source.get_activities(user_id='author', activity_id='activity',
                                fetch_likes=True).AndReturn([ACTIVITY])
@@ -370,6 +643,154 @@ class SourceTest(testutil.TestCase):
     self.assertEquals('xyz', source.strip_html_tags(
       '<p>x<a href="l">y</a><br />z</p>'))
 
+  def test_cursor(self):
+    for params in {}, {'max_id': '99'}, {'until': '1400', '__paging_token': 'x/y'}:
+      cursor = source.encode_cursor(params)
+      self.assertNotIn('=', cursor)
+      self.assertEquals(params, source.decode_cursor(cursor))
+
+    for bad in '', 'xyz', '%%%', u'\xe9', source.encode_cursor([1]):
+      with self.assertRaises(ValueError):
+        source.decode_cursor(bad)
+
+  def test_extract_json(self):
+    html = u'<p>x</p><script>var d = {"a": [1, "b"]};</script><p>y</p>'
+    self.assertEquals({'a': [1, 'b']}, source.extract_json(html, 'var d ='))
+    self.assertIsNone(source.extract_json(html, 'var e ='))
+    with self.assertRaises(ValueError):
+      source.extract_json(html, '<p>')
+
+  def test_extract_json_sparse(self):
+    html = u'<script>f([,, 1,[ ,"x",,], ,]);</script>'
+    self.assertEquals([None, None, 1, [None, 'x', None, None], None, None],
+                      source.extract_json(html, '<script>f(', suffix=');</script>',
+                                          sparse=True))
+    self.assertIsNone(source.extract_json(html, '<script>f(', suffix='nope',
+                                          sparse=True))
+
+  def test_run_concurrently(self):
+    self.assertEquals([], source.run_concurrently(lambda x: x, []))
+    for max_workers in 1, 2, 10:
+      self.assertEquals(
+        [0, 2, 4, 6, 8],
+        source.run_concurrently(lambda x: x * 2, range(5), max_workers=max_workers))
+
+  def test_run_concurrently_serial_uses_current_thread(self):
+    current = threading.current_thread()
+    self.assertEquals(
+      [current] * 3,
+      source.run_concurrently(lambda _: threading.current_thread(), range(3),
+                              max_workers=1))
+
+  def test_run_concurrently_raises(self):
+    def fn(x):
+      if x % 2:
+        raise ValueError(x)
+      return x
+
+    with self.assertRaises(ValueError) as cm:
+      source.run_concurrently(fn, range(6), max_workers=3)
+    self.assertEquals((1,), cm.exception.args)
+
+  def test_run_concurrently_per_domain(self):
+    urls = (['http://a.com/%d' % i for i in range(6)] +
+            ['http://b.com/1', 'http://c.com/1'])
+    lock = threading.Lock()
+    running = collections.Counter()
+    max_running = collections.Counter()
+    threads = set()
+
+    def fn(url):
+      domain = util.domain_from_link(url)
+      with lock:
+        threads.add(threading.current_thread())
+        running[domain] += 1
+        max_running[domain] = max(max_running[domain], running[domain])
+      time.sleep(.01)
+      with lock:
+        running[domain] -= 1
+      return url
+
+    self.assertEquals(urls, source.run_concurrently(
+      fn, urls, max_workers=10, per_domain=lambda url: url))
+    self.assertEquals({'a.com': 2, 'b.com': 1, 'c.com': 1}, max_running)
+    # only starts as many threads as the per domain limits allow
+    self.assertLessEqual(len(threads), 4)
+
+    threads.clear()
+    max_running.clear()
+    source.run_concurrently(fn, urls[:6], max_workers=10,
+                            per_domain=lambda url: url, max_per_domain=1)
+    self.assertEquals({'a.com': 1}, max_running)
+    self.assertEquals(1, len(threads))
+
+  def _pool_response(self, status=200, content='', headers=None):
+    resp = requests.Response()
+    resp.status_code = status
+    resp.reason = 'reason'
+    resp._content = content
+    resp.headers = requests.structures.CaseInsensitiveDict(headers or {})
+    resp.url = 'http://x/y'
+    return resp
+
+  def test_http_pool_urlopen(self):
+    pool = source.HttpPool()
+    self.mox.StubOutWithMock(pool.session, 'request')
+    pool.session.request('GET', 'http://x/y', data=None, headers={'A': 'b'},
+                         timeout=util.HTTP_TIMEOUT).AndReturn(
+      self._pool_response(content='foo', headers={'ETag': '"xyz"'}))
+    self.mox.ReplayAll()
+
+    resp = pool.urlopen('http://x/y', headers={'A': 'b'})
+    self.assertEquals(200, resp.getcode())
+    self.assertEquals('"xyz"', resp.info().get('etag'))
+    self.assertEquals('foo', resp.read())
+
+  def test_http_pool_urlopen_request_post(self):
+    pool = source.HttpPool()
+    self.mox.StubOutWithMock(pool.session, 'request')
+    pool.session.request('POST', 'http://x/y', data='a=b', headers={'Foo': 'bar'},
+                         timeout=util.HTTP_TIMEOUT).AndReturn(self._pool_response())
+    self.mox.ReplayAll()
+
+    req = urllib2.Request('http://x/y', data='a=b', headers={'Foo': 'bar'})
+    self.assertEquals(200, pool.urlopen(req).getcode())
+
+  def test_http_pool_urlopen_errors(self):
+    pool = source.HttpPool()
+    self.mox.StubOutWithMock(pool.session, 'request')
+    pool.session.request('GET', 'http://x/y', data=None, headers=None,
+                         timeout=util.HTTP_TIMEOUT).AndReturn(
+      self._pool_response(status=404, content='not found'))
+    pool.session.request('GET', 'http://x/y', data=None, headers=None,
+                         timeout=util.HTTP_TIMEOUT).AndRaise(
+      requests.exceptions.ConnectionError('foo'))
+    pool.session.request('GET', 'http://x/y', data=None, headers=None,
+                         timeout=util.HTTP_TIMEOUT).AndRaise(
+      requests.exceptions.Timeout('foo'))
+    self.mox.ReplayAll()
+
+    with self.assertRaises(urllib2.HTTPError) as cm:
+      pool.urlopen('http://x/y')
+    self.assertEquals(404, cm.exception.code)
+    self.assertEquals('not found', cm.exception.read())
+
+    with self.assertRaises(urllib2.URLError):
+      pool.urlopen('http://x/y')
+    with self.assertRaises(socket.timeout):
+      pool.urlopen('http://x/y')
+
+  def test_urlopen_uses_http_pool(self):
+    self.source.http_pool = self.mox.CreateMock(source.HttpPool)
+    self.source.http_pool.urlopen('http://x/y').AndReturn('resp')
+    self.source.http_pool.requests_get('http://x/z', allow_redirects=False
+                                       ).AndReturn('resp 2')
+    self.mox.ReplayAll()
+
+    self.assertEquals('resp', self.source._urlopen('http://x/y'))
+    self.assertEquals('resp 2', self.source._requests_get(
+      'http://x/z', allow_redirects=False))
+
   def test_is_public(self):
     for obj in ({'to': [{'objectType': 'unknown'}]},
                 {'to': [{'objectType': 'unknown'},
@@ -0,0 +1,76 @@
+"""Unit tests for times.py."""
+
+import os
+import time
+
+from oauth_dropins.webutil import testutil
+from oauth_dropins.webutil import util
+
+from granary import times
+
+
+class TimesTest(testutil.TestCase):
+
+  def test_tzinfo(self):
+    self.assertIs(times.UTC, times.tzinfo(0))
+    self.assertIs(times.tzinfo(-3600), times.tzinfo(-3600))
+
+  def test_rfc2822_to_iso8601(self):
+    for _ in range(2):  # second time is cached
+      for input, expected in (
+          (None, None),
+          ('Wed May 23 06:01:13 +0000 2007', '2007-05-23T06:01:13+00:00'),
+          ('Sun Feb 29 23:59:59 -0530 2004', '2004-02-29T23:59:59-05:30'),
+          # not the exact format, handled by strptime
+          ('Mon Jan 1 00:00:00 +0130 2010', '2010-01-01T00:00:00+01:30'),
+        ):
+        self.assertEquals(expected, times.rfc2822_to_iso8601(input))
+
+  def test_iso8601_to_rfc3339(self):
+    for input in (None, '', 'asdf', '2012-03-04T18:20:37+0000',
+                  '2015-11-15T09:58:35-0800', '2012-03-04T18:20:37Z',
+                  '2012-03-04 18:20:37', '2012-02-30T18:20:37+0000'):
+      self.assertEquals(util.maybe_iso8601_to_rfc3339(input),
+                        times.iso8601_to_rfc3339(input))
+
+    self.assertEquals('2015-11-15T09:58:35-08:00',
+                      times.iso8601_to_rfc3339('2015-11-15T09:58:35-0800'))
+
+  def test_timestamp_to_rfc3339(self):
+    for input in (None, '', 'asdf', '1291338921', 1291338921, '1291338921.5',
+                  1291338921.5):
+      self.assertEquals(util.maybe_timestamp_to_rfc3339(input),
+                        times.timestamp_to_rfc3339(input))
+
+    self.assertEquals('2010-12-03T01:15:21',
+                      times.timestamp_to_rfc3339('1291338921'))
+
+  def test_timestamp_to_rfc3339_local_time(self):
+    orig_tz = os.environ.get('TZ')
+    os.environ['TZ'] = 'America/Los_Angeles'
+    time.tzset()
+    try:
+      # not used elsewhere, so it's not memoized in UTC
+      self.assertEquals('2010-12-02T17:00:00',
+                        times.timestamp_to_rfc3339('1291338000'))
+      self.assertEquals(util.maybe_timestamp_to_rfc3339('1291338000'),
+                        times.timestamp_to_rfc3339('1291338000'))
+    finally:
+      if orig_tz is None:
+        del os.environ['TZ']
+      else:
+        os.environ['TZ'] = orig_tz
+      time.tzset()
+
+  def test_ms_timestamp_to_iso8601(self):
+    self.assertEquals('2015-08-24T14:11:53Z',
+                      times.ms_timestamp_to_iso8601(1440425513000))
+
+  def test_convert_multi(self):
+    calls = []
+    def convert(input):
+      calls.append(input)
+      return input * 2
+
+    self.assertEquals([2, 4, 2, 2.0], times.convert_multi(convert, [1, 2, 1, 1.0]))
+    self.assertEquals([1, 2, 1.0], calls)
@@ -8,6 +8,7 @@ import json
 import mox
 import requests
 import socket
+import StringIO
 import urllib
 import urllib2
 
@@ -576,11 +577,15 @@ class TwitterTest(testutil.TestCase):
     appengine_config.TWITTER_APP_SECRET = 'fake'
     self.orig_max_tweet_length = twitter.MAX_TWEET_LENGTH
     self.orig_tco_length = twitter.TCO_LENGTH
+    self.orig_max_workers = twitter.MAX_WORKERS
+    # mox expects HTTP requests in order, so make them serially
+    twitter.MAX_WORKERS = 1
     self.twitter = twitter.Twitter('key', 'secret')
 
   def tearDown(self):
     twitter.MAX_TWEET_LENGTH = self.orig_max_tweet_length
     twitter.TCO_LENGTH = self.orig_tco_length
+    twitter.MAX_WORKERS = self.orig_max_workers
 
   def expect_urlopen(self, url, response=None, params=None, **kwargs):
     if not url.startswith('http'):
@@ -616,6 +621,33 @@ class TwitterTest(testutil.TestCase):
     self.assert_equals([ACTIVITY_2],
                        self.twitter.get_activities(start_index=1, count=1))
 
+  def test_get_activities_cursor(self):
+    self.expect_urlopen('statuses/home_timeline.json?include_entities=true&count=2',
+                        [TWEET])
+    self.expect_urlopen('statuses/home_timeline.json?include_entities=true&count=2'
+                        '&max_id=99', [TWEET_2])
+    self.mox.ReplayAll()
+
+    resp = self.twitter.get_activities_response(count=2)
+    self.assert_equals([ACTIVITY], resp['items'])
+    self.assert_equals({'max_id': '99'}, source.decode_cursor(resp['nextCursor']))
+
+    # start_index is ignored with a cursor
+    resp = self.twitter.get_activities_response(
+      count=2, start_index=5, cursor=resp['nextCursor'])
+    self.assert_equals([ACTIVITY_2], resp['items'])
+
+  def test_get_activities_cursor_non_numeric_id(self):
+    tweet = copy.deepcopy(TWEET)
+    tweet['id_str'] = '100_b'
+    self.expect_urlopen('statuses/home_timeline.json?include_entities=true&count=2',
+                        [tweet])
+    self.mox.ReplayAll()
+
+    resp = self.twitter.get_activities_response(count=2)
+    self.assertEquals(1, len(resp['items']))
+    self.assertNotIn('nextCursor', resp)
+
   def test_get_activities_activity_id(self):
     self.expect_urlopen('statuses/show.json?id=000&include_entities=true', TWEET)
     self.mox.ReplayAll()
@@ -687,6 +719,24 @@ class TwitterTest(testutil.TestCase):
     self.assert_equals([ACTIVITY_WITH_REPLIES],
                        self.twitter.get_activities(fetch_replies=True, min_id='567'))
 
+  def test_fetch_replies_shares_searches_across_activities(self):
+    # each author should only be searched once
+    for user, replies in (('snarfed_org', REPLIES_TO_SNARFED),
+                          ('alice', REPLIES_TO_ALICE),
+                          ('bob', REPLIES_TO_BOB)):
+      self.expect_urlopen('search/tweets.json?q=%%40%s&include_entities=true&result_type=recent&count=100' % user,
+                          replies)
+    self.mox.ReplayAll()
+
+    other = copy.deepcopy(ACTIVITY)
+    other['id'] = tag_uri('999')
+    activities = [copy.deepcopy(ACTIVITY), other]
+    self.twitter.fetch_replies(activities)
+
+    expected_other = copy.deepcopy(other)
+    expected_other['object']['replies'] = {'items': [], 'totalItems': 0}
+    self.assert_equals([ACTIVITY_WITH_REPLIES, expected_other], activities)
+
   def test_get_activities_fetch_mentions(self):
     self.expect_urlopen(TIMELINE, [])
     self.expect_urlopen('account/verify_credentials.json',
@@ -893,6 +943,23 @@ class TwitterTest(testutil.TestCase):
                        [ACTIVITY, ACTIVITY],
                        self.twitter.get_activities(fetch_shares=True, min_id='567'))
 
+  def test_retweet_limit_concurrent(self):
+    twitter.MAX_WORKERS = 4
+    tweet = copy.deepcopy(TWEET)
+    tweet['retweet_count'] = 1
+    self.expect_urlopen(TIMELINE, [tweet] * (twitter.RETWEET_LIMIT + 2))
+
+    for i in range(twitter.RETWEET_LIMIT):
+      self.expect_urlopen('statuses/retweets.json?id=100&since_id=567', RETWEETS)
+
+    self.mox.ReplayAll()
+    cache = util.CacheDict()
+    self.assert_equals(([ACTIVITY_WITH_SHARES] * twitter.RETWEET_LIMIT) +
+                       [ACTIVITY, ACTIVITY],
+                       self.twitter.get_activities(fetch_shares=True, min_id='567',
+                                                   cache=cache))
+    self.assert_equals(1, cache['ATR 100'])
+
   def test_get_activities_request_etag(self):
     self.expect_urlopen(TIMELINE, [], headers={'If-none-match': '"my etag"'})
     self.mox.ReplayAll()
@@ -915,6 +982,11 @@ class TwitterTest(testutil.TestCase):
     self.mox.ReplayAll()
     self.twitter.get_activities_response(min_id=135)
 
+  def test_get_activities_timeline_min_id(self):
+    self.expect_urlopen(TIMELINE + '&since_id=135', [])
+    self.mox.ReplayAll()
+    self.twitter.get_activities_response(min_id=135, timeline_min_id=True)
+
   def test_get_activities_retries(self):
     for exc in (httplib.HTTPException('Deadline exceeded: foo'),
                 socket.error('asdf'),
@@ -967,6 +1039,38 @@ class TwitterTest(testutil.TestCase):
     # just test that we don't crash
     self.twitter.tweet_to_activity({})
 
+  def test_tweets_to_activities(self):
+    # TWEET_2's user has the same id as TWEET's but a different name, so its
+    # actor shouldn't come from the memo.
+    tweets = [TWEET, TWEET_WITH_RETWEETS, TWEET_2, TWEET, {}]
+    expected = [self.twitter.tweet_to_activity(t) for t in tweets]
+    self.assert_equals(expected, self.twitter.tweets_to_activities(tweets))
+    self.assert_equals([ACTIVITY, ACTIVITY_2],
+                       self.twitter.tweets_to_activities([TWEET, TWEET_2]))
+    self.assertIsNone(self.twitter._actor_memo)
+
+  def test_tweets_to_activities_actors_not_shared(self):
+    acts = self.twitter.tweets_to_activities([TWEET, TWEET, TWEET])
+    acts[0]['actor']['displayName'] = 'changed'
+    acts[1]['actor']['image']['url'] = 'http://changed/pic'
+    self.assert_equals(ACTIVITY['actor'], acts[2]['actor'])
+
+  def test_rfc2822_to_iso8601(self):
+    for _ in range(2):  # second time is cached
+      for input, expected in (
+          (None, None),
+          ('', None),
+          ('Wed May 23 06:01:13 +0000 2007', '2007-05-23T06:01:13+00:00'),
+          ('Sun Feb 29 23:59:59 -0530 2004', '2004-02-29T23:59:59-05:30'),
+          # not the exact format, handled by strptime
+          ('Mon Jan 1 00:00:00 +0130 2010', '2010-01-01T00:00:00+01:30'),
+          ('mon jan 01 00:00:00 +0000 2010', '2010-01-01T00:00:00+00:00'),
+        ):
+        self.assertEquals(expected, twitter.Twitter.rfc2822_to_iso8601(input))
+
+    with self.assertRaises(ValueError):
+      twitter.Twitter.rfc2822_to_iso8601('Fri Feb 30 00:00:00 +0000 2015')
+
   def test_tweet_to_object_full(self):
     self.assert_equals(OBJECT, self.twitter.tweet_to_object(TWEET))
 
@@ -1627,6 +1731,17 @@ class TwitterTest(testutil.TestCase):
     preview = self.twitter.preview_create(LIKES_FROM_HTML[0])
     self.assertIn('<span class="verb">favorite</span> <a href="https://twitter.com/snarfed_org/status/100">this tweet</a>:', preview.description)
 
+  def test_urlopen_http_pool(self):
+    self.twitter.http_pool = self.mox.CreateMock(source.HttpPool)
+    self.twitter.http_pool.urlopen(twitter.API_BASE + 'foo', headers=mox.IsA(dict)
+                                   ).AndReturn(StringIO.StringIO('{"x": 1}'))
+    # POSTs are signed and sent by signed_urlopen(), not the pool
+    self.expect_urlopen(twitter.API_POST_FAVORITE, TWEET, params={'id': 100})
+    self.mox.ReplayAll()
+
+    self.assertEquals({'x': 1}, self.twitter.urlopen('foo'))
+    self.assertEquals('like', self.twitter.create(LIKES_FROM_HTML[0]).content['type'])
+
   def test_create_retweet(self):
     self.expect_urlopen(twitter.API_POST_RETWEET % 333, TWEET, params={'id': 333})
     self.mox.ReplayAll()
@@ -0,0 +1,238 @@
+"""Timestamp parsing and formatting for the silos.
+
+Each silo emits timestamps in its own format:
+
+* Twitter: RFC 2822-ish, e.g. 'Wed May 23 06:01:13 +0000 2007'
+* Facebook: ISO 8601 with an offset, e.g. '2012-03-04T18:20:37+0000'
+* Flickr, Instagram: UNIX timestamps in seconds, e.g. '1291338921'
+* Google+: UNIX timestamps in milliseconds
+
+These functions convert them on the conversion hot path. The common exact
+layouts are parsed by hand, without regexps or strptime, and anything else
+falls back to the slower general purpose code, so output is always the same.
+Converters remember recently seen inputs, since timestamps like users' creation
+times repeat a lot within a single response. Use convert_multi() to convert
+many timestamps at once.
+"""
+
+__author__ = ['Ryan Barrett <granary@ryanb.org>']
+
+import collections
+import datetime
+import functools
+import re
+import threading
+
+from oauth_dropins.webutil import util
+
+# Each converter remembers its results for this many recent inputs.
+CACHE_SIZE = 2000
+
+# Twitter's timestamp format, e.g. 'Wed May 23 06:01:13 +0000 2007'.
+RFC2822_FORMAT = '%a %b %d %H:%M:%S %Y'
+RFC2822_OFFSET_RE = re.compile('[+-][0-9]{4}')
+RFC2822_OFFSET_SUB_RE = re.compile(' [+-][0-9]{4} ')
+WEEKDAYS = frozenset(('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'))
+MONTHS = {name: i + 1 for i, name in enumerate(
+  ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+   'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'))}
+
+
+class OffsetTzinfo(datetime.tzinfo):
+  """A simple, DST-unaware tzinfo from given utc offset in seconds.
+  """
+  def __init__(self, utc_offset=0):
+    """Constructor.
+
+    Args:
+      utc_offset: Offset of time zone from UTC in seconds
+    """
+    self._offset = datetime.timedelta(seconds=utc_offset)
+
+  def utcoffset(self, dt):
+    return self._offset
+
+  def dst(self, dt):
+    return datetime.timedelta(0)
+
+
+UTC = OffsetTzinfo(0)
+
+# maps utc offset in seconds to OffsetTzinfo. OffsetTzinfo is immutable, so
+# instances are shared.
+_tzinfos = {0: UTC}
+
+
+def tzinfo(offset):
+  """Returns the shared OffsetTzinfo for a utc offset.
+
+  Args:
+    offset: integer, seconds
+  """
+  tz = _tzinfos.get(offset)
+  if tz is None:
+    tz = _tzinfos.setdefault(offset, OffsetTzinfo(offset))
+  return tz
+
+
+def _memoize(fn):
+  """Decorator for single argument converters. Remembers the last CACHE_SIZE
+  results, least recently used first. Doesn't cache exceptions.
+  """
+  results = collections.OrderedDict()
+  lock = threading.Lock()
+
+  @functools.wraps(fn)
+  def wrapper(input):
+    # include the type since e.g. 1 == 1.0 but they can convert differently
+    key = (type(input), input)
+    try:
+      hash(key)
+    except TypeError:  # unhashable
+      return fn(input)
+
+    with lock:
+      if key in results:
+        result = results[key] = results.pop(key)  # move to most recent
+        return result
+
+    result = fn(input)
+    with lock:
+      results[key] = result
+      if len(results) > CACHE_SIZE:
+        results.popitem(last=False)
+    return result
+
+  return wrapper
+
+
+def convert_multi(convert, inputs):
+  """Converts many timestamps, converting each distinct value only once.
+
+  Args:
+    convert: one of the converter functions in this module
+    inputs: sequence of timestamps
+
+  Returns: list of converted timestamps, in the same order as inputs
+  """
+  converted = {}
+  results = []
+  for input in inputs:
+    key = (type(input), input)
+    try:
+      result = converted[key]
+    except KeyError:
+      result = converted[key] = convert(input)
+    except TypeError:  # unhashable
+      result = convert(input)
+    results.append(result)
+  return results
+
+
+def _offset(sign, hours, minutes):
+  """Returns a utc offset in seconds. All args are strings."""
+  offset = 3600 * int(hours) + 60 * int(minutes)
+  return -offset if sign == '-' else offset
+
+
+def _parse_rfc2822(time_str):
+  """Parses a timestamp in Twitter's exact format without strptime.
+
+  Returns a datetime, or None if time_str doesn't match the format exactly, in
+  which case the caller should fall back to strptime.
+  """
+  parts = time_str.split(' ')
+  if len(parts) != 6:
+    return None
+
+  weekday, month, day, hms, timezone, year = parts
+  month = MONTHS.get(month)
+  hms = hms.split(':')
+  if (weekday not in WEEKDAYS or not month or len(day) != 2 or len(hms) != 3 or
+      len(timezone) != 5 or timezone[0] not in '+-' or len(year) != 4 or
+      not (day + ''.join(hms) + timezone[1:] + year).isdigit() or
+      any(len(field) != 2 for field in hms)):
+    return None
+
+  try:
+    offset = _offset(timezone[0], timezone[1:3], timezone[3:])
+    return datetime.datetime(int(year), month, int(day), int(hms[0]),
+                             int(hms[1]), int(hms[2]), tzinfo=tzinfo(offset))
+  except ValueError:  # e.g. Feb 30. let strptime raise its usual error.
+    return None
+
+
+@_memoize
+def rfc2822_to_iso8601(time_str):
+  """Converts a timestamp string from RFC 2822 format to ISO 8601.
+
+  Example RFC 2822 timestamp string generated by Twitter:
+    'Wed May 23 06:01:13 +0000 2007'
+
+  Resulting ISO 8610 timestamp string:
+    '2007-05-23T06:01:13+00:00'
+  """
+  if not time_str:
+    return None
+
+  dt = _parse_rfc2822(time_str)
+  if dt is None:
+    without_timezone = RFC2822_OFFSET_SUB_RE.sub(' ', time_str)
+    timezone = RFC2822_OFFSET_RE.search(time_str).group(0)
+    offset = _offset(timezone[0], timezone[1:3], timezone[3:])
+    dt = datetime.datetime.strptime(without_timezone, RFC2822_FORMAT
+                                    ).replace(tzinfo=tzinfo(offset))
+
+  return dt.isoformat()
+
+
+@_memoize
+def iso8601_to_rfc3339(time_str):
+  """Converts an ISO 8601 timestamp string to RFC 3339.
+
+  Same as util.maybe_iso8601_to_rfc3339(), including returning unparseable
+  input unchanged, but parses Facebook's exact format by hand, e.g.
+  '2012-03-04T18:20:37+0000' => '2012-03-04T18:20:37+00:00'.
+  """
+  if (isinstance(time_str, basestring) and len(time_str) == 24 and
+      time_str[4] == time_str[7] == '-' and time_str[10] == 'T' and
+      time_str[13] == time_str[16] == ':' and time_str[19] in '+-'):
+    digits = (time_str[:4], time_str[5:7], time_str[8:10], time_str[11:13],
+              time_str[14:16], time_str[17:19], time_str[20:22], time_str[22:])
+    if ''.join(digits).isdigit():
+      try:
+        fields = [int(d) for d in digits[:6]]
+        offset = _offset(time_str[19], digits[6], digits[7])
+        return datetime.datetime(*fields, tzinfo=tzinfo(offset)).isoformat('T')
+      except ValueError:
+        pass
+
+  return util.maybe_iso8601_to_rfc3339(time_str)
+
+
+@_memoize
+def timestamp_to_rfc3339(timestamp):
+  """Converts a UNIX timestamp in seconds to RFC 3339, in local time.
+
+  Same as util.maybe_timestamp_to_rfc3339(), including returning unparseable
+  input unchanged, but converts integers and digit strings directly, e.g.
+  '1291338921' => '2010-12-03T01:15:21' in UTC. Results are memoized, so don't
+  change the process's time zone after converting.
+  """
+  if (isinstance(timestamp, (int, long)) and not isinstance(timestamp, bool) or
+      isinstance(timestamp, basestring) and timestamp.isdigit()):
+    try:
+      return datetime.datetime.fromtimestamp(int(timestamp)).isoformat('T')
+    except (ValueError, OverflowError):
+      pass
+
+  return util.maybe_timestamp_to_rfc3339(timestamp)
+
+
+@_memoize
+def ms_timestamp_to_iso8601(timestamp):
+  """Converts a UNIX timestamp in milliseconds to ISO 8601 in UTC, with a Z.
+
+  e.g. 1440425513000 => '2015-08-24T14:11:53Z'
+  """
+  return datetime.datetime.utcfromtimestamp(timestamp / 1000).isoformat('T') + 'Z'
@@ -13,7 +13,6 @@ https://dev.twitter.com/docs/platform-objects/users
 __author__ = ['Ryan Barrett <granary@ryanb.org>']
 
 import collections
-import datetime
 import itertools
 import httplib
 import json
@@ -31,6 +30,7 @@ from bs4 import BeautifulSoup
 import requests
 
 import source
+import times
 from oauth_dropins import twitter_auth
 from oauth_dropins.webutil import util
 
@@ -61,6 +61,10 @@ PROFILE_PICTURE_URL = 'https://twitter.com/%s/profile_image?size=original'
 # TODO: sigh. figure out a better way. dammit twitter, give me a batch API!!!
 RETWEET_LIMIT = 15
 
+# Max number of API calls to make in parallel when fanning out, e.g. fetching
+# retweets for each tweet. Set to 1 to make them serially.
+MAX_WORKERS = source.MAX_WORKERS
+
 # Number of IDs to search for at a time
 QUOTE_SEARCH_BATCH_SIZE = 20
 
@@ -86,23 +90,12 @@ MAX_VIDEO_SIZE = 15 * MB
 UPLOAD_CHUNK_SIZE = 5 * MB
 VIDEO_MIME_TYPES = frozenset(('video/mp4',))
 
+# yes, the tweet source field has an embedded HTML link. bleh.
+# https://dev.twitter.com/docs/api/1.1/get/statuses/show/
+SOURCE_RE = re.compile('<a href="([^"]+)".*>(.+)</a>')
 
-class OffsetTzinfo(datetime.tzinfo):
-  """A simple, DST-unaware tzinfo from given utc offset in seconds.
-  """
-  def __init__(self, utc_offset=0):
-    """Constructor.
-
-    Args:
-      utc_offset: Offset of time zone from UTC in seconds
-    """
-    self._offset = datetime.timedelta(seconds=utc_offset)
-
-  def utcoffset(self, dt):
-    return self._offset
-
-  def dst(self, dt):
-    return datetime.timedelta(0)
+# moved to the times module. kept here for backward compatibility.
+OffsetTzinfo = times.OffsetTzinfo
 
 
 class Twitter(source.Source):
@@ -150,23 +143,30 @@ class Twitter(source.Source):
       url = API_USER % screen_name
     return self.user_to_actor(self.urlopen(url))
 
+  @source.with_actor_memo
   def get_activities_response(self, user_id=None, group_id=None, app_id=None,
                               activity_id=None, start_index=0, count=0,
                               etag=None, min_id=None, cache=None,
                               fetch_replies=False, fetch_likes=False,
                               fetch_shares=False, fetch_events=False,
-                              fetch_mentions=False, search_query=None, **kwargs):
+                              fetch_mentions=False, search_query=None,
+                              cursor=None, timeline_min_id=False, **kwargs):
     """Fetches posts and converts them to ActivityStreams activities.
 
     XXX HACK: this is currently hacked for bridgy to NOT pass min_id to the
     request for fetching activity tweets themselves, but to pass it to all of
     the requests for filling in replies, retweets, etc. That's because we want
-    to find new replies and retweets of older initial tweets.
+    to find new replies and retweets of older initial tweets. Pass
+    timeline_min_id=True to pass it to the initial request too.
     TODO: find a better way.
 
     See method docstring in source.py for details. app_id is ignored.
     min_id is translated to Twitter's since_id.
 
+    Cursors wrap Twitter's max_id, so later pages don't have to fetch and skip
+    all of the tweets before them like start_index does.
+    https://dev.twitter.com/rest/public/timelines
+
     The code for handling ETags (and 304 Not Changed responses and setting
     If-None-Match) is here, but unused right now since Twitter evidently doesn't
     support ETags. From https://dev.twitter.com/discussions/5800 :
@@ -178,7 +178,8 @@ class Twitter(source.Source):
     Streaming API, though, and convert them with streaming_event_to_object().
     https://dev.twitter.com/docs/streaming-apis/messages#Events_event
 
-    Shares (ie retweets) are fetched with a separate API call per tweet:
+    Shares (ie retweets) are fetched with a separate API call per tweet, up to
+    MAX_WORKERS at a time in parallel:
     https://dev.twitter.com/docs/api/1.1/get/statuses/retweets/%3Aid
 
     However, retweets are only fetched for the first 15 tweets that have them,
@@ -205,6 +206,11 @@ class Twitter(source.Source):
     * it's not a reply, OR
     * it's a reply, but not to the current user, AND
       * the tweet it's replying to doesn't @-mention the current user
+
+    Additional args:
+      timeline_min_id: boolean, whether to also pass min_id as since_id to the
+        initial request for tweets. poll() sets this when it isn't fetching
+        replies, likes, etc.
     """
     if group_id is None:
       group_id = source.FRIENDS
@@ -217,10 +223,16 @@ class Twitter(source.Source):
       return user[0]
 
     activities = []
+    next_cursor = None
     if activity_id:
       tweets = [self.urlopen(API_STATUS % activity_id)]
       total_count = len(tweets)
     else:
+      max_id = None
+      if cursor:
+        max_id = source.decode_cursor(cursor).get('max_id')
+        start_index = 0
+
       if group_id == source.SELF:
         if user_id in (None, source.ME):
           user_id = ''
@@ -249,6 +261,11 @@ class Twitter(source.Source):
           'owner_screen_name': user_id,
         }
 
+      if max_id:
+        url = util.add_query_params(url, {'max_id': max_id})
+      if timeline_min_id and min_id is not None:
+        url = util.add_query_params(url, {'since_id': min_id})
+
       headers = {'If-None-Match': etag} if etag else {}
       total_count = None
       try:
@@ -258,6 +275,11 @@ class Twitter(source.Source):
         if group_id == source.SEARCH:
           tweet_obj = tweet_obj.get('statuses', [])
         tweets = tweet_obj[start_index:]
+        oldest_id = tweets[-1].get('id_str') if tweets else None
+        if oldest_id and oldest_id.isdigit():
+          # max_id is inclusive, so start the next page just before this one's
+          # oldest tweet
+          next_cursor = source.encode_cursor({'max_id': str(int(oldest_id) - 1)})
       except urllib2.HTTPError, e:
         if e.code == 304:  # Not Modified, from a matching ETag
           tweets = []
@@ -273,44 +295,45 @@ class Twitter(source.Source):
     cache_updates = {}
 
     if fetch_shares:
-      retweet_calls = 0
+      to_fetch = []
       for tweet in tweets:
         if tweet.get('retweeted'):  # this tweet is itself a retweet
           continue
-        elif retweet_calls >= RETWEET_LIMIT:
+        elif len(to_fetch) >= RETWEET_LIMIT:
           logging.warning("Hit Twitter's retweet rate limit (%d) with more to "
                           "fetch! Results will be incomplete!" % RETWEET_LIMIT)
           break
 
-        # store retweets in the 'retweets' field, which is handled by
-        # tweet_to_activity().
-        # TODO: make these HTTP requests asynchronous. not easy since we don't
-        # (yet) require threading support or use a non-blocking HTTP library.
-        #
         # twitter limits this API endpoint to one call per minute per user,
         # which is easy to hit, so we stop before we hit that.
         # https://dev.twitter.com/docs/rate-limiting/1.1/limits
         #
         # can't use the statuses/retweets_of_me endpoint because it only
         # returns the original tweets, not the retweets or their authors.
-        id = tweet['id_str']
         count = tweet.get('retweet_count')
-        if count and count != cached.get('ATR ' + id):
-          url = API_RETWEETS % id
-          if min_id is not None:
-            url = util.add_query_params(url, {'since_id': min_id})
+        if count and count != cached.get('ATR ' + tweet['id_str']):
+          to_fetch.append(tweet)
 
-          try:
-            tweet['retweets'] = self.urlopen(url)
-          except urllib2.URLError, e:
-            code, _ = util.interpret_http_exception(e)
-            if code != '404':  # 404 means the original tweet was deleted
-              raise
+      # store retweets in the 'retweets' field, which is handled by
+      # tweet_to_activity(). the calls are independent, so make them in
+      # parallel.
+      def fetch_retweets(tweet):
+        url = API_RETWEETS % tweet['id_str']
+        if min_id is not None:
+          url = util.add_query_params(url, {'since_id': min_id})
+
+        try:
+          tweet['retweets'] = self.urlopen(url)
+        except urllib2.URLError, e:
+          code, _ = util.interpret_http_exception(e)
+          if code != '404':  # 404 means the original tweet was deleted
+            raise
 
-          retweet_calls += 1
-          cache_updates['ATR ' + id] = count
+      source.run_concurrently(fetch_retweets, to_fetch, max_workers=MAX_WORKERS)
+      for tweet in to_fetch:
+        cache_updates['ATR ' + tweet['id_str']] = tweet.get('retweet_count')
 
-    tweet_activities = [self.tweet_to_activity(t) for t in tweets]
+    tweet_activities = self.tweets_to_activities(tweets)
 
     if fetch_replies:
       self.fetch_replies(tweet_activities, min_id=min_id)
@@ -320,7 +343,7 @@ class Twitter(source.Source):
       # https://github.com/snarfed/bridgy/issues/631
       mentions = self.fetch_mentions(_user().get('screen_name'), tweets,
                                      min_id=min_id)
-      tweet_activities += [self.tweet_to_activity(m) for m in mentions]
+      tweet_activities += self.tweets_to_activities(mentions)
 
     if fetch_likes:
       for tweet, activity in zip(tweets, tweet_activities):
@@ -329,7 +352,7 @@ class Twitter(source.Source):
         if self.is_public(activity) and count and count != cached.get('ATF ' + id):
           url = HTML_FAVORITES % id
           try:
-            html = json.loads(util.urlopen(url).read()).get('htmlUsers', '')
+            html = json.loads(self._urlopen(url).read()).get('htmlUsers', '')
           except urllib2.URLError, e:
             util.interpret_http_exception(e)  # just log it
             continue
@@ -340,6 +363,8 @@ class Twitter(source.Source):
     activities += tweet_activities
     response = self.make_activities_base_response(activities)
     response.update({'total_count': total_count, 'etag': etag})
+    if next_cursor:
+      response['nextCursor'] = next_cursor
     if cache_updates and cache is not None:
       cache.set_multi(cache_updates)
     return response
@@ -351,6 +376,10 @@ class Twitter(source.Source):
     for @-mentions, matches them to the original tweets with
     in_reply_to_status_id_str, and recurses until it's walked the entire tree.
 
+    Walks all of the activities' reply trees together, one level at a time. Each
+    level's @-mention searches are made in parallel, up to MAX_WORKERS at a
+    time, and each author is only searched once across all activities.
+
     Args:
       activities: list of activity dicts
 
@@ -358,53 +387,70 @@ class Twitter(source.Source):
       same activities list
     """
 
-    # cache searches for @-mentions for individual users. maps username to dict
-    # mapping tweet id to ActivityStreams reply object dict.
+    # cache searches for @-mentions for individual users. maps username to list
+    # of Twitter API tweet dicts.
     mentions = {}
 
-    # find replies
+    def search_mentions(author):
+      # get mentions of this tweet's author so we can search them for replies to
+      # this tweet. can't use statuses/mentions_timeline because i'd need to
+      # auth as the user being mentioned.
+      # https://dev.twitter.com/docs/api/1.1/get/statuses/mentions_timeline
+      url = API_SEARCH % {
+        'q': urllib.quote_plus('@' + author),
+        'count': 100,
+      }
+      if min_id is not None:
+        url = util.add_query_params(url, {'since_id': min_id})
+      return self.urlopen(url)['statuses']
+
+    # for each activity, a list of ActivityStreams reply object dicts and a set
+    # of seen activity ids (tag URIs). seed with the original tweet; we'll filter
+    # it out later.
+    trees = []
     for activity in activities:
-      # list of ActivityStreams reply object dict and set of seen activity ids
-      # (tag URIs). seed with the original tweet; we'll filter it out later.
-      replies = [activity]
       _, id = util.parse_tag_uri(activity['id'])
-      seen_ids = set([id])
-
-      for reply in replies:
-        # get mentions of this tweet's author so we can search them for replies to
-        # this tweet. can't use statuses/mentions_timeline because i'd need to
-        # auth as the user being mentioned.
-        # https://dev.twitter.com/docs/api/1.1/get/statuses/mentions_timeline
-        #
-        # note that these HTTP requests are synchronous. you can make async
-        # requests by using urlfetch.fetch() directly, but not with urllib2.
-        # https://developers.google.com/appengine/docs/python/urlfetch/asynchronousrequests
-        author = reply['actor']['username']
-        if author not in mentions:
-          url = API_SEARCH % {
-            'q': urllib.quote_plus('@' + author),
-            'count': 100,
-          }
-          if min_id is not None:
-            url = util.add_query_params(url, {'since_id': min_id})
-          mentions[author] = self.urlopen(url)['statuses']
-
-        # look for replies. add any we find to the end of replies. this makes us
-        # recursively follow reply chains to their end. (python supports
-        # appending to a sequence while you're iterating over it.)
-        for mention in mentions[author]:
-          id = mention['id_str']
-          if (mention.get('in_reply_to_status_id_str') in seen_ids and
-              id not in seen_ids):
-            replies.append(self.tweet_to_activity(mention))
-            seen_ids.add(id)
-
+      trees.append(([activity], set([id])))
+
+    # index of the first reply in each tree that we haven't searched yet
+    done = [0] * len(trees)
+
+    while any(start < len(replies) for (replies, _), start in zip(trees, done)):
+      # collect the authors at this level, across all activities, that we
+      # haven't searched yet, in the order we first see them.
+      level = []
+      for (replies, _), start in zip(trees, done):
+        for reply in replies[start:]:
+          author = reply['actor']['username']
+          if author not in mentions and author not in level:
+            level.append(author)
+
+      mentions.update(zip(level, source.run_concurrently(
+        search_mentions, level, max_workers=MAX_WORKERS)))
+
+      # look for replies. add any we find to the end of replies. they'll be
+      # searched in the next level. this makes us follow reply chains to their
+      # end.
+      for i, (replies, seen_ids) in enumerate(trees):
+        end = len(replies)
+        for reply in replies[done[i]:end]:
+          for mention in mentions[reply['actor']['username']]:
+            id = mention['id_str']
+            if (mention.get('in_reply_to_status_id_str') in seen_ids and
+                id not in seen_ids):
+              replies.append(self.tweet_to_activity(mention))
+              seen_ids.add(id)
+        done[i] = end
+
+    for activity, (replies, _) in zip(activities, trees):
       items = [r['object'] for r in replies[1:]]  # filter out seed activity
       activity['object']['replies'] = {
         'items': items,
         'totalItems': len(items),
         }
 
+    return activities
+
   def fetch_mentions(self, username, tweets, min_id=None):
     """Fetches a user's @-mentions and returns them as ActivityStreams.
 
@@ -911,13 +957,23 @@ class Twitter(source.Source):
 
   def urlopen(self, url, parse_response=True, **kwargs):
     """Wraps urllib2.urlopen() and adds an OAuth signature.
+
+    Uses http_pool's keep-alive connections for GETs if it's set. Everything
+    else goes through twitter_auth.signed_urlopen(), which moves POST params
+    into the URL before signing, since Twitter rejects the signature otherwise.
     """
     if not url.startswith('http'):
       url = API_BASE + url
 
     def request():
-      resp = twitter_auth.signed_urlopen(
-        url, self.access_token_key, self.access_token_secret, **kwargs)
+      if self.http_pool and not set(kwargs) - set(['headers']):
+        headers = dict(kwargs.get('headers') or {})
+        headers.update(twitter_auth.auth_header(
+          url, self.access_token_key, self.access_token_secret, 'GET'))
+        resp = self.http_pool.urlopen(url, headers=headers)
+      else:
+        resp = twitter_auth.signed_urlopen(
+          url, self.access_token_key, self.access_token_secret, **kwargs)
       if parse_response:
         try:
           return json.loads(resp.read())
@@ -1006,15 +1062,41 @@ class Twitter(source.Source):
     if in_reply_to:
       activity['context'] = {'inReplyTo': in_reply_to}
 
-    # yes, the source field has an embedded HTML link. bleh.
-    # https://dev.twitter.com/docs/api/1.1/get/statuses/show/
-    parsed = re.search('<a href="([^"]+)".*>(.+)</a>', tweet.get('source', ''))
+    parsed = SOURCE_RE.search(tweet.get('source', ''))
     if parsed:
       url, name = parsed.groups()
       activity['generator'] = {'displayName': name, 'url': url}
 
     return self.postprocess_activity(activity)
 
+  def poll_min_id_kwargs(self, min_id, extras):
+    """min_id always applies to the requests for replies, retweets, etc, and
+    also to the timeline when there are no extras to fetch. See
+    get_activities_response().
+    """
+    return {'min_id': min_id, 'timeline_min_id': not extras}
+
+  @classmethod
+  def min_id_key(cls, silo_id):
+    """Tweet ids are integers. Other ids, e.g. favorites', aren't compared."""
+    return int(silo_id) if silo_id.isdigit() else None
+
+  def tweets_to_activities(self, tweets):
+    """Converts a list of tweets to activities.
+
+    Equivalent to [self.tweet_to_activity(t) for t in tweets], but converts
+    each distinct user to an actor only once, which adds up for timelines with
+    many tweets, retweets, and quotes by the same people.
+
+    Args:
+      tweets: sequence of dicts, decoded JSON tweets
+
+    Returns:
+      list of ActivityStreams activity dicts
+    """
+    with self.actor_memo():
+      return [self.tweet_to_activity(t) for t in tweets]
+
   def tweet_to_object(self, tweet):
     """Converts a tweet to an object.
 
@@ -1183,6 +1265,7 @@ class Twitter(source.Source):
 
     return entities
 
+  @source.memoized_actor
   def user_to_actor(self, user):
     """Converts a tweet to an activity.
 
@@ -1333,25 +1416,15 @@ class Twitter(source.Source):
   def rfc2822_to_iso8601(time_str):
     """Converts a timestamp string from RFC 2822 format to ISO 8601.
 
+    Delegates to times.rfc2822_to_iso8601().
+
     Example RFC 2822 timestamp string generated by Twitter:
       'Wed May 23 06:01:13 +0000 2007'
 
     Resulting ISO 8610 timestamp string:
       '2007-05-23T06:01:13'
     """
-    if not time_str:
-      return None
-
-    without_timezone = re.sub(' [+-][0-9]{4} ', ' ', time_str)
-    timezone = re.search('[+-][0-9]{4}', time_str).group(0)
-    ## convert offset to seconds
-    offset = 3600 * int(timezone[1:3]) + 60 * int(timezone[3:])
-    ## negative offset
-    if timezone[0] == '-':
-      offset = -offset
-
-    dt = datetime.datetime.strptime(without_timezone, '%a %b %d %H:%M:%S %Y').replace(tzinfo=OffsetTzinfo(offset))
-    return dt.isoformat()
+    return times.rfc2822_to_iso8601(time_str)
 
   def user_url(self, username):
     """Returns the Twitter URL for a given user."""
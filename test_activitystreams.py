@@ -5,6 +5,7 @@ __author__ = ['Ryan Barrett <granary@ryanb.org>']
 
 import copy
 import json
+import mox
 
 import oauth_dropins.webutil.test
 from oauth_dropins.webutil import testutil
@@ -106,6 +107,25 @@ class HandlerTest(testutil.HandlerTest):
   def test_json_format(self):
     self.check_request('/@me/?format=json', None)
 
+  def test_json_format_small_chunks(self):
+    orig = activitystreams.OUTPUT_CHUNK_SIZE
+    activitystreams.OUTPUT_CHUNK_SIZE = 5
+    try:
+      resp = self.get_response('/fake?format=json')
+    finally:
+      activitystreams.OUTPUT_CHUNK_SIZE = orig
+
+    self.assertEquals(200, resp.status_int)
+    self.assert_multiline_equals(json.dumps({
+        'startIndex': 0,
+        'itemsPerPage': 1,
+        'totalResults': 9,
+        'items': [{'foo': 'bar'}],
+        'filtered': False,
+        'sorted': False,
+        'updatedSince': False,
+        }, indent=2), resp.body)
+
   def test_xml_format(self):
     resp = self.get_response('/fake?format=xml')
     self.assertEquals(200, resp.status_int)
@@ -173,6 +193,67 @@ class HandlerTest(testutil.HandlerTest):
   def test_count_greater_than_items_per_page(self):
     self.check_request('?count=999', count=activitystreams.ITEMS_PER_PAGE)
 
+  def test_cursor(self):
+    cursor = source.encode_cursor({'max_id': '99'})
+    self.check_request('?cursor=%s&startIndex=5' % cursor, cursor=cursor)
+
+  def test_bad_cursor(self):
+    resp = activitystreams.application.get_response('/fake?cursor=%%%')
+    self.assertEquals(400, resp.status_int)
+
+  def test_response_cache(self):
+    kwargs = {'start_index': 0, 'count': activitystreams.ITEMS_PER_PAGE}
+    FakeSource.get_activities_response(**kwargs).AndReturn(
+      {'items': self.activities, 'etag': '"up"'})
+    # upstream hasn't changed
+    for _ in range(2):
+      FakeSource.get_activities_response(etag='"up"', **kwargs).AndReturn(
+        {'items': [], 'etag': '"up"'})
+    # upstream has changed
+    FakeSource.get_activities_response(etag='"up"', **kwargs).AndReturn(
+      {'items': [{'baz': 'baj'}], 'etag': '"new"'})
+    self.mox.ReplayAll()
+
+    try:
+      activitystreams.Handler.response_cache = source.LRUCache(10, 60)
+      get = activitystreams.application.get_response
+
+      first = get('/fake/?access_token=x')
+      self.assertEquals(200, first.status_int)
+      etag = first.headers['ETag']
+
+      resp = get('/fake/?access_token=x')
+      self.assertEquals(200, resp.status_int)
+      self.assertEquals(first.body, resp.body)
+      self.assertEquals('application/json', resp.headers['Content-Type'])
+      self.assertEquals(etag, resp.headers['ETag'])
+
+      resp = get('/fake/?access_token=x', headers={'If-None-Match': etag})
+      self.assertEquals(304, resp.status_int)
+      self.assertEquals('', resp.body)
+
+      resp = get('/fake/?access_token=x', headers={'If-None-Match': etag})
+      self.assertEquals(200, resp.status_int)
+      self.assertEquals([{'baz': 'baj'}], json.loads(resp.body)['items'])
+    finally:
+      activitystreams.Handler.response_cache = None
+
+  def test_response_cache_ttl(self):
+    FakeSource.get_activities_response(
+      start_index=0, count=activitystreams.ITEMS_PER_PAGE).AndReturn(
+        {'items': self.activities})
+    cache = self.mox.CreateMockAnything()
+    cache.get(mox.IsA(basestring)).AndReturn(None)
+    cache.set_multi(mox.IsA(dict), time=activitystreams.RESPONSE_CACHE_TTL)
+    self.mox.ReplayAll()
+
+    try:
+      activitystreams.Handler.response_cache = cache
+      resp = activitystreams.application.get_response('/fake/')
+      self.assertEquals(200, resp.status_int)
+    finally:
+      activitystreams.Handler.response_cache = None
+
     # TODO: move to facebook and/or twitter since they do implementation
   # def test_start_index_count_zero(self):
   #   self.check_request('?startIndex=0&count=0', self.ACTIVITIES)
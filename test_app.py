@@ -2,12 +2,14 @@
 """
 
 import json
+import StringIO
 import xml.sax.saxutils
 
 import oauth_dropins.webutil.test
 from oauth_dropins.webutil import testutil
 
 import app
+from granary import source
 
 
 ACTIVITIES = [{
@@ -197,3 +199,75 @@ class AppTest(testutil.HandlerTest):
     headers = resp.headers.getall('Link')
     self.assertIn('<http://a/hub>; rel="hub"', headers)
     self.assertIn('<%s>; rel="self"' % self_url, headers)
+
+  def test_url_response_cache(self):
+    for _ in range(2):
+      self.expect_urlopen('http://my/posts.json', json.dumps(ACTIVITIES))
+    self.mox.ReplayAll()
+
+    url = '/url?url=http://my/posts.json&input=activitystreams&output=json-mf2'
+    try:
+      app.UrlHandler.response_cache = source.LRUCache(10, 60)
+      resp = app.application.get_response(url)
+      self.assert_equals(200, resp.status_int)
+      etag = resp.headers['ETag']
+
+      resp = app.application.get_response(url, headers={'If-None-Match': etag})
+      self.assert_equals(304, resp.status_int)
+    finally:
+      app.UrlHandler.response_cache = None
+
+  def test_url_conditional_get(self):
+    self.expect_urlopen('http://my/posts.json', json.dumps(ACTIVITIES),
+                        response_headers={
+                          'ETag': '"abc"',
+                          'Last-Modified': 'Sat, 01 Oct 2016 00:00:00 GMT',
+                        })
+    self.expect_urlopen('http://my/posts.json', status=304, headers={
+      'If-none-match': '"abc"',
+      'If-modified-since': 'Sat, 01 Oct 2016 00:00:00 GMT',
+    })
+    self.mox.ReplayAll()
+
+    url = '/url?url=http://my/posts.json&input=activitystreams&output=json-mf2'
+    try:
+      app.UrlHandler.response_cache = source.LRUCache(10, 60)
+      first = app.application.get_response(url)
+      self.assert_equals(200, first.status_int)
+
+      resp = app.application.get_response(url)
+      self.assert_equals(200, resp.status_int)
+      self.assert_equals(first.body, resp.body)
+      self.assert_equals(MF2_JSON, json.loads(resp.body))
+    finally:
+      app.UrlHandler.response_cache = None
+
+  def test_url_max_fetch_bytes(self):
+    mf2_json = json.dumps(MF2_JSON)
+    html = HTML % {'body_class': '', 'extra': ''}
+    self.expect_urlopen('http://my/posts.json', mf2_json)
+    self.expect_urlopen('http://my/posts.html', html)
+    self.mox.ReplayAll()
+
+    orig = app.MAX_FETCH_BYTES
+    try:
+      # truncated JSON can't be parsed
+      app.MAX_FETCH_BYTES = len(mf2_json) - 1
+      resp = app.application.get_response(
+        '/url?url=http://my/posts.json&input=json-mf2&output=html')
+      self.assert_equals(400, resp.status_int)
+
+      # only the first post fits
+      app.MAX_FETCH_BYTES = html.index('baz baj')
+      resp = app.application.get_response(
+        '/url?url=http://my/posts.html&input=html&output=json-mf2')
+      self.assert_equals(200, resp.status_int)
+      self.assert_equals(1, len(json.loads(resp.body)['items']))
+    finally:
+      app.MAX_FETCH_BYTES = orig
+
+  def test_read_bounded(self):
+    for max_bytes, expected in ((3, ('abc', True)), (6, ('abcdef', False)),
+                                (10, ('abcdef', False))):
+      self.assertEquals(expected, app.read_bounded(StringIO.StringIO('abcdef'),
+                                                   max_bytes))